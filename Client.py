@@ -1,19 +1,77 @@
 # echo-client.py
 
+import json
 import sys
 import trio
+from itertools import count
+from struct import Struct
 from trio import sleep
 PORT = 6000
 
+# Framed command format, mirrors skybrush_ext_aimotionlab/protocol.py: magic, version, drone ID, then the lengths of
+# the command, the argument and the payload (and in version 2, the request ID), followed by the command, the argument
+# and the payload themselves.
+MAGIC = b"AIML"
+HEADER_V1 = Struct("<4sBBBHI")
+HEADER = Struct("<4sBBBHII")
+
+# Commands with a request ID are answered with framed responses: magic, version, request ID, status and the length of
+# the JSON body. Each command is acknowledged (status 1) when the server receives it, then answered with its result.
+RESPONSE_MAGIC = b"AIMR"
+RESPONSE_HEADER = Struct("<4sBIBI")
+STATUS_NAMES = {1: "accepted", 2: "ok", 3: "partial", 4: "failed", 5: "rejected"}
+
+
+def encode_command(id_: int, command: bytes, arg: bytes = b"", payload: bytes = b"", request_id=None) -> bytes:
+    if request_id is None:
+        header = HEADER_V1.pack(MAGIC, 1, id_, len(command), len(arg), len(payload))
+    else:
+        header = HEADER.pack(MAGIC, 2, id_, len(command), len(arg), len(payload), request_id)
+    return header + command + arg + payload
+
+
+request_ids = count(1)
+sent_at = {}  # request ID -> when it was sent, to measure the latency of each command
+
+
+# Binary trajectory format, mirrors skybrush_ext_aimotionlab/trajectory_format.py: header, then (t, x, y, z) of each
+# point, the number of control points of each point, and the control points themselves.
+TRAJ_MAGIC = b"AITR"
+TRAJ_VERSION = 1
+TRAJ_HEADER = Struct("<4sBxHHff")
+
+
+def encode_binary_trajectory(data) -> bytes:
+    points = data["points"]
+    controls = [control for point in points for control in point[2]]
+    return (
+        TRAJ_HEADER.pack(TRAJ_MAGIC, TRAJ_VERSION, len(points), len(controls), data.get("takeoffTime", 0.0),
+                         data.get("landingTime", 0.0))
+        + b"".join(Struct("<4f").pack(point[0], *point[1]) for point in points)
+        + b"".join(Struct("<H").pack(len(point[2])) for point in points)
+        + b"".join(Struct("<3f").pack(*control) for control in controls)
+    )
+
+
+def binary_traj(ID, name, command=b"traj"):
+    # Binary trajectories must be sent in the framed format.
+    with open(f"{name}_traj.json", 'rb') as f:
+        payload = encode_binary_trajectory(json.load(f))
+    return encode_command(ID, command, b"relative", payload)
+
 commands = {
     b"takeoff": ((True, float), False),
     b"traj": ((True, str), True),
     b"land": ((False, None), False),
     b"hover": ((False, None), False),
+    b"prepare": ((True, str), True),
+    b"commit": ((False, None), False),
+    b"store": ((True, str), True),
+    b"play": ((True, str), False),
 }
 
 
-async def build_command() -> bytes:
+async def build_command(request_id: int) -> bytes:
     # Prompt user for ID (integer from 0 to 9)
     while True:
         try:
@@ -44,7 +102,7 @@ async def build_command() -> bytes:
             except ValueError:
                 pass
             print(f"Invalid argument. Please enter a {arg_argtype[1].__name__}.")
-        arg = str(arg_str).encode() + b'_'
+        arg = str(arg_str).encode()
     else:
         arg = b""
     if payload:
@@ -52,19 +110,20 @@ async def build_command() -> bytes:
         await sleep(0.1)
         with open(f"{payload}_traj.json", 'rb') as f:
             payload = f.read()
-        payload = payload + b'_'
     else:
         payload = b""
-    return b"CMDSTART_" + str(id_).encode() + b"_" + command + b"_" + arg + payload + b"EOF"
+    return encode_command(id_, command, arg, payload, request_id)
 
 
 async def sender(client_stream: trio.SocketStream):
+    # Every command gets a request ID, so there is no need to wait for the answer before sending the next one.
     print("sender: started!")
     while True:
-        data = await build_command()
+        request_id = next(request_ids)
+        data = await build_command(request_id)
+        sent_at[request_id] = trio.current_time()
         await client_stream.send_all(data)
-        print(f"sender: sending {data}")
-        await trio.sleep(0.5)
+        print(f"sender: sending request {request_id}: {data[:80]}")
 
 
 def cw(ID):
@@ -85,6 +144,18 @@ def traj(ID):
     return b'CMDSTART_'+ ID.encode('utf-8') + b'_traj_relative_' + payload + b'_EOF'
 
 
+def prepare(ID, name):
+    with open (f"{name}_traj.json", 'rb') as f:
+        payload = f.read()
+    return b'CMDSTART_'+ ID.encode('utf-8') + b'_prepare_relative_' + payload + b'_EOF'
+
+
+def store(ID, name):
+    with open (f"{name}_traj.json", 'rb') as f:
+        payload = f.read()
+    return b'CMDSTART_'+ ID.encode('utf-8') + b'_store_' + name.encode('utf-8') + b'_' + payload + b'_EOF'
+
+
 shortcut_dict = {
     "takeoff": b'CMDSTART_0_takeoff_0.6_EOF',
     "takeoff6": b'CMDSTART_6_takeoff_0.6_EOF',
@@ -101,7 +172,18 @@ shortcut_dict = {
     "ccw": ccw(str(0)),
     "ccw6": ccw(str(6)),
     "ccw8": ccw(str(8)),
-    "traj": traj(str(0))
+    "traj": traj(str(0)),
+    "preparecw": prepare(str(0), "cw"),
+    "prepareccw": prepare(str(0), "ccw"),
+    "commit": b'CMDSTART_0_commit_EOF',
+    "commit6": b'CMDSTART_6_commit_EOF',
+    "commit8": b'CMDSTART_8_commit_EOF',
+    "storecw": store(str(0), "cw"),
+    "storeccw": store(str(0), "ccw"),
+    "playcw": b'CMDSTART_0_play_cw_EOF',
+    "playccw": b'CMDSTART_0_play_ccw_EOF',
+    "cwbin": binary_traj(0, "cw"),
+    "ccwbin": binary_traj(0, "ccw"),
 }
 
 
@@ -120,10 +202,29 @@ async def shortcut_sender(client_stream: trio.SocketStream):
 
 async def receiver(client_stream):
     print("receiver: started!")
+    buffer = b""
     async for data in client_stream:
-        if type(data) == bytes:
-            data = data.decode("utf-8")
-        print(f"receiver: got the following data: {data}")
+        buffer += data
+        while buffer:
+            if not buffer.startswith(RESPONSE_MAGIC):
+                # Free text answer of a command without request ID
+                end = buffer.find(RESPONSE_MAGIC)
+                end = len(buffer) if end == -1 else end
+                print(f"receiver: got the following data: {buffer[:end].decode('utf-8', errors='replace')}")
+                buffer = buffer[end:]
+                continue
+            if len(buffer) < RESPONSE_HEADER.size:
+                break
+            _, _, request_id, status, length = RESPONSE_HEADER.unpack_from(buffer)
+            if len(buffer) < RESPONSE_HEADER.size + length:
+                break
+            body = json.loads(buffer[RESPONSE_HEADER.size:RESPONSE_HEADER.size + length])
+            buffer = buffer[RESPONSE_HEADER.size + length:]
+            latency = trio.current_time() - sent_at.get(request_id, trio.current_time())
+            if status != 1:
+                sent_at.pop(request_id, None)
+            print(f"receiver: request {request_id} {STATUS_NAMES.get(status, status)} after {latency * 1000:.1f} ms: "
+                  f"{body}")
     print("receiver: connection closed")
     sys.exit()
 
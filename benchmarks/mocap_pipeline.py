@@ -0,0 +1,372 @@
+"""Throughput and latency benchmark of the mocap hot path.
+
+Frames of a synthetic mocap source are fed, in the wire format of the driver
+process, to ``LibmotioncaptureConnection.iter_frames()``; every decoded frame
+is passed to ``AiMotionMocapFrameHandler.notify_frame()``, which broadcasts
+the poses through a fake ``broadcast`` function that only records the
+packets. The benchmark reports the achieved frame rate, the CPU time spent
+per frame, the memory allocated per frame and the percentiles of the time
+from feeding a frame to the end of its broadcast.
+
+Run it in the environment of the server, e.g.::
+
+    poetry run python benchmarks/mocap_pipeline.py --bodies 50 --matching 0.2
+
+Use ``--rate 0`` (the default) to find the maximum sustainable frame rate, or
+the frame rate of the mocap system (e.g. ``--rate 120``) to measure latency
+under a realistic load. ``--json`` prints the results in a machine-readable
+form so that they can be compared across commits. ``--replay`` feeds the
+frames of a log recorded by the libmotioncapture extension instead of the
+synthetic ones, looping over the log if it is shorter than needed.
+"""
+
+import json
+import sys
+import tracemalloc
+
+from argparse import ArgumentParser
+from collections import deque
+from contextlib import aclosing
+from time import perf_counter, process_time, time
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+import trio
+
+from flockwave.server.ext.motion_capture import MotionCaptureFrame
+
+from skybrush_ext_aimotionlab.classifier import ObjectClassifier
+from skybrush_ext_aimotionlab.handler import AiMotionMocapFrameHandler
+from skybrush_ext_libmotioncapture.channel import LibmotioncaptureConnection
+from skybrush_ext_libmotioncapture.protocol import (
+    BinaryFrame,
+    encode_frame_message,
+    encode_names_message,
+    iter_poses,
+)
+from skybrush_ext_libmotioncapture.recording import MocapLog
+from skybrush_ext_libmotioncapture.synthetic import SyntheticMocapSource
+
+PORT = 6  # CRTP localization port
+CHANNEL = 1
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class FeedConnection:
+    """Stand-in for the connection to the driver process; reading from it
+    returns the chunks sent into the given memory channel.
+    """
+
+    def __init__(self, receiver: trio.MemoryReceiveChannel):
+        self._receiver = receiver
+
+    async def open(self) -> None:
+        pass
+
+    async def read(self) -> bytes:
+        try:
+            return await self._receiver.receive()
+        except (trio.EndOfChannel, trio.ClosedResourceError):
+            return b""
+
+    async def write(self, data: bytes) -> None:
+        pass
+
+    async def close(self) -> None:
+        await self._receiver.aclose()
+
+
+class RecordingBroadcast:
+    """Fake ``broadcast()`` API of the crazyflie extension that counts the
+    packets instead of sending them.
+    """
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.last: Optional[Tuple[Any, Any, bytes]] = None
+
+    def __call__(self, port: Any, channel: Any, packet: bytes) -> None:
+        self.packets += 1
+        self.bytes += len(packet)
+        self.last = port, channel, packet
+
+
+def create_frame() -> MotionCaptureFrame:
+    return MotionCaptureFrame(timestamp=time())
+
+
+def load_recorded_messages(path: str, count: int, format: str) -> List[bytes]:
+    """Encodes the given number of frames of a recorded log in the given wire
+    format, starting over at the end of the log if needed.
+    """
+    log = MocapLog(path)
+    if not len(log):
+        raise RuntimeError(f"no frames in {path}")
+
+    messages = []
+    for index in range(count):
+        timestamp, records = log.frame(index % len(log))
+        if format == "binary":
+            message = encode_frame_message(timestamp, 1, records)
+            if index == 0:
+                message = encode_names_message(1, log.names) + message
+        else:
+            items = list(iter_poses(BinaryFrame(timestamp, 1, records), log.names))
+            message = json.dumps({"items": items, "t": timestamp}).encode() + b"\n"
+        messages.append(message)
+    return messages
+
+
+def summarize(values: List[float], scale: float = 1.0) -> Dict[str, float]:
+    if not values:
+        return {}
+    array = np.asarray(values) * scale
+    result = {"mean": float(array.mean())}
+    for q in PERCENTILES:
+        result[f"p{q:g}"] = float(np.percentile(array, q))
+    result["max"] = float(array.max())
+    return result
+
+
+async def run_pipeline(
+    messages: List[bytes],
+    format: str,
+    rate: float,
+    warmup: int,
+    prefixes: List[str],
+    trace_allocations: bool = False,
+) -> Dict[str, Any]:
+    """Feeds the given encoded frames through the pipeline and measures it.
+    The first ``warmup`` frames (at least one) are processed but not measured.
+    """
+    broadcast = RecordingBroadcast()
+    handler = AiMotionMocapFrameHandler(
+        broadcast, PORT, CHANNEL, classifier=ObjectClassifier(prefixes)
+    )
+    sender, receiver = trio.open_memory_channel(0)
+    conn = LibmotioncaptureConnection(FeedConnection(receiver), format=format)
+    conn.frame_factory = create_frame
+
+    fed_at: Deque[float] = deque()
+    latencies: List[float] = []
+    handler_times: List[float] = []
+    allocations: List[int] = []
+    measured: Dict[str, Any] = {}
+
+    async def feed():
+        async with sender:
+            start = trio.current_time()
+            for index, message in enumerate(messages):
+                if rate > 0:
+                    await trio.sleep_until(start + index / rate)
+                fed_at.append(perf_counter())
+                await sender.send(message)
+
+    async def consume():
+        index = 0
+        total = len(messages)
+        baseline = 0
+        async with aclosing(conn.iter_frames()) as frames:
+            async for frame in frames:
+                started = perf_counter()
+                handler.notify_frame(frame)
+                finished = perf_counter()
+                latency = finished - fed_at.popleft()
+                index += 1
+
+                if index == warmup:
+                    measured["wall"] = perf_counter()
+                    measured["cpu"] = process_time()
+                    measured["packets"] = broadcast.packets
+                    if trace_allocations:
+                        tracemalloc.reset_peak()
+                        baseline = tracemalloc.get_traced_memory()[0]
+                        measured["memory"] = baseline
+                elif index > warmup:
+                    latencies.append(latency)
+                    handler_times.append(finished - started)
+                    if trace_allocations:
+                        # Peak memory above what was in use after the previous
+                        # frame: what receiving, decoding and handling a single
+                        # frame allocates at most
+                        current, peak = tracemalloc.get_traced_memory()
+                        allocations.append(peak - baseline)
+                        tracemalloc.reset_peak()
+                        baseline = current
+
+                if index == total:
+                    break
+
+        measured["wall"] = perf_counter() - measured["wall"]
+        measured["cpu"] = process_time() - measured["cpu"]
+        measured["packets"] = broadcast.packets - measured["packets"]
+        if trace_allocations:
+            retained = tracemalloc.get_traced_memory()[0] - measured["memory"]
+            measured["memory"] = retained
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(feed)
+        nursery.start_soon(consume)
+
+    frames = len(latencies)
+    result = {
+        "frames": frames,
+        "frames_per_second": frames / measured["wall"] if measured["wall"] else 0.0,
+        "cpu_per_frame_us": measured["cpu"] / frames * 1e6,
+        "packets_per_frame": measured["packets"] / frames,
+        "latency_ms": summarize(latencies, 1e3),
+        "handler_ms": summarize(handler_times, 1e3),
+    }
+    if trace_allocations:
+        result["allocated_bytes_per_frame"] = summarize(allocations)
+        result["retained_bytes_per_frame"] = measured["memory"] / frames
+    return result
+
+
+def format_stats(stats: Dict[str, float], unit: str, digits: int = 3) -> str:
+    return ", ".join(f"{key} {value:.{digits}f}{unit}" for key, value in stats.items())
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--bodies", type=int, default=20, help="number of rigid bodies per frame"
+    )
+    parser.add_argument(
+        "--matching",
+        type=float,
+        default=0.5,
+        help="share of the rigid bodies whose names match the object prefixes",
+    )
+    parser.add_argument(
+        "--prefixes",
+        nargs="+",
+        default=["bu", "hook", "test"],
+        help="object prefixes of the handler",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="frames per second to feed; 0 feeds them as fast as possible",
+    )
+    parser.add_argument(
+        "--frames", type=int, default=10000, help="number of measured frames"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=200, help="number of frames not measured"
+    )
+    parser.add_argument(
+        "--format", choices=("json", "binary"), default="binary", help="wire format"
+    )
+    parser.add_argument(
+        "--allocation-frames",
+        type=int,
+        default=2000,
+        help=(
+            "number of frames of a second pass that traces memory allocations; "
+            "0 skips it. Tracing slows everything down, so it is not done "
+            "in the timed pass"
+        ),
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--replay",
+        metavar="PATH",
+        help=(
+            "feed the frames of a log recorded by the libmotioncapture extension "
+            "instead of synthetic frames; --bodies and --matching are ignored"
+        ),
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="print the results in JSON format"
+    )
+    return parser
+
+
+def main() -> int:
+    args = create_parser().parse_args()
+    warmup = max(args.warmup, 1)
+
+    # Frames are encoded up front so that encoding them does not count
+    # towards the CPU time of the pipeline
+    count = warmup + args.frames
+    if args.replay:
+        messages = load_recorded_messages(args.replay, count, args.format)
+    else:
+        source = SyntheticMocapSource(
+            args.bodies, args.matching, args.prefixes, args.seed
+        )
+        messages = [
+            message
+            for _, message in source.iter_messages(
+                count, args.rate or 100.0, args.format
+            )
+        ]
+
+    results: Dict[str, Any] = {
+        "replay": args.replay,
+        "bodies": args.bodies,
+        "matching": args.matching,
+        "rate": args.rate,
+        "format": args.format,
+        "python": sys.version.split()[0],
+    }
+    results.update(
+        trio.run(
+            run_pipeline, messages, args.format, args.rate, warmup, args.prefixes
+        )
+    )
+
+    if args.allocation_frames > 0:
+        if not hasattr(tracemalloc, "reset_peak"):
+            print("Allocation tracing needs Python 3.9 or later", file=sys.stderr)
+        else:
+            tracemalloc.start()
+            try:
+                traced = trio.run(
+                    run_pipeline,
+                    messages[: warmup + args.allocation_frames],
+                    args.format,
+                    0,
+                    warmup,
+                    args.prefixes,
+                    True,
+                )
+            finally:
+                tracemalloc.stop()
+            results["allocated_bytes_per_frame"] = traced["allocated_bytes_per_frame"]
+            results["retained_bytes_per_frame"] = traced["retained_bytes_per_frame"]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+
+    workload = (
+        f"Frames of {args.replay}"
+        if args.replay
+        else f"{results['bodies']} bodies ({results['matching']:.0%} matching)"
+    )
+    print(
+        f"{workload}, {args.format} format, {'max' if not args.rate else args.rate} fps requested"
+    )
+    print(
+        f"Throughput: {results['frames_per_second']:.0f} frames/s over "
+        f"{results['frames']} frames, {results['packets_per_frame']:.1f} "
+        f"packets/frame"
+    )
+    print(f"CPU: {results['cpu_per_frame_us']:.1f} us/frame")
+    print(f"Latency: {format_stats(results['latency_ms'], 'ms')}")
+    print(f"Handler: {format_stats(results['handler_ms'], 'ms')}")
+    if "allocated_bytes_per_frame" in results:
+        print(
+            f"Allocated: {format_stats(results['allocated_bytes_per_frame'], 'B', 0)}"
+        )
+        print(f"Retained: {results['retained_bytes_per_frame']:.1f} B/frame")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
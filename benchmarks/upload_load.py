@@ -0,0 +1,433 @@
+"""Load test of trajectory uploads against simulated Crazyflies.
+
+Starts the aimotionlab extension with its real TCP server on a local port and
+a fleet of simulated drones (see ``skybrush_ext_aimotionlab.simulation``)
+in its object registry, then replays a workload of takeoff, hover, trajectory
+and land commands through the TCP command protocol, with every command sent
+to every drone at the same time. This is repeated for each requested fleet
+size. For each step of the workload, the test reports:
+
+- the latency of the commands, from sending them to their final response,
+- the switch latency of trajectory commands, from sending them until the
+  drone starts the new trajectory,
+- the throughput: commands per second and bytes written to the memory of the
+  drones per second.
+
+Radio traffic is simulated with a per-packet latency and a bandwidth per
+Crazyradio, and drones are spread over the radios. Run it from anywhere in the
+environment of the server, e.g.::
+
+    poetry run python benchmarks/upload_load.py --drones 1,10,50
+"""
+
+import json
+import logging
+import os
+import sys
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from itertools import count
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import trio
+
+from skybrush_ext_aimotionlab.extension import ext_aimotionlab
+from skybrush_ext_aimotionlab.protocol import (
+    RESPONSE_HEADER,
+    STATUS_ACCEPTED,
+    STATUS_OK,
+    encode_command,
+)
+from skybrush_ext_aimotionlab.simulation import RadioModel, SimulatedCrazyflieUAV
+from skybrush_ext_aimotionlab.trajectory_cache import TrajectoryCache
+from skybrush_ext_aimotionlab.trajectory_format import encode_binary_trajectory
+
+ROOT = Path(__file__).resolve().parent.parent
+
+MEMORY_PARTITIONS = [
+    {"ID": 0, "size": 100, "start": 1},
+    {"ID": 1, "size": 50, "start": 101},
+    {"ID": 2, "size": 1950, "start": 151},
+    {"ID": 3, "size": 1950, "start": 2141},
+]
+"""Trajectory memory layout, same as in skybrushd.jsonc."""
+
+ROUND_OFFSET = 0.005
+"""Number of meters by which the trajectories of consecutive rounds are
+shifted so that each round is a new trajectory; must be well above the 1 mm
+resolution of the compressed trajectory encoding.
+"""
+
+COMMANDS = {
+    # step name -> (command, argument)
+    "takeoff": (b"takeoff", b"0.5"),
+    "hover": (b"hover", b""),
+    "traj": (b"traj", b"relative"),
+    "land": (b"land", b""),
+}
+
+
+class Registry:
+    """Object registry of the fake server application, with the simulated
+    drones in it.
+    """
+
+    def __init__(self, uavs: List[SimulatedCrazyflieUAV]):
+        self._uavs = {uav.id: uav for uav in uavs}
+        self.added = SimpleNamespace(connected_to=_ignore_signal)
+
+    def ids_by_type(self, cls: Any) -> List[str]:
+        return list(self._uavs)
+
+    def find_by_id(self, id: str) -> SimulatedCrazyflieUAV:
+        return self._uavs[id]
+
+
+@contextmanager
+def _ignore_signal(*args, **kwargs):
+    yield
+
+
+class App:
+    """The parts of the Skybrush server application that the extension uses."""
+
+    def __init__(self, registry: Registry):
+        self.object_registry = registry
+
+    def import_api(self, name: str) -> Any:
+        if name == "signals":
+            return SimpleNamespace(use=_ignore_signal)
+        elif name == "crazyflie":
+            return SimpleNamespace(broadcast=lambda port, channel, packet: None)
+        raise KeyError(name)
+
+
+class Client:
+    """TCP client that sends commands with request IDs and waits for their
+    final responses.
+    """
+
+    def __init__(self, stream: trio.SocketStream):
+        self._stream = stream
+        self._request_ids = count(1)
+        self._pending: Dict[int, Tuple[trio.Event, List[Any]]] = {}
+        self._send_lock = trio.Lock()
+
+    async def receive(self) -> None:
+        buffer = b""
+        async for data in self._stream:
+            buffer += data
+            while len(buffer) >= RESPONSE_HEADER.size:
+                _, _, request_id, status, length = RESPONSE_HEADER.unpack_from(buffer)
+                end = RESPONSE_HEADER.size + length
+                if len(buffer) < end:
+                    break
+                body = json.loads(buffer[RESPONSE_HEADER.size : end])
+                buffer = buffer[end:]
+                if status != STATUS_ACCEPTED and request_id in self._pending:
+                    event, result = self._pending.pop(request_id)
+                    result.extend((status, body, trio.current_time()))
+                    event.set()
+
+    async def request(
+        self, uav_id: int, command: bytes, argument: bytes = b"", payload: bytes = b""
+    ) -> Tuple[int, Dict[str, Any], float, float]:
+        """Sends a command and returns its status, the body of its response,
+        the time when it was sent and the time when it was answered.
+        """
+        request_id = next(self._request_ids)
+        event, result = trio.Event(), []
+        self._pending[request_id] = event, result
+        async with self._send_lock:
+            sent_at = trio.current_time()
+            await self._stream.send_all(
+                encode_command(uav_id, command, argument, payload, request_id)
+            )
+        await event.wait()
+        status, body, answered_at = result
+        return status, body, sent_at, answered_at
+
+
+def load_payloads() -> List[Dict[str, Any]]:
+    payloads = []
+    for name in ("cw", "ccw"):
+        with open(ROOT / f"{name}_traj.json", "rb") as fp:
+            payloads.append(json.load(fp))
+    return payloads
+
+
+def encode_payload(
+    data: Dict[str, Any], round: int, unique: bool, binary: bool
+) -> bytes:
+    if unique:
+        # Shift the trajectory a little so that every round is a different
+        # trajectory, and has to be encoded and uploaded again
+        offset = round * ROUND_OFFSET
+        data = dict(
+            data,
+            points=[
+                [
+                    t,
+                    [position[0] + offset, *position[1:]],
+                    [[x + offset, y, z] for x, y, z in controls],
+                ]
+                for t, position, controls in data["points"]
+            ],
+        )
+    if binary:
+        return encode_binary_trajectory(data)
+    return json.dumps(data).encode("utf-8")
+
+
+def parse_workload(spec: str) -> List[str]:
+    # e.g. "takeoff,hover,traj*10,land"
+    steps = []
+    for item in spec.split(","):
+        name, _, repeat = item.strip().partition("*")
+        if name not in COMMANDS:
+            raise ValueError(f"unknown workload step: {name!r}")
+        steps.extend([name] * (int(repeat) if repeat else 1))
+    return steps
+
+
+def summarize(values: List[float]) -> str:
+    if not values:
+        return "-"
+    array = np.asarray(values) * 1000
+    return (
+        f"{np.percentile(array, 50):.1f}/{np.percentile(array, 95):.1f}/"
+        f"{array.max():.1f}ms"
+    )
+
+
+async def run_fleet(size: int, args) -> List[Dict[str, Any]]:
+    """Starts the extension with the given number of simulated drones, runs
+    the workload and returns the measurements of each step.
+    """
+    radios = [
+        RadioModel(f"radio://{index}", args.latency / 1000, args.bandwidth)
+        for index in range((size + args.drones_per_radio - 1) // args.drones_per_radio)
+    ]
+    uavs = []
+    for index in range(size):
+        radio = radios[index // args.drones_per_radio]
+        number = index + 1
+        uavs.append(
+            SimulatedCrazyflieUAV(
+                f"{number:02d}", f"{radio.name}/80/2M/E7E7E7E7{number:02X}", radio
+            )
+        )
+
+    extension = ext_aimotionlab()
+    app = App(Registry(uavs))
+    extension.app = app
+    extension.log = logging.getLogger("ext_aimotionlab")
+    configuration = {
+        "memory_partitions": MEMORY_PARTITIONS,
+        "tcp_port": args.port,
+        "max_commands_per_radio": args.max_commands_per_radio,
+        "hover_provisioning_interval": 0,
+    }
+
+    payloads = load_payloads()
+    steps = parse_workload(args.workload)
+    results = []
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(extension.run, app, configuration, extension.log)
+
+        # The extension waits a second before it starts listening
+        with trio.fail_after(10):
+            while True:
+                try:
+                    stream = await trio.open_tcp_stream("127.0.0.1", args.port)
+                    break
+                except OSError:
+                    await trio.sleep(0.1)
+
+        client = Client(stream)
+        nursery.start_soon(client.receive)
+
+        async def send(
+            uav: SimulatedCrazyflieUAV,
+            command: bytes,
+            argument: bytes,
+            payload: bytes,
+            responses: Dict[str, Tuple[int, Dict[str, Any], float, float]],
+        ) -> None:
+            responses[uav.id] = await client.request(
+                int(uav.id), command, argument, payload
+            )
+
+        traj_round = 0
+        encoder = TrajectoryCache()
+        encoded_rounds = set()
+        for step in steps:
+            command, argument = COMMANDS[step]
+            payload = b""
+            if step == "traj":
+                payload = encode_payload(
+                    payloads[traj_round % 2], traj_round, not args.repeat, args.binary
+                )
+                if not args.repeat:
+                    # Otherwise we would be measuring the cached path that
+                    # --repeat is for
+                    encoded = encoder.encode(payload).data
+                    assert encoded not in encoded_rounds, (
+                        f"round {traj_round} encodes to the same trajectory "
+                        f"as an earlier round"
+                    )
+                    encoded_rounds.add(encoded)
+                traj_round += 1
+
+            written_before = sum(
+                uav._get_crazyflie().trajectory_memory.bytes_written for uav in uavs
+            )
+            started = trio.current_time()
+            responses: Dict[str, Tuple[int, Dict[str, Any], float, float]] = {}
+            async with trio.open_nursery() as step_nursery:
+                for uav in uavs:
+                    step_nursery.start_soon(
+                        send, uav, command, argument, payload, responses
+                    )
+            elapsed = trio.current_time() - started
+
+            latencies, switches, failures = [], [], 0
+            for uav in uavs:
+                status, body, sent_at, answered_at = responses[uav.id]
+                latencies.append(answered_at - sent_at)
+                if status != STATUS_OK:
+                    failures += 1
+                    if args.verbose:
+                        print(f"  {uav.id}: {body}", file=sys.stderr)
+                if step == "traj":
+                    # The drone may switch to hover first; the switch is done
+                    # when the new trajectory is started, i.e. the last start
+                    starts = [
+                        event[0]
+                        for event in uav._get_crazyflie().events
+                        if event[1] == "start" and sent_at <= event[0] <= answered_at
+                    ]
+                    if starts:
+                        switches.append(starts[-1] - sent_at)
+
+            written_after = sum(
+                uav._get_crazyflie().trajectory_memory.bytes_written for uav in uavs
+            )
+            written = written_after - written_before
+            results.append(
+                {
+                    "drones": size,
+                    "step": step,
+                    "failed": failures,
+                    "elapsed": elapsed,
+                    "latencies": latencies,
+                    "switches": switches,
+                    "bytes_written": written,
+                    "payload_size": len(payload),
+                }
+            )
+
+        nursery.cancel_scope.cancel()
+
+    # Closed only once the task receiving from it is gone
+    await stream.aclose()
+    return results
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--drones",
+        default="1,5,10,25,50",
+        help="comma-separated list of fleet sizes to test",
+    )
+    parser.add_argument(
+        "--workload",
+        default="takeoff,hover,traj*10,land",
+        help=(
+            "comma-separated steps of the workload; 'traj*10' repeats a step. "
+            f"Valid steps: {', '.join(COMMANDS)}"
+        ),
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=1.0,
+        help="round trip time of a radio packet, in milliseconds",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=250000,
+        help="bandwidth of a Crazyradio in bytes per second; 0 means unlimited",
+    )
+    parser.add_argument(
+        "--drones-per-radio", type=int, default=8, help="drones sharing a radio"
+    )
+    parser.add_argument(
+        "--max-commands-per-radio",
+        type=int,
+        default=4,
+        help="max_commands_per_radio setting of the extension",
+    )
+    parser.add_argument(
+        "--binary", action="store_true", help="send trajectories in binary format"
+    )
+    parser.add_argument(
+        "--repeat",
+        action="store_true",
+        help=(
+            "alternate between the same two trajectories instead of sending a "
+            "new one every time, to measure the cached path"
+        ),
+    )
+    parser.add_argument(
+        "--port", type=int, default=6100, help="TCP port of the extension"
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="print the results in JSON format"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="show the log of the extension"
+    )
+    return parser
+
+
+def main() -> int:
+    args = create_parser().parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    # The extension reads the hover trajectory from the working directory
+    os.chdir(ROOT)
+
+    results = []
+    for size in (int(value) for value in args.drones.split(",")):
+        results.extend(trio.run(run_fleet, size, args))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+
+    print(
+        f"{'drones':>6} {'step':<8} {'failed':>6} {'latency p50/p95/max':>22} "
+        f"{'switch p50/p95/max':>22} {'cmd/s':>8} {'kB/s':>8}"
+    )
+    for result in results:
+        elapsed = result["elapsed"]
+        print(
+            f"{result['drones']:>6} {result['step']:<8} {result['failed']:>6} "
+            f"{summarize(result['latencies']):>22} "
+            f"{summarize(result['switches']):>22} "
+            f"{result['drones'] / elapsed if elapsed else 0:>8.1f} "
+            f"{result['bytes_written'] / elapsed / 1000 if elapsed else 0:>8.2f}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
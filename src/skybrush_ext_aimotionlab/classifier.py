@@ -0,0 +1,57 @@
+import re
+from typing import Dict, Iterable, List, Mapping, Optional, Pattern, Tuple
+
+__all__ = ("ObjectClassifier", "DEFAULT_PREFIXES")
+
+DEFAULT_PREFIXES = ("bu", "hook", "test")
+# Prefixes which we classify as non-UAV when nothing is configured.
+
+MAX_CACHE_SIZE = 4096
+# Upper bound on the number of names remembered by the classifier. Rigid body names rarely change, so this is only
+# reached when something is generating random names; in that case we simply start over.
+
+
+class ObjectClassifier:
+    """Decides which mocap objects are non-UAV objects whose pose is broadcast to the drones, and which numeric ID and
+    class they get. The result is cached per name, so the rules are only evaluated when a new name shows up.
+    """
+
+    def __init__(self, prefixes: Iterable[str] = DEFAULT_PREFIXES, patterns: Optional[Mapping[str, str]] = None):
+        # prefixes: names consisting of one of these prefixes and an integer are matched, the class is the prefix.
+        # patterns: class name -> regular expression. The expression must match the whole name and must have a group
+        # named 'id' (or a single group) that captures the numeric ID.
+        self._rules: List[Tuple[Optional[str], Pattern]] = []
+        prefixes = sorted(prefixes, key=len, reverse=True)  # longest prefix wins if several match
+        if prefixes:
+            alternatives = "|".join(re.escape(prefix) for prefix in prefixes)
+            self._rules.append((None, re.compile(f"(?P<cls>{alternatives})(?P<id>\\d+)")))
+        for cls, pattern in (patterns or {}).items():
+            compiled = re.compile(pattern)
+            if "id" not in compiled.groupindex and compiled.groups != 1:
+                raise ValueError(f"Pattern for object class {cls!r} needs an 'id' group: {pattern!r}")
+            self._rules.append((cls, compiled))
+        self._cache: Dict[str, Optional[Tuple[int, str]]] = {}
+
+    @classmethod
+    def from_configuration(cls, configuration) -> "ObjectClassifier":
+        return cls(configuration.get("object_prefixes", DEFAULT_PREFIXES), configuration.get("object_patterns"))
+
+    def classify(self, name: str) -> Optional[Tuple[int, str]]:
+        # Returns (numeric ID, class) of the object with the given name, or None if it is not a broadcast object.
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        if len(self._cache) >= MAX_CACHE_SIZE:
+            self._cache.clear()
+        result = self._cache[name] = self._classify(name)
+        return result
+
+    def _classify(self, name: str) -> Optional[Tuple[int, str]]:
+        for cls, pattern in self._rules:
+            match = pattern.fullmatch(name)
+            if match is None:
+                continue
+            numeric_id = int(match.group("id") if "id" in pattern.groupindex else match.group(1))
+            return numeric_id, cls if cls is not None else match.group("cls")
+        return None
@@ -3,41 +3,72 @@ from trio import sleep
 from flockwave.server.app import SkybrushServer
 from flockwave.server.ext.base import Extension
 from flockwave.server.ext.crazyflie.driver import CrazyflieUAV
-from flockwave.server.ext.crazyflie.trajectory import encode_trajectory, TrajectoryEncoding
 from aiocflib.crazyflie.high_level_commander import TrajectoryType
-from contextlib import ExitStack
+from contextlib import AsyncExitStack
 from functools import partial
 from flockwave.server.ext.motion_capture import MotionCaptureFrame
-from trio import sleep_forever
 from .handler import AiMotionMocapFrameHandler
-from typing import Dict, Callable, Union, Tuple, Any, List
-from flockwave.server.show.trajectory import TrajectorySpecification
-from aiocflib.crazyflie.mem import write_with_checksum
+from .classifier import ObjectClassifier
+from .sharding import BroadcastShard, create_broadcast_shards
+from .predictor import PosePredictor
+from .trajectory_cache import EncodedTrajectory, TrajectoryCache
+from .slots import TrajectorySlots
+from .library import TrajectoryLibrary
+from .shadow import MemoryShadow, write_with_shadow
+from .protocol import Command, ProtocolError
+from .session import CommandSession
+from skybrush_ext_libmotioncapture.latency import get_timeline
+from typing import Dict, Callable, Union, Tuple, Any, List, Awaitable, Optional
+from weakref import WeakValueDictionary, ref
 from aiocflib.crtp.crtpstack import MemoryType
-from aiocflib.utils.checksum import crc32
-from aiocflib.crazyflie.log import LogSession
-import json
 
 __all__ = ("ext_aimotionlab", )
 
 TCP_PORT = 6000
+# Provisioning the hover trajectory on a drone that keeps failing is retried with exponential backoff, up to this many
+# seconds apart, until the drone reconnects
+MAX_HOVER_RETRY_DELAY = 60.0
+
+CommandResult = Tuple[bool, bytes]
+# What a command handler returns for a single drone: whether the command was dispatched, and a message for the client.
 
 
 class ext_aimotionlab(Extension):
     """Extension that broadcasts the pose of non-UAV objects to the Crazyflie drones."""
-    _hover_traj_defined: Dict[str, bool]
     def __init__(self):
         super().__init__()
-        self._active_traj_ID = 2
-        # self._hover_traj_defined = False
-        self._stream_data = b''
-        self._traj = b''
-        self._transmission_active = False
+        # A/B trajectory slot state of each drone (which slot is flying, what is prepared in the other one)
+        self._traj_slots: Dict[str, TrajectorySlots] = {}
+        # Trajectories stored on each drone for later use, only if a 'trajectory_library' memory region is configured
+        self._library_config = None
+        self._traj_libraries: Dict[str, TrajectoryLibrary] = {}
+        # What we know about the trajectory memory of each drone, so that uploads only write what actually changed
+        self._memory_shadows: Dict[str, MemoryShadow] = {}
+        # For each drone, the Crazyflie connection on which the hover trajectory was defined. Kept across TCP
+        # connections; a reconnected drone gets a new connection object and therefore needs hover again. Weak, so that
+        # the connection objects of disconnected drones are not kept alive.
+        self._hover_traj_defined: "WeakValueDictionary[str, Any]" = WeakValueDictionary()
+        # Commands (and background tasks) touching the same drone are serialized by its lock, since several TCP
+        # sessions may send commands to it at the same time. Take the radio limiter first, then the drone lock.
+        self._drone_locks: Dict[str, trio.Lock] = {}
+        # Seconds between checks for drones that appeared or reconnected without hover; 0 turns provisioning off.
+        self._hover_provisioning_interval = 1.0
         self._load_from_file = False
         self._save_to_local_file = False
         self._memory_partitions = None
-        self._block_transmission = False
         self._allow_traj_outside_show = True
+        # Limits how many commands may be in flight at the same time on a single Crazyradio, see _get_radio_limiter
+        self._max_commands_per_radio = 4
+        self._radio_limiters: Dict[str, trio.CapacityLimiter] = {}
+        # Encoded trajectories, shared by all drones and TCP connections, so that the same payload is encoded only once
+        self._trajectory_cache = TrajectoryCache()
+        # Trajectories that don't fit in their partition are simplified, moving them by at most this much (meters)
+        self._max_simplification_error = 0.05
+        # Limits the number of worker threads preparing trajectories at the same time
+        self._encoding_limiter = trio.CapacityLimiter(2)
+        # Commands of a single TCP connection that may be processed at the same time; reading from the connection
+        # stops while there are this many
+        self._max_pipelined_commands = 32
 
     def get_traj_type(self, traj_type: bytes) -> Tuple[bool, Union[bool, None]]:
         # trajectories can either be relative or absolute. This is determined by a string/bytes, but only these two
@@ -52,69 +83,38 @@ class ext_aimotionlab(Extension):
         else:
             return False, None
 
-    def parse(self,
-              raw_data: bytes,
-              cmd_dict: Dict[bytes, Tuple[Callable[[Extension, CrazyflieUAV, trio.SocketStream, bytes], None], Tuple[bool, Any], bool]]):
-        # Function to determine the command and its argument from the TCP port. Standard command structure is like this:
-        # b'CMDSTART_ID_command_argument_payload_EOF'. ID refers to the drone that the command must go out to. 0 refers
-        # to all drones. The command should be in the command dictionary, which contains data about each command:
-        # whether it requires an argument or not, and what kind of argument it requires. Also whether it takes a
-        # payload such as the json file containing the trajectory.
-        data = raw_data.strip()
-        if not data:
-            return None, None
-        data = data.split(b'_')
-        if data[0] != b'CMDSTART':
-            return b'NO_CMDSTART', None
-        if len(data[1].decode("utf-8")) == 1:  # this means we need to add a leading 0 unfortunately
-            ID = "0" + data[1].decode("utf-8")
-        else:
-            ID = data[1].decode("utf-8")
-        command = data[2]
-        if command not in cmd_dict:
-            return b'WRONG_CMD', None
-        if cmd_dict[command][1][0]: # This is a boolean signifying whether we expect an argument
-            argument = data[3]
-        else:
-            argument = None
-        if cmd_dict[command][2]: # This is a boolean signifying that we are expecting a payload
-            self.log.info("Payload expected.")
-            # payload = data[4]
-            # self._traj = payload
-            # #BUG: WHEN THE WHOLE MESSAGE GETS TRANSMITTED IN ONE, WE GET NO EOF AND UPLOAD DOESNT FINISH
-        return ID, command, argument
-
-    async def takeoff(self, uav: CrazyflieUAV, server_stream: trio.SocketStream, arg):
+    async def takeoff(self, uav: CrazyflieUAV, arg, payload: Optional[bytes]) -> CommandResult:
         try:
             arg = float(arg)
-            if arg < 0.1 or arg > 1.5:
-                arg = 0.5
-                self.log.warning("Takeoff height was out of allowed bounds, taking off to 0.5m")
-            if uav._airborne:
-                self.log.warning(f"Drone {uav.id} is already airborne, takeoff command wasn't dispatched.")
-                await server_stream.send_all(b"Drone is already airborne, takeoff command wasn't dispatched.")
-            else:
-                await uav.takeoff(altitude=arg)
-                await server_stream.send_all(b'Takeoff command dispatched to drone.')
-                self.log.info(f"Takeoff command dispatched to drone {uav.id}.")
         except ValueError:
             self.log.warning("Takeoff argument is not a float.")
+            return False, b'Takeoff argument is not a float.'
+        if arg < 0.1 or arg > 1.5:
+            arg = 0.5
+            self.log.warning("Takeoff height was out of allowed bounds, taking off to 0.5m")
+        if uav._airborne:
+            self.log.warning(f"Drone {uav.id} is already airborne, takeoff command wasn't dispatched.")
+            return False, b"Drone is already airborne, takeoff command wasn't dispatched."
+        await uav.takeoff(altitude=arg)
+        self.log.info(f"Takeoff command dispatched to drone {uav.id}.")
+        return True, b'Takeoff command dispatched to drone.'
 
-    async def land(self, uav: CrazyflieUAV, server_stream: trio.SocketStream, arg):
+    async def land(self, uav: CrazyflieUAV, arg, payload: Optional[bytes]) -> CommandResult:
         if uav._airborne:
             await uav.land()
-            await server_stream.send_all(b'Land command dispatched to drone.')
             self.log.info(f"Land command dispatched to drone {uav.id}.")
+            return True, b'Land command dispatched to drone.'
         else:
             self.log.warning(f"Drone {uav.id} is already on the ground, land command wasn't dispatched.")
-            await server_stream.send_all(b"Drone is already on the ground, land command wasn't dispatched.")
+            return False, b"Drone is already on the ground, land command wasn't dispatched."
 
-    async def start_traj(self, uav: CrazyflieUAV, server_stream: trio.SocketStream, arg: str):
+    async def start_traj(self, uav: CrazyflieUAV, arg: str, payload: Optional[bytes]) -> CommandResult:
         cf = uav._get_crazyflie() #access to protected member
         await cf.high_level_commander.start_trajectory(1, time_scale=1, relative=False, reversed=False)
-        await server_stream.send_all(b'Trajectory start command received.')
+        return True, b'Trajectory start command received.'
 
-    async def write_safely(self, traj_id: int, handler, data) -> Tuple[bool, Union[int, None]]:
+    async def write_safely(self, traj_id: int, handler, trajectory: EncodedTrajectory,
+                           shadow: MemoryShadow) -> Tuple[bool, Union[int, None]]:
         # Function to upload trajectories to the drone while keeping each trajectory confined to its allotted partition.
         # Check the configuration: For a particular trajectory ID, what is the starting address of the allowed
         # partition, and what's its size? Return with info about whether the trajectory fits into the partition, and the
@@ -122,128 +122,280 @@ class ext_aimotionlab(Extension):
         # data written to the partition will begin with the checksum, and only then does the trajectory data begin.
         start_addr = self._memory_partitions[traj_id]["start"]
         allowed_size = self._memory_partitions[traj_id]["size"]
-        checksum_length = len(crc32(data))
+        data = trajectory.data
+        checksum_length = len(trajectory.checksum)
         self.log.info(f"Checksum length: {checksum_length}, data length: {len(data)}, allowed size: {allowed_size}")
         if len(data)+checksum_length <= allowed_size:
-            checksum_length = await write_with_checksum(handler, start_addr, data, only_if_changed=True)
+            checksum_length = await write_with_shadow(handler, shadow, start_addr, data, trajectory.checksum)
             # self.log.info(f"Wrote trajectory to address {start_addr}")
+            self.log.debug(f"Trajectory memory writes so far: {shadow.bytes_written} bytes written, "
+                           f"{shadow.bytes_skipped} bytes skipped")
             return True, start_addr+checksum_length
         else:
             return False, None
 
+    def is_hover_defined(self, uav: CrazyflieUAV) -> bool:
+        cf = getattr(uav, "_crazyflie", None)  # access to protected member
+        return cf is not None and self._hover_traj_defined.get(uav.id) is cf
+
     async def upload_hover(self, uav: CrazyflieUAV):
-        trajectory_data = None
-        # Hover trajectory is always the same (0.0 relative setpoint)
-        with open('./hover.json') as json_file:
-            trajectory_data = json.load(json_file)
+        # Called with the drone lock held. The provisioning task and a command may both get here for the same drone,
+        # one after the other; upload only once.
+        if self.is_hover_defined(uav):
+            return
+        # Hover trajectory is always the same (0.0 relative setpoint), so it is only read and encoded once
+        trajectory = await self._run_in_worker(self._trajectory_cache.encode_file, './hover.json')
         cf = uav._get_crazyflie() #access to protected member
         try:
             trajectory_memory = await cf.mem.find(MemoryType.TRAJECTORY)
         except ValueError:
             raise RuntimeError("Trajectories are not supported on this drone") from None
-        trajectory = TrajectorySpecification(trajectory_data)
-        data = encode_trajectory(trajectory, encoding=TrajectoryEncoding.COMPRESSED)
-        success, addr = await self.write_safely(1, trajectory_memory, data)
+        success, addr = await self.write_safely(1, trajectory_memory, trajectory, self.get_shadow(uav))
         if success:
             await cf.high_level_commander.define_trajectory(1, addr=addr, type=TrajectoryType.COMPRESSED)
             self.log.info(f"Defined fallback hover trajectory for drone {uav.id}!")
         else:
-            self.log.warning(f"Trajectory is too long.")
-        self._hover_traj_defined[uav.id] = True
+            self.log.warning("Trajectory is too long.")
+        self._hover_traj_defined[uav.id] = cf
+
+    def get_shadow(self, uav: CrazyflieUAV) -> MemoryShadow:
+        # Shadow of the trajectory memory of the drone, started over when the drone reconnected (or rebooted).
+        cf = uav._get_crazyflie()  # access to protected member
+        shadow = self._memory_shadows.get(uav.id)
+        if shadow is None or shadow.connection is not cf:
+            shadow = self._memory_shadows[uav.id] = MemoryShadow(cf)
+        return shadow
+
+    def get_slots(self, uav: CrazyflieUAV) -> TrajectorySlots:
+        # A/B slot state of the drone, started over when the drone reconnected (its trajectories are gone then).
+        cf = uav._get_crazyflie()  # access to protected member
+        slots = self._traj_slots.get(uav.id)
+        if slots is None or slots.connection is not cf:
+            slots = self._traj_slots[uav.id] = TrajectorySlots(cf)
+        return slots
+
+    def get_library(self, uav: CrazyflieUAV) -> Optional[TrajectoryLibrary]:
+        # Trajectory library of the drone, or None if not configured. Started over when the drone reconnected.
+        if not self._library_config:
+            return None
+        cf = uav._get_crazyflie()  # access to protected member
+        library = self._traj_libraries.get(uav.id)
+        if library is None or library.connection is not cf:
+            library = self._traj_libraries[uav.id] = TrajectoryLibrary.from_configuration(cf, self._library_config)
+        return library
 
-    async def handle_new_traj(self, uav: CrazyflieUAV, server_stream: trio.SocketStream, arg: bytes):
+    async def _run_in_worker(self, func, *args):
+        # Parsing, encoding and simplifying trajectories is CPU-bound; it runs in worker threads so that the event loop
+        # keeps forwarding mocap frames in the meantime. Radio I/O stays on the event loop.
+        return await trio.to_thread.run_sync(partial(func, *args), limiter=self._encoding_limiter)
+
+    async def _get_encoded_traj(self, payload: bytes, max_size: int) -> Optional[EncodedTrajectory]:
+        # Returns the encoded trajectory, simplified if needed to fit in max_size bytes (with its checksum), or None if
+        # it doesn't fit even so.
         # Writing to a separate file isn't needed, but helps when debugging.
         if self._save_to_local_file:
             with open('./trajectory.json', 'wb') as f:
-                f.write(self._traj)
+                f.write(payload)
                 self.log.warning("Trajectory saved to local json file for backup.")
+        # We may want to load the trajectory from the backup file:
+        if self._load_from_file and self._save_to_local_file:
+            trajectory = await self._run_in_worker(self._trajectory_cache.encode_file, './trajectory.json')
+            self.log.warning("Trajectory read from local json file.")
+        else:
+            trajectory = await self._run_in_worker(self._trajectory_cache.fit, payload, max_size,
+                                                   self._max_simplification_error)
+        self.log.debug(f"Trajectory cache: {self._trajectory_cache.format_stats()}")
+        if trajectory is not None and trajectory.error > 0:
+            self.log.info(f"Trajectory was simplified to fit in {max_size} bytes, "
+                          f"largest deviation is {trajectory.error * 1000:.1f} mm.")
+        return trajectory
+
+    @staticmethod
+    def _describe_fit(trajectory: EncodedTrajectory) -> bytes:
+        if trajectory.error > 0:
+            return f" Simplified to fit, largest deviation is {trajectory.error * 1000:.1f} mm.".encode()
+        return b''
+
+    async def prepare_traj(self, uav: CrazyflieUAV, payload: bytes, is_relative: bool) -> CommandResult:
+        # Uploads the received trajectory into the inactive slot of the drone and defines it there, without starting
+        # it. The trajectory in the active slot keeps flying in the meantime.
+        cf = uav._get_crazyflie()  # access to protected member
+        slots = self.get_slots(uav)
+        trajectory = await self._get_encoded_traj(payload, self._memory_partitions[slots.inactive]["size"])
+        if trajectory is None:
+            self.log.warning("Trajectory is too long.")
+            return False, b'Trajectory is too long.'
+        # If the drone has this very trajectory in its library, there is nothing to upload.
+        library = self.get_library(uav)
+        entry = library.get(trajectory.key) if library is not None else None
+        if entry is not None:
+            slots.begin_prepare()
+            slots.finish_prepare(entry.traj_id, is_relative)
+            library.touch(entry)
+            self.log.info(f"Trajectory for drone {uav.id} is already stored on ID {entry.traj_id}.")
+            return True, b'Trajectory prepared from library.'
+        try:
+            trajectory_memory = await cf.mem.find(MemoryType.TRAJECTORY)
+        except ValueError:
+            raise RuntimeError("Trajectories are not supported on this drone") from None
+        upcoming_traj_ID = slots.begin_prepare()
+        # Try to write the data (at this point we don't know whether it's too long or not, write_safely will tell)
+        write_success, addr = await self.write_safely(upcoming_traj_ID, trajectory_memory, trajectory,
+                                                      self.get_shadow(uav))
+        if not write_success:
+            self.log.warning("Trajectory is too long.")
+            return False, b'Trajectory is too long.'
+        await cf.high_level_commander.define_trajectory(upcoming_traj_ID, addr=addr, type=TrajectoryType.COMPRESSED)
+        slots.finish_prepare(upcoming_traj_ID, is_relative)
+        self.log.info(
+            f"Defined trajectory on ID {upcoming_traj_ID} for drone {uav.id}(currently active ID is {slots.active}).")
+        return True, b'Trajectory prepared.' + self._describe_fit(trajectory)
+
+    async def commit_traj(self, uav: CrazyflieUAV) -> CommandResult:
+        # Starts the trajectory prepared by prepare_traj(): a single radio command.
+        cf = uav._get_crazyflie()  # access to protected member
+        slots = self.get_slots(uav)
+        if slots.prepared is None:
+            self.log.warning(f"No prepared trajectory on drone {uav.id}, commit command wasn't dispatched.")
+            return False, b"No prepared trajectory, commit command wasn't dispatched."
+        traj_ID, is_relative = slots.prepared
+        await cf.high_level_commander.start_trajectory(traj_ID, time_scale=1, relative=is_relative, reversed=False)
+        # We are now playing the trajectory with the new ID: adjust the active ID accordingly.
+        slots.commit()
+        self.log.info(f"Started trajectory on ID {traj_ID} for drone {uav.id}")
+        return True, b'Trajectory started.'
+
+    async def store_traj(self, uav: CrazyflieUAV, payload: bytes, name: Optional[str]) -> CommandResult:
+        # Stores the received trajectory in the library of the drone (unless it's already there), and optionally names
+        # it. It can then be started with the play command without uploading it again.
+        library = self.get_library(uav)
+        if library is None:
+            return False, b'Trajectory library is not configured.'
+        cf = uav._get_crazyflie()  # access to protected member
+        trajectory = await self._get_encoded_traj(payload, library.size)
+        if trajectory is None:
+            self.log.warning(f"Trajectory doesn't fit in the library of drone {uav.id}.")
+            return False, b"Trajectory doesn't fit in the library."
+        entry = library.get(trajectory.key)
+        if entry is None:
+            slots = self.get_slots(uav)
+            keep = [traj_id for traj_id in (slots.playing, slots.prepared and slots.prepared[0]) if traj_id]
+            entry = library.allocate(trajectory.key, len(trajectory.checksum) + len(trajectory.data), keep=keep)
+            if entry is None:
+                self.log.warning(f"Trajectory doesn't fit in the library of drone {uav.id}.")
+                return False, b"Trajectory doesn't fit in the library."
+            try:
+                try:
+                    trajectory_memory = await cf.mem.find(MemoryType.TRAJECTORY)
+                except ValueError:
+                    raise RuntimeError("Trajectories are not supported on this drone") from None
+                checksum_length = await write_with_shadow(trajectory_memory, self.get_shadow(uav), entry.start,
+                                                          trajectory.data, trajectory.checksum)
+                await cf.high_level_commander.define_trajectory(entry.traj_id, addr=entry.start + checksum_length,
+                                                                type=TrajectoryType.COMPRESSED)
+            except BaseException:
+                library.remove(entry.key)
+                raise
+            self.log.info(f"Stored trajectory {entry.key.hex()} on ID {entry.traj_id} for drone {uav.id}.")
+        else:
+            library.touch(entry)
+        if name:
+            library.set_name(name, entry.key)
+        return True, f"Trajectory stored: {entry.key.hex()}.".encode() + self._describe_fit(trajectory)
+
+    async def play_traj(self, uav: CrazyflieUAV, name_or_hash: str, is_relative: bool) -> CommandResult:
+        # Starts a trajectory from the library of the drone, by name or by payload hash.
+        library = self.get_library(uav)
+        if library is None:
+            return False, b'Trajectory library is not configured.'
+        entry = library.find(name_or_hash)
+        if entry is None:
+            self.log.warning(f"Trajectory {name_or_hash} is not stored on drone {uav.id}.")
+            return False, b'Trajectory is not stored on the drone.'
+        library.touch(entry)
+        slots = self.get_slots(uav)
+        slots.begin_prepare()
+        slots.finish_prepare(entry.traj_id, is_relative)
+        return await self.commit_traj(uav)
+
+    def _can_fly_traj(self, uav: CrazyflieUAV) -> bool:
+        return (uav.is_running_show or self._allow_traj_outside_show) and uav._airborne
+
+    async def handle_new_traj(self, uav: CrazyflieUAV, arg: bytes, payload: bytes) -> CommandResult:
         is_valid, is_relative = self.get_traj_type(arg)
-        if (uav.is_running_show or self._allow_traj_outside_show) and uav._airborne and is_valid:
+        if self._can_fly_traj(uav) and is_valid:
             cf = uav._get_crazyflie()  # access to protected member
             # If this is the first trajectory uploaded, we've not yet defined a hover trajectory: do so.
-            if not self._hover_traj_defined[uav.id]:
+            if not self.is_hover_defined(uav):
                 await self.upload_hover(uav)
             # initiate hover while we switch trajectories so that we don't drift too far
             await cf.high_level_commander.start_trajectory(1, time_scale=1, relative=True, reversed=False)
-            try:
-                trajectory_memory = await cf.mem.find(MemoryType.TRAJECTORY)
-            except ValueError:
-                raise RuntimeError("Trajectories are not supported on this drone") from None
-            # We may want to load the trajectory from the backup file:
-            if self._load_from_file and self._save_to_local_file:
-                with open('./trajectory.json') as json_file:
-                    trajectory_data = json.load(json_file)
-                self.log.warning("Trajectory read from local json file.")
-            else:
-                trajectory_data = json.loads(self._traj.decode('utf-8'))
-            trajectory = TrajectorySpecification(trajectory_data)
-            data = encode_trajectory(trajectory, encoding=TrajectoryEncoding.COMPRESSED)
-            # The trajectory IDs we upload to are 2 and 3, we swap between them like so:
-            upcoming_traj_ID = 5 - self._active_traj_ID
-            # Try to write the data (at this point we don't know whether it's too long or not, write_safely will tell)
-            write_success, addr = await self.write_safely(upcoming_traj_ID, trajectory_memory, data)
-            if write_success:
-                await cf.high_level_commander.define_trajectory(
-                    upcoming_traj_ID, addr=addr, type=TrajectoryType.COMPRESSED)
-                self.log.info(
-                    f"Defined trajectory on ID {upcoming_traj_ID} for drone {uav.id}(currently active ID is {self._active_traj_ID}).")
-                await cf.high_level_commander.start_trajectory(upcoming_traj_ID, time_scale=1, relative=is_relative,
-                                                               reversed=False)
-                self.log.info(f"Started trajectory on ID {upcoming_traj_ID} for drone {uav.id}")
-                # We are now playing the trajectory with the new ID: adjust the active ID accordingly.
-                self._active_traj_ID = upcoming_traj_ID
-            else:
-                self.log.warning(f"Trajectory is too long.")
+            success, message = await self.prepare_traj(uav, payload, is_relative)
+            if not success:
+                return success, message
+            return await self.commit_traj(uav)
         else:
             self.log.warning(f"Drone {uav.id} is not airborne. Start the hover show to upload trajectories.")
-            await server_stream.send_all(b"Drone is not airborne. Start the hover show to upload trajectories.")
-
-        self._block_transmission = True
-
-    async def handle_transmission(self, server_stream: trio.SocketStream):
-        if not self._block_transmission:
-            await server_stream.send_all(b'Transmission of trajectory started.')
-            self.log.info("Transmission of trajectory started.")
-            # Find where the json file begins
-            start_index = self._stream_data.find(b'{')
-            # If the command was 'traj', then a json file must follow. If it doesn't (we can't find the beginning b'{'),
-            # then the command or the file was corrupted.
-            if start_index == -1:
-                self.log.warning("Corrupted trajectory file.")
-                return
-            else:
-                self._traj = self._stream_data[start_index:]
-            self._transmission_active = True  # signal we're in the middle of transmission
-            while not self._traj.endswith(b'_EOF'):  # receive data until we see that the file has ended
-                self._traj += await server_stream.receive_some()  # append the new data to the already received data
-            self._traj = self._traj[:-len(b'_EOF')]  # once finished, remove the EOF indicator
-            self._transmission_active = False  # then signal that the transmission has ended
-            self.log.info("Transmission of trajectory finished.")
-            await server_stream.send_all(b'Transmission of trajectory finished.')
-
-    async def traj(self, uav: CrazyflieUAV, server_stream: trio.SocketStream, arg: bytes):
-        await self.handle_transmission(server_stream)
-        await self.handle_new_traj(uav, server_stream, arg)
-
-    async def hover(self, uav: CrazyflieUAV, server_stream: trio.SocketStream, arg):
-        if not self._hover_traj_defined[uav.id]:
+            return False, b"Drone is not airborne. Start the hover show to upload trajectories."
+
+    async def traj(self, uav: CrazyflieUAV, arg: bytes, payload: Optional[bytes]) -> CommandResult:
+        # The payload has already been received by the TCP server at this point, see handle_command.
+        return await self.handle_new_traj(uav, arg, payload)
+
+    async def prepare(self, uav: CrazyflieUAV, arg: bytes, payload: Optional[bytes]) -> CommandResult:
+        # Like traj, but the trajectory is only uploaded; a later commit command starts it.
+        is_valid, is_relative = self.get_traj_type(arg)
+        if not is_valid:
+            self.log.warning(f"Invalid trajectory type: {arg!r}")
+            return False, b'Invalid trajectory type, use relative or absolute.'
+        return await self.prepare_traj(uav, payload, is_relative)
+
+    async def commit(self, uav: CrazyflieUAV, arg, payload: Optional[bytes]) -> CommandResult:
+        if not self._can_fly_traj(uav):
+            self.log.warning(f"Drone {uav.id} is not airborne, commit command wasn't dispatched.")
+            return False, b"Drone is not airborne, commit command wasn't dispatched."
+        return await self.commit_traj(uav)
+
+    async def store(self, uav: CrazyflieUAV, arg: bytes, payload: Optional[bytes]) -> CommandResult:
+        # The argument is the name to store the trajectory under.
+        return await self.store_traj(uav, payload, arg.decode("utf-8") if arg else None)
+
+    async def play(self, uav: CrazyflieUAV, arg: bytes, payload: Optional[bytes]) -> CommandResult:
+        # The argument is the name or the hash of a stored trajectory, optionally followed by ':relative' (default) or
+        # ':absolute'.
+        name_or_hash, _, traj_type = arg.partition(b':')
+        is_valid, is_relative = self.get_traj_type(traj_type or b'relative')
+        if not is_valid:
+            return False, b'Invalid trajectory type, use relative or absolute.'
+        if not self._can_fly_traj(uav):
+            self.log.warning(f"Drone {uav.id} is not airborne, play command wasn't dispatched.")
+            return False, b"Drone is not airborne, play command wasn't dispatched."
+        return await self.play_traj(uav, name_or_hash.decode("utf-8"), is_relative)
+
+    async def hover(self, uav: CrazyflieUAV, arg, payload: Optional[bytes]) -> CommandResult:
+        if not self.is_hover_defined(uav):
             await self.upload_hover(uav)
         if uav._airborne:
             cf = uav._get_crazyflie()
             await cf.high_level_commander.start_trajectory(1, time_scale=1, relative=True, reversed=False)
-            await server_stream.send_all(b'hover command dispatched to drone.')
             self.log.info(f"Hover command dispatched to drone {uav.id}.")
+            return True, b'hover command dispatched to drone.'
         else:
             self.log.warning(f"Drone {uav.id} is on the ground, if you want to do a takeoff, do so from Live")
-            await server_stream.send_all(b"Drone is already on the ground, hover command wasn't dispatched.")
+            return False, b"Drone is already on the ground, hover command wasn't dispatched."
     # The dictionary keeping track of valid commands. Should match up for the client and the server, but we validate
     # whether an incoming command is recognized anyway. Layout is like this:
     # command: (handler_function, (does_it_take_argument, argument_type), does_it_take_payload)
-    _tcp_command_dict: Dict[bytes, Tuple[Callable[[Extension, CrazyflieUAV, trio.SocketStream, bytes], None], Tuple[bool, Any], bool]] = {
+    # Handlers take the UAV, the argument and the payload, and return a CommandResult.
+    _tcp_command_dict: Dict[bytes, Tuple[Callable[[Extension, CrazyflieUAV, bytes, Optional[bytes]], Awaitable[CommandResult]], Tuple[bool, Any], bool]] = {
         b"takeoff": (takeoff, (True, float), False),  # The command takeoff takes a float argument and expects no payload
         b"land": (land, (False, None), False),  # The command land takes no argument and expects no payload
         b"traj": (traj, (True, str), True),  # The command traj takes a str argument and expects a payload
         b"hover": (hover, (False, None), False),
+        b"prepare": (prepare, (True, str), True),  # Same as traj, but the trajectory isn't started until commit
+        b"commit": (commit, (False, None), False),
+        b"store": (store, (True, str), True),  # Stores the trajectory on the drone under the name given as argument
+        b"play": (play, (True, str), False),  # Starts a stored trajectory by name or hash
     }
 
     async def run(self, app: "SkybrushServer", configuration, logger):
@@ -264,8 +416,26 @@ class ext_aimotionlab(Extension):
         """
 
         self._memory_partitions = configuration.get("memory_partitions")
+        self._max_commands_per_radio = int(configuration.get("max_commands_per_radio", self._max_commands_per_radio))
+        self._radio_limiters = {}
+        self._library_config = configuration.get("trajectory_library")
+        self._traj_libraries = {}
+        self._trajectory_cache = TrajectoryCache(int(configuration.get("trajectory_cache_size",
+                                                                       self._trajectory_cache.max_size)))
+        self._encoding_limiter = trio.CapacityLimiter(int(configuration.get("max_encoding_threads", 2)))
+        self._max_simplification_error = float(configuration.get("max_simplification_error",
+                                                                 self._max_simplification_error))
+        self._max_pipelined_commands = int(configuration.get("max_pipelined_commands", self._max_pipelined_commands))
+        self._hover_provisioning_interval = float(configuration.get("hover_provisioning_interval",
+                                                                    self._hover_provisioning_interval))
         port = configuration.get("port")
         channel = configuration.get("channel")
+        tcp_port = int(configuration.get("tcp_port", TCP_PORT))  # 'port' is the CRTP port of the pose broadcasts
+        # Seconds between log entries about per-object pose latencies; 0 turns off the per-object statistics.
+        latency_report_interval = float(configuration.get("latency_report_interval", 0))
+        # Optional latency compensation of broadcast poses, see PosePredictor for the available settings.
+        prediction_config = configuration.get("prediction")
+        predictor = PosePredictor.from_configuration(prediction_config) if prediction_config else None
         assert self.app is not None
         signals = self.app.import_api("signals")
         broadcast = self.app.import_api("crazyflie").broadcast
@@ -277,23 +447,120 @@ class ext_aimotionlab(Extension):
                 f.write(b'')
             self.log.info("Cleared trajectory.json")
 
-        with ExitStack() as stack:
-            # create a dedicated mocap frame handler
-            frame_handler = AiMotionMocapFrameHandler(broadcast, port, channel)
-            # subscribe to the motion capture frame signal
-            stack.enter_context(
-                signals.use(
-                    {
-                        "motion_capture:frame": partial(
-                            self._on_motion_capture_frame_received,
-                            handler=frame_handler,
-                        )
-                    }
+        async with AsyncExitStack() as stack:
+            async with trio.open_nursery() as nursery:
+                # Poses are sharded across the radios listed under 'radios' (see create_broadcast_shards); each shard
+                # may limit its packets per second with a BroadcastScheduler. Without 'radios', every pose goes to the
+                # configured port and channel.
+                shards = await create_broadcast_shards(configuration, broadcast, nursery, stack)
+                # create a dedicated mocap frame handler
+                frame_handler = AiMotionMocapFrameHandler(broadcast, port, channel,
+                                                          collect_latency_stats=latency_report_interval > 0,
+                                                          classifier=ObjectClassifier.from_configuration(configuration),
+                                                          shards=shards, predictor=predictor)
+                # subscribe to the motion capture frame signal
+                stack.enter_context(
+                    signals.use(
+                        {
+                            "motion_capture:frame": partial(
+                                self._on_motion_capture_frame_received,
+                                handler=frame_handler,
+                            )
+                        }
+                    )
                 )
-            )
-            # await sleep_forever() # We need *something* here that prevents exiting the context where we are subscribed
-            # to the signal. If we don't have the serve_tcp, then we need a sleep forever.
-            await trio.serve_tcp(self.TCP_Server, TCP_PORT)
+                if latency_report_interval > 0:
+                    nursery.start_soon(self._report_latency_stats, frame_handler, latency_report_interval)
+                if self._hover_provisioning_interval > 0:
+                    nursery.start_soon(self._provision_hover, self._hover_provisioning_interval)
+                for shard in shards:
+                    if shard.scheduler is not None:
+                        nursery.start_soon(shard.scheduler.run)
+                        report_interval = float(shard.scheduler_report_interval)
+                        if report_interval > 0:
+                            nursery.start_soon(self._report_broadcast_rates, shard, report_interval)
+                # serve_tcp never returns, which keeps us in the context where we are subscribed to the signal.
+                await trio.serve_tcp(self.TCP_Server, tcp_port)
+
+    async def _provision_hover(self, interval: float):
+        # Uploads and defines the hover trajectory on every drone as soon as it shows up in the object registry or
+        # reconnects, so that the first trajectory command doesn't have to do it in the middle of a trajectory switch.
+        # New drones are picked up immediately through the 'added' signal of the registry; reconnections (a new
+        # Crazyflie connection object) are found by checking all drones periodically. Drones that failed are retried
+        # with a growing delay, or right away once they reconnect.
+        registry = self.app.object_registry
+        send_channel, receive_channel = trio.open_memory_channel(float("inf"))
+
+        def on_added(sender, object):
+            if isinstance(object, CrazyflieUAV):
+                send_channel.send_nowait(object)
+
+        async def poll():
+            while True:
+                for uav_id in list(registry.ids_by_type(CrazyflieUAV)):
+                    try:
+                        send_channel.send_nowait(registry.find_by_id(uav_id))
+                    except KeyError:
+                        pass
+                await sleep(interval)
+
+        with registry.added.connected_to(on_added, sender=registry):
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(poll)
+                pending = set()
+                # uav.id -> (connection that failed, time of the next attempt, delay before the next attempt)
+                failures: Dict[str, Tuple[ref, float, float]] = {}
+                async for uav in receive_channel:
+                    cf = getattr(uav, "_crazyflie", None)  # access to protected member
+                    if uav.id in pending or cf is None or self.is_hover_defined(uav):
+                        continue
+                    failure = failures.get(uav.id)
+                    if failure is not None and failure[0]() is cf and trio.current_time() < failure[1]:
+                        continue
+                    pending.add(uav.id)
+                    nursery.start_soon(self._provision_hover_on, uav, cf, pending, failures, interval)
+
+    async def _provision_hover_on(self, uav: CrazyflieUAV, cf, pending: set,
+                                  failures: Dict[str, Tuple[ref, float, float]], interval: float):
+        try:
+            async with self._get_radio_limiter(uav):
+                async with self.get_drone_lock(uav):
+                    await self.upload_hover(uav)
+            failures.pop(uav.id, None)
+        except Exception as exc:
+            # Logged once per connection; repeated failures on the same connection back off exponentially
+            failure = failures.get(uav.id)
+            if failure is not None and failure[0]() is cf:
+                delay = min(failure[2] * 2, MAX_HOVER_RETRY_DELAY)
+                self.log.debug(f"Could not provision hover trajectory on drone {uav.id} again: {exc!r}")
+            else:
+                delay = interval
+                self.log.warning(f"Could not provision hover trajectory on drone {uav.id}: {exc!r}")
+            failures[uav.id] = (ref(cf), trio.current_time() + delay, delay)
+        finally:
+            pending.discard(uav.id)
+
+    async def _report_broadcast_rates(self, shard: BroadcastShard, interval: float):
+        # Periodically log how many pose updates per second each object actually got from the broadcast scheduler, and
+        # how many packets the radio dropped because it could not keep up.
+        dropped = 0
+        while True:
+            await sleep(interval)
+            rates = shard.scheduler.achieved_rates()
+            if rates:
+                summary = ", ".join(f"{name}: {rate:.1f}/s" for name, rate in sorted(rates.items()))
+                self.log.info(f"Achieved pose update rates on {shard.name}: {summary}")
+            if shard.scheduler.dropped_packets > dropped:
+                self.log.warning(f"Radio {shard.name} dropped {shard.scheduler.dropped_packets - dropped} packet(s)")
+                dropped = shard.scheduler.dropped_packets
+
+    async def _report_latency_stats(self, handler: AiMotionMocapFrameHandler, interval: float):
+        # Periodically log how old the poses of each broadcast object were when they were handed over to the radio.
+        while True:
+            await sleep(interval)
+            for name, stats in sorted(handler.object_stats.items()):
+                self.log.info(f"Pose latency of {name}: {stats.format()}")
+                stats.reset()
 
     def _on_motion_capture_frame_received(
             self,
@@ -302,71 +569,148 @@ class ext_aimotionlab(Extension):
             frame: "MotionCaptureFrame",
             handler: AiMotionMocapFrameHandler,
     ) -> None:
+        timeline = get_timeline(frame)
+        if timeline is not None:
+            timeline.stamp("dispatch")
         handler.notify_frame(frame)
 
-    async def cmd_to_single_drone(self, cmd, ID, server_stream, arg):
-        self.log.info(f"Command received: {cmd.decode('utf-8')}")  # Let the user know the command arrived
-        await server_stream.send_all(b'Command received: ' + cmd)  # Let the client know as well
+    async def cmd_to_single_drone(self, cmd, ID, arg, payload) -> Dict[str, CommandResult]:
         try:
             uav: CrazyflieUAV = self.app.object_registry.find_by_id(ID)
-            self.log.info(f"UAV {ID} found!")
-            # call the appropriate handler function of the command as described in the dictionary
-            await self._tcp_command_dict[cmd][0](self, uav, server_stream, arg)
         except KeyError:
             self.log.warning(f"UAV by ID {ID} is not found in the client registry.")
-            return
+            return {ID: (False, f"UAV by ID {ID} is not found.".encode())}
+        self.log.info(f"UAV {ID} found!")
+        # Same as for all drones: take the limiter of the radio first, then the drone lock
+        results: Dict[str, CommandResult] = {}
+        await self._run_command_on_radio(cmd, uav, arg, payload, results)
+        return {ID: results[uav.id]}
 
-    async def cmd_to_all_drones(self, cmd, server_stream, arg):
+    async def cmd_to_all_drones(self, cmd, arg, payload) -> Dict[str, CommandResult]:
         # Check which drones are known by the server
         uav_ids = list(self.app.object_registry.ids_by_type(CrazyflieUAV))
-        self.log.info(f"Command received: {cmd.decode('utf-8')}")  # Let the user know the command arrived
-        await server_stream.send_all(b'Command received: ' + cmd)  # Let the client know as well
-        try:
-            # Place the known drones into a list to iterate over
-            uavs = [self.app.object_registry.find_by_id(ID) for ID in uav_ids]
+        uavs = []
+        for ID in uav_ids:
+            try:
+                uavs.append(self.app.object_registry.find_by_id(ID))
+            except KeyError:
+                self.log.warning(f"UAV {ID} was not found in the registry.")
+        # The command goes out to every drone at the same time; drones sharing a radio are throttled by the limiter of
+        # that radio. We wait for all of them and then answer the client in one go.
+        results: Dict[str, CommandResult] = {}
+        async with trio.open_nursery() as nursery:
             for uav in uavs:
-                await self._tcp_command_dict[cmd][0](self, uav, server_stream, arg)
-        except KeyError:
-            self.log.warning("An UAV was not found in the registry.")
+                nursery.start_soon(self._run_command_on_radio, cmd, uav, arg, payload, results)
+        return results
+
+    def get_drone_lock(self, uav: CrazyflieUAV) -> trio.Lock:
+        lock = self._drone_locks.get(uav.id)
+        if lock is None:
+            lock = self._drone_locks[uav.id] = trio.Lock()
+        return lock
+
+    async def _run_command(self, cmd, uav: CrazyflieUAV, arg, payload) -> CommandResult:
+        # call the appropriate handler function of the command as described in the dictionary
+        try:
+            async with self.get_drone_lock(uav):
+                return await self._tcp_command_dict[cmd][0](self, uav, arg, payload)
+        except Exception as exc:
+            self.log.warning(f"Command {cmd.decode('utf-8')} failed on drone {uav.id}: {exc!r}")
+            return False, f"Command failed: {exc}".encode()
+
+    async def _run_command_on_radio(self, cmd, uav: CrazyflieUAV, arg, payload, results: Dict[str, CommandResult]):
+        async with self._get_radio_limiter(uav):
+            results[uav.id] = await self._run_command(cmd, uav, arg, payload)
+
+    def _get_radio_limiter(self, uav: CrazyflieUAV) -> trio.CapacityLimiter:
+        # Drones are grouped by the radio they are on, e.g. radio://0/80/2M/E7E7E7E706 is on radio://0.
+        uri = getattr(uav, "uri", None) or ""
+        scheme, _, rest = uri.partition("://")
+        radio = f"{scheme}://{rest.split('/', 1)[0]}" if rest else uri
+        limiter = self._radio_limiters.get(radio)
+        if limiter is None:
+            limiter = self._radio_limiters[radio] = trio.CapacityLimiter(self._max_commands_per_radio)
+        return limiter
+
+    async def handle_command(self, session: CommandSession, command: Command, received_at: float,
+                             after: List[trio.Event]):
+        # Runs a command once the earlier commands of the session it has to wait for are done, and answers the client.
+        _, (takes_argument, _), takes_payload = self._tcp_command_dict[command.command]
+        if takes_argument and command.argument is None:
+            self.log.warning(f"Command {command.command.decode('utf-8')} is missing its argument.")
+            await session.reject(command, b'Command is missing its argument.')
             return
+        if takes_payload:
+            if not command.payload:
+                self.log.warning(f"Command {command.command.decode('utf-8')} is missing its payload.")
+                await session.reject(command, b'Command is missing its payload.')
+                return
+            # The payload (i.e. a trajectory) was received once, even if the command goes out to several drones.
+            self.log.info(f"Received payload of {len(command.payload)} bytes.")
+        # Let the user and the client know the command arrived
+        self.log.info(f"Command received from {session}: {command.command.decode('utf-8')}")
+        await session.acknowledge(command)
+        for event in after:
+            await event.wait()
+        started_at = trio.current_time()
+        if int(command.uav_id) == 0:
+            results = await self.cmd_to_all_drones(command.command, command.argument, command.payload)
+        else:
+            results = await self.cmd_to_single_drone(command.command, command.uav_id, command.argument,
+                                                     command.payload)
+        await session.respond(command, results, received_at, started_at)
+
+    async def _process_command(self, session: CommandSession, command: Command, received_at: float,
+                               after: List[trio.Event], done: trio.Event):
+        try:
+            await self.handle_command(session, command, received_at, after)
+        except trio.BrokenResourceError:
+            self.log.info(f"Could not answer {command.command.decode('utf-8')} in {session}, client is gone.")
+        except Exception as exc:
+            self.log.warning(f"TCP server crashed: {exc!r}")
+        finally:
+            done.set()
+
+    async def _process_pipelined_command(self, session: CommandSession, command: Command, received_at: float,
+                                         after: List[trio.Event], done: trio.Event, slots: trio.Semaphore):
+        try:
+            await self._process_command(session, command, received_at, after, done)
+        finally:
+            slots.release()
 
     async def TCP_Server(self, server_stream: trio.SocketStream):
+        # Every connection gets its own session, so several clients can send commands at the same time.
+        session = CommandSession(server_stream,
+                                 {cmd: (spec[1][0], spec[2]) for cmd, spec in self._tcp_command_dict.items()})
         uav_ids = list(self.app.object_registry.ids_by_type(CrazyflieUAV))
-        self._hover_traj_defined = {key: False for key in uav_ids}
-        print(self._hover_traj_defined)
-        self.log.info(f"Connection made to TCP client. Valid drone IDs: {uav_ids}")
+        self.log.info(f"Connection made to TCP client in {session}. Valid drone IDs: {uav_ids}")
         # uav_ids_bytes = ', '.join(uav_ids).encode("utf-8")
         # await server_stream.send_all(uav_ids_bytes)
-        while True:
-            # If we're not in the middle of a trajectory's transition, we can handle commands:
-            if not self._transmission_active:
-                try:
-                    self._stream_data: bytes = await server_stream.receive_some()
-                    if not self._stream_data:
-                        break
-                    ID, cmd, arg = self.parse(self._stream_data, self._tcp_command_dict)
-                    if cmd == b'NO_CMDSTART':
-                        self.log.info(f"Command is missing standard CMDSTART")
-                        await server_stream.send_all(b'Command is missing standard CMDSTART')
-                    elif cmd == b'WRONG_CMD':
-                        self.log.info(f"Command is not found in server side dictionary")
-                        await server_stream.send_all(b'Command is not found in server side dictionary')
-                    elif cmd is None:
-                        self.log.warning(f"None-type command")
-                        await server_stream.send_all(b'None-type command')
-                    else:
-                        # Allow trajectory transmission. This is then blocked after a trajectory is handled to avoid
-                        # unnecessarily uploading a trajectory several times when we transmit the trajectory to several
-                        # drones at once.
-                        self._block_transmission = False
-                        if int(ID) == 0:
-                            await self.cmd_to_all_drones(cmd, server_stream, arg)
+        # Commands may arrive split across several reads or several in a single read, in the framed or in the legacy
+        # format; the parser of the session takes care of reassembling them. Commands with a request ID are processed
+        # concurrently (the session keeps the ones sent to the same drone in order) and answered whenever they are
+        # done; the client tells the answers apart by their request ID. Other commands are processed one by one, as
+        # their answers carry nothing to match them with.
+        slots = trio.Semaphore(self._max_pipelined_commands)
+        async with trio.open_nursery() as nursery:
+            try:
+                async for data in server_stream:
+                    received_at = trio.current_time()
+                    for item in session.parser.feed(data):
+                        if isinstance(item, ProtocolError):
+                            self.log.info(item.message.decode("utf-8", errors="replace"))
+                            await session.reject(item, item.message)
+                            continue
+                        after, done = session.reserve(item.uav_id)
+                        if item.request_id is None:
+                            await self._process_command(session, item, received_at, after, done)
                         else:
-                            await self.cmd_to_single_drone(cmd, ID, server_stream, arg)
-                except Exception as exc:
-                    self.log.warning(f"TCP server crashed: {exc!r}")
-
-
-
-
-
+                            await slots.acquire()
+                            nursery.start_soon(self._process_pipelined_command, session, item, received_at, after,
+                                               done, slots)
+            except trio.BrokenResourceError:
+                # The client went away. Caught here and not outside of the nursery, so that the commands already
+                # running (e.g. halfway through a memory write) are finished instead of being cancelled; their answers
+                # are dropped.
+                pass
+        self.log.info(f"TCP client of {session} disconnected.")
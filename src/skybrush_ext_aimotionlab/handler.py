@@ -1,45 +1,102 @@
 from time import  time
-from typing import List, Tuple
-from flockwave.server.utils import chunks
+from typing import Dict, List, Optional, Tuple
 from flockwave.server.ext.motion_capture import MotionCaptureFrame
 from aiocflib.utils.quaternion import QuaternionXYZW
-from aiocflib.crazyflie.localization import (
-    GenericLocalizationCommand,
-    Localization,
-)
+from skybrush_ext_libmotioncapture.latency import LatencyStats, get_timeline
+from .classifier import ObjectClassifier
+from .scheduler import BroadcastScheduler, Pose
+from .sharding import BroadcastShard, assign_shards
+from .predictor import PosePredictor
 
 
 class AiMotionMocapFrameHandler:
 
-    def __init__(self, broadcast, port, channel):
-        self._broadcast = broadcast
-        self._port = port
-        self._channel = channel
+    def __init__(self, broadcast, port, channel, collect_latency_stats: bool = False,
+                 classifier: Optional[ObjectClassifier] = None, scheduler: Optional[BroadcastScheduler] = None,
+                 shards: Optional[List[BroadcastShard]] = None, predictor: Optional[PosePredictor] = None):
         self._cur_id = 0
+        # Decides which objects are non-UAV objects whose pose we broadcast; caches its decision per name.
+        self._classifier = classifier or ObjectClassifier()
+        # Latency statistics of each broadcast object, keyed by name. Only collected for frames that carry a timeline
+        # (i.e. that come from the libmotioncapture extension with latency instrumentation turned on).
+        self.object_stats: Optional[Dict[str, LatencyStats]] = {} if collect_latency_stats else None
+        # The radios (or port/channel pairs) that we broadcast poses on. Without explicit shards, everything goes to
+        # the given port and channel. When a shard has a scheduler, poses are handed over to it instead of being
+        # broadcast right away.
+        if shards is None:
+            shards = [BroadcastShard("default", broadcast, port, channel, scheduler=scheduler)]
+        self.shards = shards
+        # Optional estimator that compensates for the latency of the pipeline by extrapolating positions
+        self._predictor = predictor
+        self._shards_by_name: Dict[str, List[BroadcastShard]] = {}
+        for shard in shards:
+            if shard.scheduler is not None and self.object_stats is not None:
+                shard.scheduler.on_sent = self.record_object_latency
+            # Poses may wait in a scheduler for a while; they are extrapolated when they are actually sent
+            if shard.scheduler is not None and predictor is not None:
+                shard.scheduler.predict = predictor.predict
 
     def notify_frame(self, frame: "MotionCaptureFrame"):
-        # Prefixes which we classify as non-UAV.
-        valid_prefixes = ['bu', 'hook', 'test']
-        poses: List[Tuple[int, Tuple[float, float, float], QuaternionXYZW]] = []
+        timeline = get_timeline(frame)
+        classify = self._classifier.classify
+        entries: List[Tuple[str, str, Pose]] = []
         for item in frame.items:
-            for prefix in valid_prefixes:
-                if item.name.startswith(prefix):
-                    try:
-                        numeric_id = int(item.name[len(prefix):])
-                    except ValueError:
-                        continue
-                    if item.attitude is not None and item.position is not None:
-                        w, x, y, z = item.attitude
-                        poses.append((numeric_id + self._cur_id, item.position, QuaternionXYZW(x, y, z, w)))
-                        self._cur_id = 1 - self._cur_id
-        for chunk in chunks(poses, 2):
-            packet = bytes(
-                [GenericLocalizationCommand.EXT_POSE_PACKED]
-            ) + Localization.encode_external_pose_packed(chunk)
-            # print(f"Broadcasting on channel {self._channel} and port {self._port} with time stamp: {time()}")
-            #TODO: when there are two radios available, the drone doesn't receive the correct packets.
-            self._broadcast(
-                self._port,
-                self._channel,
-                packet,
-            )
+            classification = classify(item.name)
+            if classification is None:
+                continue
+            if item.attitude is not None and item.position is not None:
+                w, x, y, z = item.attitude
+                pose = (classification[0] + self._cur_id, item.position, QuaternionXYZW(x, y, z, w))
+                self._cur_id = 1 - self._cur_id
+                entries.append((item.name, classification[1], pose))
+        predicted = entries
+        if self._predictor is not None and entries:
+            predicted = self._predict(entries, timeline)
+        if timeline is not None:
+            timeline.stamp("handler")
+        capture = timeline.capture if timeline is not None else None
+        poses_by_shard: Dict[BroadcastShard, List[Tuple[str, str, Pose]]] = {}
+        for entry, predicted_entry in zip(entries, predicted):
+            for shard in self._get_shards(entry[0], entry[1]):
+                # Schedulers extrapolate the measured poses themselves when sending them
+                poses_by_shard.setdefault(shard, []).append(entry if shard.scheduler is not None else predicted_entry)
+        for shard, shard_entries in poses_by_shard.items():
+            if shard.scheduler is not None:
+                for name, cls, pose in shard_entries:
+                    shard.scheduler.submit(name, cls, pose, capture)
+            else:
+                shard.send([pose for _, _, pose in shard_entries])
+        if timeline is not None and entries:
+            now = timeline.stamp("broadcast")
+            if self.object_stats is not None:
+                # Objects that go through a scheduler are recorded when they are actually sent
+                for shard, shard_entries in poses_by_shard.items():
+                    if shard.scheduler is None:
+                        for name, _, _ in shard_entries:
+                            self.record_object_latency(name, timeline.capture, now)
+
+    def _predict(self, entries: List[Tuple[str, str, Pose]], timeline) -> List[Tuple[str, str, Pose]]:
+        # Feeds the measured positions to the predictor and returns the entries with positions extrapolated to the
+        # expected receive time. When we know when the frame was captured, the time it spent in the pipeline so far is
+        # added to the prediction horizon.
+        now = time()
+        t = timeline.capture if timeline is not None else now
+        positions = self._predictor.update([name for name, _, _ in entries], [pose[1] for _, _, pose in entries],
+                                           t, latency=now - t)
+        return [(name, cls, (pose[0], position, pose[2])) for (name, cls, pose), position in zip(entries, positions)]
+
+    def _get_shards(self, name: str, cls: str) -> List[BroadcastShard]:
+        shards = self._shards_by_name.get(name)
+        if shards is None:
+            shards = self._shards_by_name[name] = assign_shards(self.shards, name, cls)
+        return shards
+
+    def record_object_latency(self, name: str, capture: float, now: float):
+        # Called when the pose of an object captured at `capture` was handed over to the radio at `now`.
+        if self.object_stats is None:
+            return
+        stats = self.object_stats.get(name)
+        if stats is None:
+            stats = self.object_stats[name] = LatencyStats(("broadcast",))
+        stats.record("broadcast", now - capture)
+        stats.intervals.add(capture)
@@ -0,0 +1,113 @@
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+__all__ = ("LibraryEntry", "TrajectoryLibrary")
+
+DEFAULT_LIBRARY_IDS = (4, 5, 6, 7, 8, 9)
+# Trajectory IDs handed out to library trajectories: 1 is hover and 2-3 are the A/B slots, the firmware has 10 IDs.
+
+
+class LibraryEntry:
+    __slots__ = ("key", "traj_id", "start", "size")
+
+    def __init__(self, key: bytes, traj_id: int, start: int, size: int):
+        self.key = key  # hash of the trajectory payload, see TrajectoryCache.key_of()
+        self.traj_id = traj_id
+        self.start = start  # address of the checksum; the trajectory itself follows it
+        self.size = size  # checksum and trajectory together
+
+    @property
+    def end(self) -> int:
+        return self.start + self.size
+
+
+class TrajectoryLibrary:
+    """Bookkeeping of the trajectories stored on a single drone, in a dedicated region of its trajectory memory. The
+    region is a pool of variable-sized blocks, each holding one trajectory under its own trajectory ID, so trajectories
+    that the drone already has can be started without sending them over the radio again. When there is no room (or
+    no free trajectory ID) for a new trajectory, the least recently used ones are evicted.
+
+    Like TrajectorySlots, a library belongs to a single Crazyflie connection.
+    """
+
+    def __init__(self, connection: Any, start: int, size: int, ids: Sequence[int] = DEFAULT_LIBRARY_IDS):
+        if size <= 0 or not ids:
+            raise ValueError("Trajectory library needs memory and at least one trajectory ID")
+        self.connection = connection
+        self.start = start
+        self.size = size
+        self._ids = tuple(ids)
+        self._entries: "OrderedDict[bytes, LibraryEntry]" = OrderedDict()  # least recently used first
+        self._names: Dict[str, bytes] = {}
+
+    @classmethod
+    def from_configuration(cls, connection: Any, configuration) -> "TrajectoryLibrary":
+        return cls(connection, int(configuration["start"]), int(configuration["size"]),
+                   configuration.get("ids", DEFAULT_LIBRARY_IDS))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: bytes) -> Optional[LibraryEntry]:
+        return self._entries.get(key)
+
+    def find(self, name_or_hash: str) -> Optional[LibraryEntry]:
+        # Looks up a trajectory by the name it was stored under, or by the hex digest of its payload.
+        key = self._names.get(name_or_hash)
+        if key is None:
+            try:
+                key = bytes.fromhex(name_or_hash)
+            except ValueError:
+                return None
+        return self._entries.get(key)
+
+    def names_of(self, key: bytes) -> List[str]:
+        return [name for name, named_key in self._names.items() if named_key == key]
+
+    def set_name(self, name: str, key: bytes):
+        if key not in self._entries:
+            raise KeyError(key)
+        self._names[name] = key
+
+    def touch(self, entry: LibraryEntry):
+        # Marks the entry as used just now, so it is evicted last.
+        self._entries.move_to_end(entry.key)
+
+    def allocate(self, key: bytes, size: int, keep: Iterable[int] = ()) -> Optional[LibraryEntry]:
+        # Reserves a block of the given size and a trajectory ID for the trajectory with the given key, evicting the
+        # least recently used trajectories if needed, except those whose IDs are in keep (e.g. the one in flight).
+        # Returns None if the trajectory doesn't fit even then. The caller is responsible for writing and defining it.
+        if key in self._entries:
+            self.remove(key)
+        if size > self.size:
+            return None
+        keep = set(keep)
+        while True:
+            traj_id = self._free_id()
+            start = self._find_gap(size)
+            if traj_id is not None and start is not None:
+                break
+            victim = next((entry for entry in self._entries.values() if entry.traj_id not in keep), None)
+            if victim is None:
+                return None
+            self.remove(victim.key)
+        entry = self._entries[key] = LibraryEntry(key, traj_id, start, size)
+        return entry
+
+    def remove(self, key: bytes):
+        self._entries.pop(key, None)
+        for name in self.names_of(key):
+            del self._names[name]
+
+    def _free_id(self) -> Optional[int]:
+        used = {entry.traj_id for entry in self._entries.values()}
+        return next((traj_id for traj_id in self._ids if traj_id not in used), None)
+
+    def _find_gap(self, size: int) -> Optional[int]:
+        # First fit among the gaps between the allocated blocks
+        address = self.start
+        for entry in sorted(self._entries.values(), key=lambda entry: entry.start):
+            if entry.start - address >= size:
+                return address
+            address = max(address, entry.end)
+        return address if self.start + self.size - address >= size else None
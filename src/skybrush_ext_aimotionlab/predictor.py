@@ -0,0 +1,141 @@
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+__all__ = ("PosePredictor",)
+
+MODELS = ("constant_velocity", "alpha_beta")
+
+
+class PosePredictor:
+    """Estimates the velocity of every broadcast object and extrapolates its position to the time when the pose is
+    expected to arrive at the drones. All objects are updated at once with NumPy; each object is a row in the state
+    arrays, and the last few measurements of each object are kept in a ring buffer.
+
+    Two models are available: 'constant_velocity' fits a straight line to the positions in the ring buffer, while
+    'alpha_beta' runs an alpha-beta filter on the incoming measurements. Only positions are predicted; attitudes are
+    passed on unchanged.
+    """
+
+    def __init__(self, model: str = "alpha_beta", alpha: float = 0.85, beta: float = 0.005, horizon: float = 0.0,
+                 max_horizon: float = 0.1, history: int = 8, reset_after: float = 0.5):
+        # horizon: extra time (radio transfer, on-drone processing) added to the measured pipeline latency.
+        # max_horizon: upper bound of the total prediction horizon, so a stalled pipeline can't fling poses away.
+        # reset_after: objects not seen for this long start over from zero velocity.
+        if model not in MODELS:
+            raise ValueError(f"Unknown pose prediction model: {model!r}")
+        if history < 2:
+            raise ValueError("Pose prediction needs a history of at least two samples")
+        self.model = model
+        self.alpha = float(alpha)
+        self.beta = float(beta)
+        self.horizon = float(horizon)
+        self.max_horizon = float(max_horizon)
+        self.reset_after = float(reset_after)
+        self._history = int(history)
+        self._rows: Dict[str, int] = {}
+        self._allocate(16)
+
+    @classmethod
+    def from_configuration(cls, configuration) -> "PosePredictor":
+        keys = ("model", "alpha", "beta", "horizon", "max_horizon", "history", "reset_after")
+        return cls(**{key: configuration[key] for key in keys if key in configuration})
+
+    def _allocate(self, capacity: int):
+        k = self._history
+        old = getattr(self, "_position", None)
+        position = np.zeros((capacity, 3))
+        velocity = np.zeros((capacity, 3))
+        last_t = np.full(capacity, -np.inf)
+        times = np.zeros((capacity, k))
+        samples = np.zeros((capacity, k, 3))
+        count = np.zeros(capacity, dtype=np.int64)
+        if old is not None:
+            n = len(old)
+            position[:n] = self._position
+            velocity[:n] = self._velocity
+            last_t[:n] = self._last_t
+            times[:n] = self._times
+            samples[:n] = self._samples
+            count[:n] = self._count
+        self._position, self._velocity, self._last_t = position, velocity, last_t
+        self._times, self._samples, self._count = times, samples, count
+
+    def _rows_of(self, names: Sequence[str]) -> np.ndarray:
+        rows = self._rows
+        for name in names:
+            if name not in rows:
+                if len(rows) == len(self._position):
+                    self._allocate(2 * len(rows))
+                rows[name] = len(rows)
+        return np.fromiter((rows[name] for name in names), dtype=np.int64, count=len(names))
+
+    def update(self, names: Sequence[str], positions, t: float, latency: float = 0.0) -> List[List[float]]:
+        # Feeds the positions of the given objects measured at time t, and returns the positions extrapolated to
+        # t + latency + horizon, in the same order. latency is the measured age of the measurement by now.
+        if not names:
+            return []
+        rows = self._rows_of(names)
+        z = np.asarray(positions, dtype=float).reshape(-1, 3)
+
+        dt = t - self._last_t[rows]
+        stale = ~(dt <= self.reset_after)  # also catches first sightings where dt is inf
+        self._count[rows[stale]] = 0
+        dt = np.where(stale, 0.0, dt)
+
+        # Ring buffer of the last few measurements
+        k = self._history
+        slots = self._count[rows] % k
+        self._times[rows, slots] = t
+        self._samples[rows, slots] = z
+        self._count[rows] += 1
+        self._last_t[rows] = t
+
+        if self.model == "alpha_beta":
+            self._update_alpha_beta(rows, z, dt, stale)
+        else:
+            self._update_constant_velocity(rows, z)
+
+        horizon = min(max(latency, 0.0) + self.horizon, self.max_horizon)
+        return (self._position[rows] + self._velocity[rows] * horizon).tolist()
+
+    def predict(self, names: Sequence[str], now: float) -> List[List[float]]:
+        # Returns the positions of the given objects extrapolated from their last measurement to now + horizon, in the
+        # same order. Every object must have been passed to update() before. Used when the time of sending is only
+        # known later than the time of the measurement, e.g. when poses wait in a BroadcastScheduler.
+        if not names:
+            return []
+        rows = np.fromiter((self._rows[name] for name in names), dtype=np.int64, count=len(names))
+        horizon = np.minimum(np.maximum(now - self._last_t[rows], 0.0) + self.horizon, self.max_horizon)
+        return (self._position[rows] + self._velocity[rows] * horizon[:, None]).tolist()
+
+    def _update_alpha_beta(self, rows: np.ndarray, z: np.ndarray, dt: np.ndarray, stale: np.ndarray):
+        position = self._position[rows]
+        velocity = self._velocity[rows]
+        predicted = position + velocity * dt[:, None]
+        residual = z - predicted
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gain = np.where(dt > 0, self.beta / dt, 0.0)
+        position = np.where(stale[:, None], z, predicted + self.alpha * residual)
+        velocity = np.where(stale[:, None], 0.0, velocity + gain[:, None] * residual)
+        self._position[rows] = position
+        self._velocity[rows] = velocity
+
+    def _update_constant_velocity(self, rows: np.ndarray, z: np.ndarray):
+        # Least-squares slope of position over time across the samples in the ring buffer
+        k = self._history
+        n = np.minimum(self._count[rows], k)
+        valid = np.arange(k)[None, :] < n[:, None]
+        times = self._times[rows]
+        samples = self._samples[rows]
+        weight = valid.astype(float)
+        count = np.maximum(weight.sum(axis=1), 1.0)
+        t_mean = (times * weight).sum(axis=1) / count
+        p_mean = (samples * weight[:, :, None]).sum(axis=1) / count[:, None]
+        dt = (times - t_mean[:, None]) * weight
+        denominator = (dt * dt).sum(axis=1)
+        numerator = (dt[:, :, None] * (samples - p_mean[:, None, :])).sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            velocity = np.where(denominator[:, None] > 0, numerator / denominator[:, None], 0.0)
+        self._velocity[rows] = velocity
+        self._position[rows] = z
@@ -0,0 +1,207 @@
+"""Wire format of the commands sent to the TCP server of the extension.
+
+Framed commands start with a fixed header: the magic bytes ``AIML``, the protocol version (uint8), the ID of the
+drone (uint8, 0 means all drones), then the length of the command (uint8), of the argument (uint16) and of the payload
+(uint32), all little-endian. Version 2 adds a request ID chosen by the client (uint32). The command, the argument and
+the payload follow the header, in this order.
+
+Commands with a request ID are answered with framed responses: the magic bytes ``AIMR``, the protocol version
+(uint8), the request ID (uint32), a status (uint8, see the ``STATUS_...`` constants) and the length of the body
+(uint32), followed by the body, a UTF-8 encoded JSON object. A command is acknowledged with ``STATUS_ACCEPTED`` when it
+is received, then answered with its final status when it is done; the final response carries the result of each drone
+and the timing of the command. Other commands are answered with free text, as before.
+
+Legacy commands look like ``CMDSTART_<ID>_<command>[_<argument>][_<payload>]_EOF``; they are still understood, so
+older clients keep working. The command table tells whether a command has an argument and a payload, so a payload
+may contain underscores.
+
+Both kinds can be mixed and pipelined on the same connection, and any number of them may arrive in a single read.
+Client.py mirrors the framed layout; keep the two in sync.
+"""
+
+import json
+from struct import Struct
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple, Union
+
+__all__ = ("Command", "CommandParser", "ProtocolError", "encode_command", "encode_response")
+
+MAGIC = b"AIML"
+VERSION = 2
+RESPONSE_MAGIC = b"AIMR"
+LEGACY_START = b"CMDSTART_"
+LEGACY_END = b"_EOF"
+
+HEADER_V1 = Struct("<4sBBBHI")
+HEADER = Struct("<4sBBBHII")
+RESPONSE_HEADER = Struct("<4sBIBI")
+
+STATUS_ACCEPTED = 1  # received, being processed
+STATUS_OK = 2  # succeeded on every drone it was sent to
+STATUS_PARTIAL = 3  # succeeded on some of the drones
+STATUS_FAILED = 4  # failed on every drone, or there was no drone to send it to
+STATUS_REJECTED = 5  # not processed at all: unknown or malformed command
+
+DEFAULT_MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+# Frames announcing a larger payload are rejected (and skipped) instead of being buffered.
+
+_WHITESPACE = b" \t\r\n"
+
+
+class Command(NamedTuple):
+    """A complete command received from a client."""
+
+    uav_id: str  # two digits, "00" means all drones
+    command: bytes
+    argument: Optional[bytes]
+    payload: Optional[bytes]
+    framed: bool  # whether it was sent in the framed format
+    request_id: Optional[int] = None  # only in version 2 framed commands
+
+
+class ProtocolError(NamedTuple):
+    """Something that could not be parsed as a command, with a message for the client."""
+
+    message: bytes
+    request_id: Optional[int] = None
+
+
+def encode_command(uav_id: int, command: bytes, argument: bytes = b"", payload: bytes = b"",
+                   request_id: Optional[int] = None) -> bytes:
+    if request_id is None:
+        header = HEADER_V1.pack(MAGIC, 1, uav_id, len(command), len(argument), len(payload))
+    else:
+        header = HEADER.pack(MAGIC, VERSION, uav_id, len(command), len(argument), len(payload), request_id)
+    return header + command + argument + payload
+
+
+def encode_response(request_id: int, status: int, body: Dict[str, Any]) -> bytes:
+    data = json.dumps(body).encode("utf-8")
+    return RESPONSE_HEADER.pack(RESPONSE_MAGIC, VERSION, request_id, status, len(data)) + data
+
+
+def _format_id(uav_id: Union[int, bytes]) -> str:
+    # Drone IDs are two digits in the object registry, but clients may send a single digit.
+    uav_id = uav_id.decode("utf-8") if isinstance(uav_id, bytes) else str(uav_id)
+    return uav_id.zfill(2)
+
+
+class CommandParser:
+    """Reassembles commands from the chunks of bytes received on a TCP connection. Received data is appended to a
+    single buffer and every byte is looked at a bounded number of times, so large payloads and long bursts of
+    commands are parsed in linear time.
+    """
+
+    def __init__(self, commands: Mapping[bytes, Tuple[bool, bool]], max_payload_size: int = DEFAULT_MAX_PAYLOAD_SIZE):
+        # commands: command -> (takes_argument, takes_payload)
+        self._commands = commands
+        self._max_payload_size = max_payload_size
+        self._buffer = bytearray()
+        self._scan_from = 0  # where to continue looking for the end of a legacy command
+        self._discard = 0  # bytes of a rejected frame still to be skipped
+
+    def feed(self, data: bytes) -> List[Union[Command, ProtocolError]]:
+        # Adds the given data to the buffer and returns the commands (and errors) completed by it.
+        buffer = self._buffer
+        buffer.extend(data)
+        result: List[Union[Command, ProtocolError]] = []
+        offset = 0
+        while offset < len(buffer):
+            if self._discard:
+                skipped = min(self._discard, len(buffer) - offset)
+                self._discard -= skipped
+                offset += skipped
+                continue
+            if buffer[offset] in _WHITESPACE:
+                offset += 1
+                continue
+            view = memoryview(buffer)[offset:]
+            try:
+                if view[:len(MAGIC)] == MAGIC[:len(view)]:
+                    consumed, item = self._parse_framed(view)
+                elif view[:len(LEGACY_START)] == LEGACY_START[:len(view)]:
+                    consumed, item = self._parse_legacy(offset)
+                else:
+                    consumed, item = self._resync(offset), ProtocolError(b'Command is missing standard CMDSTART')
+            finally:
+                view.release()
+            if not consumed:
+                break  # incomplete, wait for more data
+            offset += consumed
+            if item is not None:
+                result.append(item)
+        if offset:
+            del buffer[:offset]
+            self._scan_from = max(self._scan_from - offset, 0)
+        return result
+
+    def _parse_framed(self, view: memoryview) -> Tuple[int, Optional[Union[Command, ProtocolError]]]:
+        if len(view) <= len(MAGIC):
+            return 0, None
+        version = view[len(MAGIC)]
+        if version == 1:
+            header, request_id = HEADER_V1, None
+            if len(view) < header.size:
+                return 0, None
+            _, _, uav_id, command_length, argument_length, payload_length = header.unpack_from(view)
+        elif version == 2:
+            header = HEADER
+            if len(view) < header.size:
+                return 0, None
+            _, _, uav_id, command_length, argument_length, payload_length, request_id = header.unpack_from(view)
+        else:
+            # We can't know the layout of the rest; drop the magic and look for the next command.
+            return len(MAGIC), ProtocolError(f"Unsupported protocol version: {version}".encode())
+        size = header.size + command_length + argument_length + payload_length
+        if payload_length > self._max_payload_size:
+            self._discard = size - header.size
+            return header.size, ProtocolError(b'Payload is too large', request_id)
+        if len(view) < size:
+            return 0, None
+        start = header.size
+        command = bytes(view[start:start + command_length])
+        start += command_length
+        argument = bytes(view[start:start + argument_length]) if argument_length else None
+        start += argument_length
+        payload = bytes(view[start:start + payload_length]) if payload_length else None
+        if command not in self._commands:
+            return size, ProtocolError(b'Command is not found in server side dictionary', request_id)
+        return size, Command(_format_id(uav_id), command, argument, payload, True, request_id)
+
+    def _parse_legacy(self, offset: int) -> Tuple[int, Optional[Union[Command, ProtocolError]]]:
+        buffer = self._buffer
+        end = buffer.find(LEGACY_END, max(offset, self._scan_from - len(LEGACY_END) + 1))
+        if end == -1:
+            self._scan_from = len(buffer)
+            return 0, None
+        self._scan_from = 0
+        consumed = end + len(LEGACY_END) - offset
+        fields = bytes(buffer[offset + len(LEGACY_START):end]).split(b'_', 2)
+        if len(fields) < 2 or not fields[0].isdigit():
+            return consumed, ProtocolError(b'Malformed command')
+        uav_id, command = fields[0], fields[1]
+        rest = fields[2] if len(fields) > 2 else None
+        if command not in self._commands:
+            return consumed, ProtocolError(b'Command is not found in server side dictionary')
+        takes_argument, takes_payload = self._commands[command]
+        argument = payload = None
+        if takes_argument:
+            if rest is None:
+                return consumed, ProtocolError(b'Command is missing its argument')
+            argument, _, rest = rest.partition(b'_')
+        if takes_payload:
+            payload = rest
+        return consumed, Command(_format_id(uav_id), command, argument, payload, False)
+
+    def _resync(self, offset: int) -> int:
+        # Skips garbage up to the next possible start of a command, and returns the number of bytes skipped.
+        buffer = self._buffer
+        candidates = [buffer.find(marker, offset + 1) for marker in (MAGIC, LEGACY_START)]
+        candidates = [index for index in candidates if index != -1]
+        if candidates:
+            return min(candidates) - offset
+        # Keep the tail if it may be the beginning of a marker that is not fully received yet
+        for start in range(max(offset + 1, len(buffer) - len(LEGACY_START) + 1), len(buffer)):
+            tail = buffer[start:]
+            if MAGIC.startswith(tail) or LEGACY_START.startswith(tail):
+                return start - offset
+        return len(buffer) - offset
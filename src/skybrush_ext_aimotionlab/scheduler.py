@@ -0,0 +1,156 @@
+from time import time
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+from trio import current_time, sleep
+from aiocflib.crazyflie.localization import (
+    GenericLocalizationCommand,
+    Localization,
+)
+
+__all__ = ("BroadcastScheduler",)
+
+Pose = Tuple[int, Any, Any]
+# (numeric ID, position, QuaternionXYZW), as expected by Localization.encode_external_pose_packed()
+
+POSES_PER_PACKET = 2
+
+
+class _ScheduledObject:
+    __slots__ = ("name", "priority", "min_period", "pose", "capture", "pending", "last_sent", "pass_value", "sent")
+
+    def __init__(self, name: str, priority: float, min_rate: Optional[float], pass_value: float):
+        self.name = name
+        self.priority = priority
+        self.min_period = 1.0 / min_rate if min_rate else None
+        self.pose: Optional[Pose] = None
+        self.capture: Optional[float] = None
+        self.pending = False  # whether we have a pose that was not broadcast yet
+        self.last_sent = 0.0
+        self.pass_value = pass_value  # stride scheduling: lower value goes first
+        self.sent = 0  # number of broadcasts since the last call to achieved_rates()
+
+
+class BroadcastScheduler:
+    """Sits between the mocap frame handler and the radio broadcast, and limits the number of external pose packets
+    sent per second. Only the latest pose of each object is kept. When the budget does not allow sending every pose,
+    objects take turns in proportion to their priority (stride scheduling), but objects with a minimum rate are always
+    served first once they are overdue.
+    """
+
+    def __init__(self, broadcast, port, channel, budget: float, priorities: Optional[Mapping[str, float]] = None,
+                 min_rates: Optional[Mapping[str, float]] = None, tick: float = 0.005):
+        # budget: maximum number of packets per second. priorities and min_rates are keyed by object name or class;
+        # a name takes precedence over a class.
+        if budget <= 0:
+            raise ValueError("Broadcast budget must be positive")
+        self._broadcast = broadcast
+        self._port = port
+        self._channel = channel
+        self._budget = float(budget)
+        self._priorities = dict(priorities or {})
+        self._min_rates = dict(min_rates or {})
+        self._tick = tick
+        # Number of packets that the broadcast function dropped instead of sending (see sharding.RadioSender)
+        self.dropped_packets = 0
+        # Called with (name, capture time, send time) for each broadcast pose whose capture time is known.
+        self.on_sent: Optional[Callable[[str, float, float], None]] = None
+        # Called with the names of the objects in a packet and the time of sending, right before sending; returns their
+        # positions extrapolated to that time (see PosePredictor.predict), which replace those of the submitted poses.
+        self.predict: Optional[Callable[[List[str], float], List[Any]]] = None
+        self._burst = max(1.0, self._budget * tick * 2)  # never save up more than two ticks' worth of packets
+        self._tokens = 0.0
+        self._virtual_time = 0.0  # pass value of the most recently served object
+        self._objects: Dict[str, _ScheduledObject] = {}
+        self._rates_since = 0.0
+
+    @classmethod
+    def from_configuration(cls, broadcast, port, channel, configuration) -> "BroadcastScheduler":
+        return cls(broadcast, port, channel, configuration["budget"], priorities=configuration.get("priorities"),
+                   min_rates=configuration.get("min_rates"))
+
+    def submit(self, name: str, cls: Optional[str], pose: Pose, capture: Optional[float] = None):
+        # Stores the latest pose of an object; it replaces any pose of the same object that was not sent yet.
+        obj = self._objects.get(name)
+        if obj is None:
+            obj = self._objects[name] = self._create_object(name, cls)
+        elif not obj.pending:
+            # An object that was idle for a while can't monopolize the radio to catch up with the others.
+            obj.pass_value = max(obj.pass_value, self._virtual_time)
+        obj.pose = pose
+        obj.capture = capture
+        obj.pending = True
+
+    def achieved_rates(self) -> Dict[str, float]:
+        # Returns the number of broadcasts per second of each object since the last call.
+        now = current_time()
+        elapsed = max(now - self._rates_since, 1e-9)
+        self._rates_since = now
+        result = {}
+        for name, obj in self._objects.items():
+            result[name] = obj.sent / elapsed
+            obj.sent = 0
+        return result
+
+    async def run(self):
+        last = self._rates_since = current_time()
+        while True:
+            await sleep(self._tick)
+            now = current_time()
+            self._tokens = min(self._burst, self._tokens + (now - last) * self._budget)
+            last = now
+            while self._tokens >= 1:
+                batch = self._select(now)
+                if not batch:
+                    break
+                self._send(batch)
+                self._tokens -= 1
+
+    def _create_object(self, name: str, cls: Optional[str]) -> _ScheduledObject:
+        priority = self._lookup(self._priorities, name, cls, 1.0)
+        min_rate = self._lookup(self._min_rates, name, cls, None)
+        return _ScheduledObject(name, max(float(priority), 1e-3), min_rate, self._virtual_time)
+
+    @staticmethod
+    def _lookup(table: Mapping[str, Any], name: str, cls: Optional[str], default):
+        if name in table:
+            return table[name]
+        if cls is not None and cls in table:
+            return table[cls]
+        return default
+
+    def _select(self, now: float) -> List[_ScheduledObject]:
+        pending = [obj for obj in self._objects.values() if obj.pending]
+        if len(pending) <= POSES_PER_PACKET:
+            return pending
+        # Objects that fell behind their minimum rate come first, most overdue first; the rest by stride order.
+        overdue = [
+            obj for obj in pending if obj.min_period is not None and now - obj.last_sent >= obj.min_period
+        ]
+        overdue.sort(key=lambda obj: obj.last_sent + obj.min_period)
+        batch = overdue[:POSES_PER_PACKET]
+        if len(batch) < POSES_PER_PACKET:
+            rest = sorted((obj for obj in pending if obj not in batch), key=lambda obj: obj.pass_value)
+            batch.extend(rest[:POSES_PER_PACKET - len(batch)])
+        return batch
+
+    def _send(self, batch: List[_ScheduledObject]):
+        now = current_time()
+        poses = [obj.pose for obj in batch]
+        if self.predict is not None:
+            positions = self.predict([obj.name for obj in batch], time())
+            poses = [(pose[0], position, pose[2]) for pose, position in zip(poses, positions)]
+        packet = bytes([GenericLocalizationCommand.EXT_POSE_PACKED]) + Localization.encode_external_pose_packed(poses)
+        dropped = self._broadcast(self._port, self._channel, packet) is False
+        if dropped:
+            self.dropped_packets += 1
+        sent_at = time()
+        self._virtual_time = max(self._virtual_time, min(obj.pass_value for obj in batch))
+        for obj in batch:
+            obj.pending = False
+            obj.last_sent = now
+            obj.pass_value += 1.0 / obj.priority
+            if dropped:
+                continue
+            obj.sent += 1
+            if self.on_sent is not None and obj.capture is not None:
+                self.on_sent(obj.name, obj.capture, sent_at)
@@ -0,0 +1,112 @@
+from itertools import count
+from typing import Dict, List, Mapping, Tuple, Union
+
+import trio
+
+from .protocol import (
+    Command,
+    CommandParser,
+    ProtocolError,
+    STATUS_ACCEPTED,
+    STATUS_FAILED,
+    STATUS_OK,
+    STATUS_PARTIAL,
+    STATUS_REJECTED,
+    encode_response,
+)
+
+__all__ = ("CommandSession",)
+
+_session_ids = count(1)
+
+ALL_DRONES = "00"
+
+
+class CommandSession:
+    """State of a single TCP client connection: the stream, the parser with its receive buffer, and the lock that
+    keeps replies from interleaving. Every connection has its own session, so several clients (e.g. a path planner
+    and a payload controller) can send commands at the same time without stepping on each other's data; state of the
+    drones themselves is shared by all sessions and protected by per-drone locks in the extension.
+
+    Commands of a session may be processed concurrently. The session keeps the commands sent to the same drone in the
+    order they were received: a command waits for the earlier commands of the session that target the same drone (or
+    all drones), see reserve().
+    """
+
+    def __init__(self, stream: trio.SocketStream, commands: Mapping[bytes, Tuple[bool, bool]]):
+        self.id = next(_session_ids)
+        self.stream = stream
+        self.parser = CommandParser(commands)
+        self._send_lock = trio.Lock()
+        self._last_commands: Dict[str, trio.Event] = {}  # target -> completion of the last command sent to it
+        try:
+            host, port, *_ = stream.socket.getpeername()
+            self.peer = f"{host}:{port}"
+        except (AttributeError, OSError, ValueError):
+            self.peer = "unknown"
+
+    def __str__(self) -> str:
+        return f"session {self.id} ({self.peer})"
+
+    async def send(self, message: bytes):
+        async with self._send_lock:
+            await self.stream.send_all(message)
+
+    def reserve(self, target: str) -> Tuple[List[trio.Event], trio.Event]:
+        # Takes the place of a new command sent to the given drone (or to all drones) in the order of the session.
+        # Returns the events to wait for before running the command, and the event to set when it is done.
+        done = trio.Event()
+        if target == ALL_DRONES:
+            after = list(self._last_commands.values())
+            self._last_commands = {ALL_DRONES: done}
+        else:
+            after = [event for event in (self._last_commands.get(target), self._last_commands.get(ALL_DRONES)) if
+                     event is not None]
+            self._last_commands[target] = done
+        return [event for event in after if not event.is_set()], done
+
+    async def acknowledge(self, command: Command):
+        if command.request_id is None:
+            await self.send(b'Command received: ' + command.command)
+        else:
+            await self.send(encode_response(command.request_id, STATUS_ACCEPTED,
+                                            {"command": command.command.decode("utf-8", errors="replace")}))
+
+    async def reject(self, request: Union[Command, ProtocolError], message: bytes):
+        if request.request_id is None:
+            await self.send(message)
+        else:
+            await self.send(encode_response(request.request_id, STATUS_REJECTED,
+                                            {"message": message.decode("utf-8", errors="replace")}))
+
+    async def respond(self, command: Command, results: Dict[str, Tuple[bool, bytes]], received_at: float,
+                      started_at: float):
+        # Sends the results of a command, per drone, to the client.
+        succeeded = sum(1 for success, _ in results.values() if success)
+        if command.request_id is None:
+            # Free text, as older clients expect it
+            if command.uav_id != ALL_DRONES:
+                await self.send(b'\n'.join(message for _, message in results.values()))
+                return
+            lines = [f"{ID}: ".encode() + message for ID, (_, message) in sorted(results.items())]
+            summary = f"Command {command.command.decode('utf-8')} succeeded on {succeeded}/{len(results)} drones"
+            await self.send(b'\n'.join([summary.encode()] + lines))
+            return
+        if results and succeeded == len(results):
+            status = STATUS_OK
+        elif succeeded:
+            status = STATUS_PARTIAL
+        else:
+            status = STATUS_FAILED
+        now = trio.current_time()
+        body = {
+            "command": command.command.decode("utf-8", errors="replace"),
+            "results": {
+                ID: {"success": success, "message": message.decode("utf-8", errors="replace")}
+                for ID, (success, message) in sorted(results.items())
+            },
+            # Seconds spent waiting for earlier commands, and in total since the command was received
+            "queued": started_at - received_at,
+            "elapsed": now - received_at,
+        }
+        await self.send(encode_response(command.request_id, status, body))
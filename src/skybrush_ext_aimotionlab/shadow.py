@@ -0,0 +1,114 @@
+from typing import Any, List, Tuple
+
+import numpy as np
+
+__all__ = ("MemoryShadow", "write_with_shadow")
+
+MERGE_GAP = 25
+# Changed byte ranges closer to each other than this are written in one go. A memory write request carries at most 25
+# bytes, so writing a few unchanged bytes in between is cheaper than starting a new request.
+
+
+class MemoryShadow:
+    """Server-side copy of the trajectory memory of a single drone, holding every byte we have written to (or read
+    from) it, along with a mask of the bytes that are known. It lets us decide locally whether a trajectory is already
+    on the drone, and which byte ranges of it have to be rewritten when it changed.
+
+    Like TrajectorySlots, a shadow belongs to a single Crazyflie connection: the memory of the drone is lost when it
+    reboots, which means that it reconnects as well.
+    """
+
+    def __init__(self, connection: Any, size: int = 4096):
+        self.connection = connection
+        self._image = np.zeros(size, dtype=np.uint8)
+        self._known = np.zeros(size, dtype=bool)
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+
+    def _ensure_size(self, end: int):
+        if end > len(self._image):
+            size = max(end, 2 * len(self._image))
+            self._image = np.concatenate((self._image, np.zeros(size - len(self._image), dtype=np.uint8)))
+            self._known = np.concatenate((self._known, np.zeros(size - len(self._known), dtype=bool)))
+
+    def invalidate(self):
+        # Forgets everything, e.g. after a failed write, when we don't know what made it to the drone.
+        self._known[:] = False
+
+    def is_known(self, addr: int, length: int) -> bool:
+        end = addr + length
+        self._ensure_size(end)
+        return bool(self._known[addr:end].all())
+
+    def matches(self, addr: int, data: bytes) -> bool:
+        # Whether the given data is known to be at the given address.
+        end = addr + len(data)
+        self._ensure_size(end)
+        return bool(
+            self._known[addr:end].all() and (self._image[addr:end] == np.frombuffer(data, dtype=np.uint8)).all()
+        )
+
+    def diff(self, addr: int, data: bytes) -> List[Tuple[int, bytes]]:
+        # Returns the (address, data) ranges that have to be written so that the given data ends up at the given
+        # address: the bytes that differ from the shadow or are not known.
+        end = addr + len(data)
+        self._ensure_size(end)
+        new = np.frombuffer(data, dtype=np.uint8)
+        changed = ~self._known[addr:end] | (self._image[addr:end] != new)
+        if not changed.any():
+            return []
+        # Start and end offsets of the runs of changed bytes, then merge runs separated by short gaps
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], changed, [False])).astype(np.int8)))
+        starts, ends = edges[0::2], edges[1::2]
+        keep = np.concatenate(([True], starts[1:] - ends[:-1] > MERGE_GAP))
+        starts = starts[keep]
+        ends = ends[np.concatenate((keep[1:], [True]))]
+        return [(addr + int(start), data[start:stop]) for start, stop in zip(starts, ends)]
+
+    def update(self, addr: int, data: bytes):
+        # Records that the given data is now at the given address.
+        end = addr + len(data)
+        self._ensure_size(end)
+        self._image[addr:end] = np.frombuffer(data, dtype=np.uint8)
+        self._known[addr:end] = True
+
+
+async def write_with_shadow(handler, shadow: MemoryShadow, addr: int, data: bytes, checksum: bytes) -> int:
+    """Counterpart of ``aiocflib.crazyflie.mem.write_with_checksum()`` that keeps the given shadow up to date and
+    uses it to skip the write altogether when the data is already on the drone, or to write only the changed byte
+    ranges of the data otherwise. The memory layout is the same: the checksum, followed by the data.
+
+    Returns:
+        the number of checksum bytes to skip to get to the data
+    """
+    checksum_length = len(checksum)
+    data_addr = addr + checksum_length
+    if shadow.matches(addr, checksum) and shadow.matches(data_addr, data):
+        shadow.bytes_skipped += len(data)
+        return checksum_length
+
+    if not shadow.is_known(addr, checksum_length):
+        # We know nothing about this memory yet (e.g. the drone was just connected), but the drone may still hold this
+        # very data from an earlier upload: the checksum tells.
+        observed = bytes(await handler.read(addr, checksum_length))
+        shadow.update(addr, observed)
+        if observed == checksum:
+            shadow.update(data_addr, data)
+            shadow.bytes_skipped += len(data)
+            return checksum_length
+
+    try:
+        # Clear the checksum first so an interrupted write can't leave valid-looking data behind
+        zeros = bytes(checksum_length)
+        await handler.write(addr, zeros)
+        shadow.update(addr, zeros)
+        for start, chunk in shadow.diff(data_addr, data):
+            await handler.write(start, chunk)
+            shadow.update(start, chunk)
+            shadow.bytes_written += len(chunk)
+        await handler.write(addr, checksum)
+        shadow.update(addr, checksum)
+    except BaseException:
+        shadow.invalidate()
+        raise
+    return checksum_length
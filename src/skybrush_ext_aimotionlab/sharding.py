@@ -0,0 +1,123 @@
+from contextlib import AsyncExitStack
+from fnmatch import fnmatchcase
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from flockwave.server.utils import chunks
+from aiocflib.crazyflie.localization import (
+    GenericLocalizationCommand,
+    Localization,
+)
+from trio import Nursery, WouldBlock, open_memory_channel
+
+from .scheduler import BroadcastScheduler
+
+__all__ = ("BroadcastShard", "create_broadcast_shards")
+
+Broadcaster = Callable[[Any, Any, bytes], Optional[bool]]
+# Function with the same signature as the broadcast() API of the crazyflie extension: (port, channel, packet). May
+# return False if the packet was dropped instead of being sent.
+
+RADIO_QUEUE_SIZE = 32
+# Packets waiting to be sent on a dedicated radio; packets arriving when the queue is full (e.g. because the dongle is
+# slow or stuck) are dropped.
+
+
+class BroadcastShard:
+    """A single radio (or CRTP port/channel) that external poses are broadcast on, together with the objects that the
+    drones listening on that radio need. Objects are selected by fnmatch-style patterns on their name or by their
+    class; a shard without patterns takes every object that is not claimed by another shard.
+    """
+
+    def __init__(self, name: str, broadcast: Broadcaster, port, channel, patterns: Optional[Sequence[str]] = None,
+                 scheduler: Optional[BroadcastScheduler] = None, scheduler_report_interval: float = 0):
+        self.name = name
+        self.port = port
+        self.channel = channel
+        self.patterns = list(patterns) if patterns is not None else None
+        self.scheduler = scheduler
+        self.scheduler_report_interval = scheduler_report_interval  # seconds between logs of achieved rates
+        self._broadcast = broadcast
+
+    @property
+    def is_catch_all(self) -> bool:
+        return self.patterns is None
+
+    def matches(self, name: str, cls: Optional[str]) -> bool:
+        if self.patterns is None:
+            return False
+        return any(pattern == cls or fnmatchcase(name, pattern) for pattern in self.patterns)
+
+    def send(self, poses: List[Tuple[int, Any, Any]]):
+        # Broadcasts the given poses right away, two poses per packet.
+        for chunk in chunks(poses, 2):
+            packet = bytes(
+                [GenericLocalizationCommand.EXT_POSE_PACKED]
+            ) + Localization.encode_external_pose_packed(chunk)
+            self._broadcast(self.port, self.channel, packet)
+
+
+def assign_shards(shards: Sequence[BroadcastShard], name: str, cls: Optional[str]) -> List[BroadcastShard]:
+    # Returns the shards that the object with the given name and class must be broadcast on.
+    result = [shard for shard in shards if shard.matches(name, cls)]
+    return result or [shard for shard in shards if shard.is_catch_all]
+
+
+async def create_broadcast_shards(configuration: Dict[str, Any], broadcast: Broadcaster, nursery: Nursery,
+                                  stack: AsyncExitStack) -> List[BroadcastShard]:
+    # Creates the shards described in the 'radios' section of the configuration. Each entry may have a 'uri' (the
+    # URI prefix of a Crazyradio, e.g. crazyradio://1/90/2M, in which case a dedicated broadcaster is opened on that
+    # radio), 'port' and 'channel' (default: the top-level ones), 'objects' (patterns of object names or classes;
+    # omit for a catch-all shard) and 'broadcast_scheduler' (default: the top-level one). Without a 'radios' section,
+    # there is a single catch-all shard that uses the broadcast API of the crazyflie extension.
+    port = configuration.get("port")
+    channel = configuration.get("channel")
+    default_scheduler_config = configuration.get("broadcast_scheduler")
+    radios = configuration.get("radios") or [{}]
+
+    shards = []
+    for index, radio in enumerate(radios):
+        uri = radio.get("uri")
+        if uri:
+            from aiocflib.crtp.broadcaster import Broadcaster as RadioBroadcaster
+
+            radio_broadcaster = await stack.enter_async_context(RadioBroadcaster(uri))
+            sender = RadioSender(radio_broadcaster)
+            nursery.start_soon(sender.run)
+            shard_broadcast = sender.send
+        else:
+            shard_broadcast = broadcast
+        shard_port = radio.get("port", port)
+        shard_channel = radio.get("channel", channel)
+        scheduler_config = radio.get("broadcast_scheduler", default_scheduler_config)
+        scheduler = None
+        report_interval = 0
+        if scheduler_config:
+            scheduler = BroadcastScheduler.from_configuration(shard_broadcast, shard_port, shard_channel,
+                                                              scheduler_config)
+            report_interval = scheduler_config.get("report_interval", 0)
+        shards.append(BroadcastShard(uri or f"radio {index}", shard_broadcast, shard_port, shard_channel,
+                                     radio.get("objects"), scheduler, report_interval))
+    return shards
+
+
+class RadioSender:
+    """Sends the packets broadcast on a dedicated radio one after the other, from a single task, through a bounded
+    queue. The event loop never waits for the radio; when the queue is full, packets are dropped and counted.
+    """
+
+    def __init__(self, broadcaster, queue_size: int = RADIO_QUEUE_SIZE):
+        self._broadcaster = broadcaster
+        self._queue_tx, self._queue_rx = open_memory_channel(queue_size)
+        self.dropped = 0
+
+    def send(self, port, channel, packet: bytes) -> bool:
+        try:
+            self._queue_tx.send_nowait((port, channel, packet))
+        except WouldBlock:
+            self.dropped += 1
+            return False
+        return True
+
+    async def run(self):
+        async for port, channel, packet in self._queue_rx:
+            await self._broadcaster.send_packet(port=port, channel=channel, data=packet)
@@ -0,0 +1,86 @@
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+__all__ = ("fit_trajectory", "simplify_points")
+
+SEARCH_STEPS = 12
+# Number of bisection steps when looking for the smallest tolerance that makes a trajectory fit.
+
+
+def simplify_points(times: np.ndarray, positions: np.ndarray, tolerance: float,
+                    fixed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, float]:
+    """Time-synchronized Ramer-Douglas-Peucker simplification of a piecewise linear trajectory.
+
+    A point may be dropped if the straight segment between the points kept around it passes within the given
+    tolerance of where the trajectory was at the time of the dropped point. Points marked in fixed (and the first and
+    last point) are always kept.
+
+    Returns:
+        the boolean mask of the kept points, and the largest distance of a dropped point from the simplified
+        trajectory at its own time
+    """
+    n = len(times)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, n - 1]] = True
+    if fixed is not None:
+        keep |= fixed
+    error = 0.0
+    anchors = np.flatnonzero(keep)
+    stack = [(int(start), int(end)) for start, end in zip(anchors[:-1], anchors[1:]) if end - start > 1]
+    while stack:
+        start, end = stack.pop()
+        t = times[start + 1:end]
+        span = times[end] - times[start]
+        ratio = (t - times[start]) / span if span > 0 else np.zeros_like(t)
+        expected = positions[start] + ratio[:, None] * (positions[end] - positions[start])
+        distances = np.linalg.norm(positions[start + 1:end] - expected, axis=1)
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            split = start + 1 + index
+            keep[split] = True
+            if split - start > 1:
+                stack.append((start, split))
+            if end - split > 1:
+                stack.append((split, end))
+        else:
+            error = max(error, float(distances[index]))
+    return keep, error
+
+
+def fit_trajectory(data: Dict[str, Any], encode: Callable[[Dict[str, Any]], bytes], max_size: int,
+                   max_error: float) -> Optional[Tuple[Dict[str, Any], bytes, float]]:
+    """Removes as few points of a trajectory (in its JSON representation) as needed to make its encoded form at most
+    max_size bytes long, without moving it by more than max_error anywhere.
+
+    Only straight segments are simplified; points with control points and the points before them are kept.
+
+    Returns:
+        the simplified trajectory, its encoded form and the achieved error, or None if it can't be made to fit
+    """
+    points = data["points"]
+    if len(points) < 3:
+        return None
+    times = np.array([point[0] for point in points], dtype=float)
+    positions = np.array([point[1] for point in points], dtype=float).reshape(-1, 3)
+    curved = np.array([bool(point[2]) for point in points])
+    fixed = curved | np.append(curved[1:], False)
+
+    def attempt(tolerance: float):
+        keep, error = simplify_points(times, positions, tolerance, fixed)
+        simplified = dict(data, points=[point for point, kept in zip(points, keep.tolist()) if kept])
+        return simplified, encode(simplified), error
+
+    best = attempt(max_error)
+    if len(best[1]) > max_size:
+        return None
+    # Look for the smallest tolerance that still fits: fewer dropped points mean a more faithful trajectory.
+    low, high = 0.0, max_error
+    for _ in range(SEARCH_STEPS):
+        middle = (low + high) / 2
+        candidate = attempt(middle)
+        if len(candidate[1]) <= max_size:
+            best, high = candidate, middle
+        else:
+            low = middle
+    return best
@@ -0,0 +1,149 @@
+from typing import Any, List, Optional, Tuple
+
+import trio
+from aiocflib.crtp.crtpstack import MemoryType
+
+__all__ = ("RadioModel", "SimulatedCrazyflie", "SimulatedCrazyflieUAV")
+
+WRITE_CHUNK_SIZE = 25
+# Data bytes carried by a single memory write request (aiocflib's MAX_WRITE_REQUEST_LENGTH)
+READ_CHUNK_SIZE = 20
+# Data bytes carried by a single memory read response
+PACKET_OVERHEAD = 6
+# Bytes of a memory request besides the data: CRTP header, memory ID and address
+
+
+class RadioModel:
+    """Timing model of a single Crazyradio, shared by all the simulated drones on it. The radio carries one packet at
+    a time; a packet takes a fixed round trip latency plus its size divided by the bandwidth.
+    """
+
+    def __init__(self, name: str = "radio://0", latency: float = 0.001, bandwidth: float = 250000.0):
+        self.name = name
+        self.latency = latency  # seconds per packet, including the acknowledgement
+        self.bandwidth = bandwidth  # bytes per second, 0 means unlimited
+        self.packets = 0
+        self.bytes = 0
+        self.busy_time = 0.0
+        self._lock = trio.Lock()
+
+    async def transfer(self, size: int):
+        # Waits until a packet of the given size went through the radio.
+        duration = self.latency + (size / self.bandwidth if self.bandwidth > 0 else 0.0)
+        async with self._lock:
+            await trio.sleep(duration)
+            self.packets += 1
+            self.bytes += size
+            self.busy_time += duration
+
+
+class SimulatedTrajectoryMemory:
+    # Stand-in for the trajectory memory handler of aiocflib: reads and writes are split into radio packets.
+
+    def __init__(self, radio: RadioModel, size: int = 4096):
+        self._radio = radio
+        self._data = bytearray(size)
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    @property
+    def data(self) -> bytes:
+        return bytes(self._data)
+
+    def _check_range(self, addr: int, length: int):
+        if addr < 0 or addr + length > len(self._data):
+            raise ValueError(f"Memory access at {addr}+{length} is outside of the {len(self._data)} byte memory")
+
+    async def read(self, addr: int, length: int) -> bytes:
+        self._check_range(addr, length)
+        for offset in range(0, length, READ_CHUNK_SIZE):
+            await self._radio.transfer(min(READ_CHUNK_SIZE, length - offset) + PACKET_OVERHEAD)
+        self.bytes_read += length
+        return bytes(self._data[addr:addr + length])
+
+    async def write(self, addr: int, data: bytes):
+        # Chunks land one by one, so an interrupted write leaves partial data behind, like on the real drone.
+        self._check_range(addr, len(data))
+        for offset in range(0, len(data), WRITE_CHUNK_SIZE):
+            chunk = data[offset:offset + WRITE_CHUNK_SIZE]
+            await self._radio.transfer(len(chunk) + PACKET_OVERHEAD)
+            self._data[addr + offset:addr + offset + len(chunk)] = chunk
+            self.bytes_written += len(chunk)
+
+
+class SimulatedMemoryDirectory:
+    def __init__(self, trajectory_memory: SimulatedTrajectoryMemory):
+        self._trajectory_memory = trajectory_memory
+
+    async def find(self, memory_type) -> SimulatedTrajectoryMemory:
+        if memory_type != MemoryType.TRAJECTORY:
+            raise ValueError(f"No memory of type {memory_type!r}")
+        return self._trajectory_memory
+
+
+class SimulatedHighLevelCommander:
+    def __init__(self, crazyflie: "SimulatedCrazyflie"):
+        self._crazyflie = crazyflie
+        self.trajectories = {}  # trajectory ID -> (address, type)
+
+    async def define_trajectory(self, id: int, addr: int, type: Any = None, **kwargs):
+        await self._crazyflie.radio.transfer(PACKET_OVERHEAD + 6)
+        self.trajectories[id] = (addr, type)
+        self._crazyflie.record("define", id, addr)
+
+    async def start_trajectory(self, id: int, time_scale: float = 1.0, relative: bool = False,
+                               reversed: bool = False, **kwargs):
+        await self._crazyflie.radio.transfer(PACKET_OVERHEAD + 7)
+        if id not in self.trajectories:
+            raise RuntimeError(f"Trajectory {id} is not defined")
+        self._crazyflie.record("start", id, self.trajectories[id][0])
+
+
+class SimulatedCrazyflie:
+    """Stand-in for an aiocflib Crazyflie connection: a trajectory memory and a high level commander whose radio
+    traffic goes through the given radio model. Everything the drone does is recorded in `events` as (time, kind,
+    trajectory ID, address) tuples, in trio time.
+    """
+
+    def __init__(self, radio: RadioModel, memory_size: int = 4096):
+        self.radio = radio
+        self.trajectory_memory = SimulatedTrajectoryMemory(radio, memory_size)
+        self.mem = SimulatedMemoryDirectory(self.trajectory_memory)
+        self.high_level_commander = SimulatedHighLevelCommander(self)
+        self.events: List[Tuple[float, str, Optional[int], Optional[int]]] = []
+
+    def record(self, kind: str, id: Optional[int] = None, addr: Optional[int] = None):
+        self.events.append((trio.current_time(), kind, id, addr))
+
+
+class SimulatedCrazyflieUAV:
+    """Stand-in for a CrazyflieUAV of the crazyflie extension, for load tests without drones. It has the attributes
+    and methods used by the aimotionlab extension only; it is not an instance of CrazyflieUAV.
+    """
+
+    def __init__(self, id: str, uri: str, radio: RadioModel, memory_size: int = 4096):
+        self.id = id
+        self.uri = uri
+        self.radio = radio
+        self.is_running_show = False
+        self._airborne = False
+        self._memory_size = memory_size
+        self._crazyflie = SimulatedCrazyflie(radio, memory_size)
+
+    def _get_crazyflie(self) -> SimulatedCrazyflie:
+        return self._crazyflie
+
+    def reconnect(self):
+        # Simulates a reboot: a new connection object with empty memory and no trajectories.
+        self._crazyflie = SimulatedCrazyflie(self.radio, self._memory_size)
+        self._airborne = False
+
+    async def takeoff(self, altitude: float = 1.0, **kwargs):
+        await self.radio.transfer(PACKET_OVERHEAD + 9)
+        self._airborne = True
+        self._crazyflie.record("takeoff")
+
+    async def land(self, **kwargs):
+        await self.radio.transfer(PACKET_OVERHEAD + 9)
+        self._airborne = False
+        self._crazyflie.record("land")
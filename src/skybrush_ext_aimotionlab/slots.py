@@ -0,0 +1,54 @@
+from typing import Any, Optional, Sequence, Tuple
+
+__all__ = ("TrajectorySlots",)
+
+DEFAULT_SLOTS = (2, 3)
+# Trajectory IDs that are used as A/B buffers for uploaded trajectories; ID 1 is reserved for hover.
+
+
+class TrajectorySlots:
+    """Per-drone state of the A/B trajectory buffers. One slot holds the trajectory that the drone is flying (or has
+    flown last); new trajectories are prepared in the other one, so uploading never touches the memory of the
+    trajectory in flight. A prepared trajectory becomes the active one when it is committed. Trajectories that are
+    already stored elsewhere on the drone (see TrajectoryLibrary) can be prepared and committed as well; they leave
+    the A/B slots alone.
+
+    The state belongs to a single Crazyflie connection: trajectories defined on the drone are lost when it reconnects.
+    """
+
+    def __init__(self, connection: Any, slots: Sequence[int] = DEFAULT_SLOTS):
+        if len(slots) < 2:
+            raise ValueError("At least two trajectory slots are needed")
+        self.connection = connection
+        self._slots = tuple(slots)
+        self._active_index = 0
+        self.prepared: Optional[Tuple[int, bool]] = None  # (trajectory ID, relative) waiting to be committed
+        self.playing: Optional[int] = None  # trajectory ID that was committed last
+
+    @property
+    def active(self) -> int:
+        return self._slots[self._active_index]
+
+    @property
+    def inactive(self) -> int:
+        return self._slots[(self._active_index + 1) % len(self._slots)]
+
+    def begin_prepare(self) -> int:
+        # Returns the trajectory ID to upload to. Any previously prepared trajectory is discarded, since it lives in the
+        # very slot that is about to be overwritten.
+        self.prepared = None
+        return self.inactive
+
+    def finish_prepare(self, traj_id: int, relative: bool):
+        self.prepared = (traj_id, relative)
+
+    def commit(self) -> Optional[Tuple[int, bool]]:
+        # Makes the prepared trajectory the active one and returns it, or returns None if nothing was prepared.
+        prepared = self.prepared
+        if prepared is None:
+            return None
+        if prepared[0] in self._slots:
+            self._active_index = self._slots.index(prepared[0])
+        self.playing = prepared[0]
+        self.prepared = None
+        return prepared
@@ -0,0 +1,130 @@
+import os
+from collections import OrderedDict
+from hashlib import blake2b
+from struct import pack
+from threading import Lock
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from aiocflib.utils.checksum import crc32
+from flockwave.server.ext.crazyflie.trajectory import encode_trajectory, TrajectoryEncoding
+from flockwave.server.show.trajectory import TrajectorySpecification
+
+from .simplify import fit_trajectory
+from .trajectory_format import parse_trajectory
+
+__all__ = ("EncodedTrajectory", "TrajectoryCache")
+
+DEFAULT_CACHE_SIZE = 64
+
+
+class EncodedTrajectory(NamedTuple):
+    """A trajectory in the compressed format understood by the Crazyflie, ready to be written to its memory."""
+
+    key: bytes  # hash of the payload the trajectory was encoded from
+    data: bytes
+    checksum: bytes  # crc32 of data, as written in front of it by write_with_checksum()
+    error: float = 0.0  # largest deviation from the original trajectory if it had to be simplified, see fit()
+
+
+# Cached in place of a simplified trajectory when the payload can't be made to fit, so that retrying the same
+# oversized trajectory doesn't run the simplification again
+_UNFITTABLE = EncodedTrajectory(b"", b"", b"", float("inf"))
+
+
+class TrajectoryCache:
+    """Least-recently-used cache of encoded trajectories, keyed by a hash of the raw payload they were encoded
+    from. The same trajectory is often sent several times or to several drones; with the cache, it is only parsed and
+    encoded once. The cache is shared by every drone and every TCP connection, and it may be used from worker threads;
+    parsing and encoding happen outside of its lock.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE):
+        if max_size < 1:
+            raise ValueError("Trajectory cache must hold at least one entry")
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[bytes, EncodedTrajectory]" = OrderedDict()
+        self._files: Dict[str, Tuple[Tuple[int, int], bytes]] = {}  # path -> ((mtime, size), payload key)
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key_of(payload: bytes) -> bytes:
+        return blake2b(payload, digest_size=16).digest()
+
+    def encode(self, payload: bytes) -> EncodedTrajectory:
+        # Returns the encoded form of the given trajectory payload (JSON or binary, see trajectory_format), encoding it
+        # only if it is not cached yet.
+        key = self.key_of(payload)
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry
+        data = _encode(parse_trajectory(payload))
+        return self._store(EncodedTrajectory(key, data, crc32(data)))
+
+    def fit(self, payload: bytes, max_size: int, max_error: float) -> Optional[EncodedTrajectory]:
+        # Returns the encoded form of the given trajectory payload, simplified if needed so that the encoded form and
+        # its checksum take at most max_size bytes, without deviating from the original by more than max_error
+        # meters. Returns None if that's not possible.
+        entry = self.encode(payload)
+        if len(entry.data) + len(entry.checksum) <= max_size:
+            return entry
+        if max_error <= 0:
+            return None
+        key = self.key_of(payload + pack("<Id", max_size, max_error))
+        fitted = self._lookup(key)
+        if fitted is not None:
+            return None if fitted is _UNFITTABLE else fitted
+        result = fit_trajectory(parse_trajectory(payload), _encode, max_size - len(entry.checksum), max_error)
+        if result is None:
+            self._store(_UNFITTABLE, key)
+            return None
+        _, data, error = result
+        return self._store(EncodedTrajectory(key, data, crc32(data), error))
+
+    def encode_file(self, path: str) -> EncodedTrajectory:
+        # Same as encode() for the contents of a file; the file is only read again when it was modified.
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            known = self._files.get(path)
+        if known is not None and known[0] == version:
+            entry = self._lookup(known[1], count_miss=False)
+            if entry is not None:
+                return entry
+        with open(path, "rb") as fp:
+            entry = self.encode(fp.read())
+        with self._lock:
+            self._files[path] = (version, entry.key)
+        return entry
+
+    def format_stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.0
+        return f"{len(self._entries)} entries, {self.hits} hits, {self.misses} misses ({ratio:.0%} hit ratio)"
+
+    def _lookup(self, key: bytes, count_miss: bool = True) -> Optional[EncodedTrajectory]:
+        # count_miss=False when the caller falls back to another lookup that counts the miss itself
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def _store(self, entry: EncodedTrajectory, key: Optional[bytes] = None) -> EncodedTrajectory:
+        with self._lock:
+            self._entries[entry.key if key is None else key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+
+def _encode(data) -> bytes:
+    return encode_trajectory(TrajectorySpecification(data), encoding=TrajectoryEncoding.COMPRESSED)
@@ -0,0 +1,79 @@
+"""Payload formats of the trajectories sent with the traj, prepare and store commands.
+
+Besides the JSON format of Skybrush trajectories (``{"version": 1, "points": [[t, [x, y, z], [control points]],
+...], "takeoffTime": ..., "landingTime": ...}``), a compact binary format is accepted. It starts with a header: the
+magic bytes ``AITR``, the format version (uint8), a reserved byte, the number of points (uint16), the total number of
+control points (uint16), then the takeoff and landing times (float32), all little-endian. The header is followed by
+the points as float32 ``(t, x, y, z)`` quadruples, the number of control points of each point (uint16), and finally
+the control points as float32 ``(x, y, z)`` triplets, in the order of the points they belong to.
+
+Binary payloads may contain any byte sequence, so they must be sent in the framed command format; the legacy format
+would cut them at the first ``_EOF``. Client.py mirrors the binary layout; keep the two in sync.
+"""
+
+import json
+from struct import Struct
+from typing import Any, Dict, Union
+
+import numpy as np
+
+__all__ = ("BINARY_TRAJECTORY_MAGIC", "decode_binary_trajectory", "encode_binary_trajectory", "parse_trajectory")
+
+BINARY_TRAJECTORY_MAGIC = b"AITR"
+BINARY_TRAJECTORY_VERSION = 1
+
+_HEADER = Struct("<4sBxHHff")
+
+
+def encode_binary_trajectory(data: Dict[str, Any]) -> bytes:
+    # Converts a trajectory from its JSON representation into the binary format.
+    points = data["points"]
+    header_points = np.array([[point[0], *point[1]] for point in points], dtype="<f4").reshape(-1, 4)
+    counts = np.array([len(point[2]) for point in points], dtype="<u2")
+    controls = np.array([control for point in points for control in point[2]], dtype="<f4").reshape(-1, 3)
+    header = _HEADER.pack(BINARY_TRAJECTORY_MAGIC, BINARY_TRAJECTORY_VERSION, len(points), len(controls),
+                          data.get("takeoffTime", 0.0), data.get("landingTime", 0.0))
+    return header + header_points.tobytes() + counts.tobytes() + controls.tobytes()
+
+
+def decode_binary_trajectory(payload: Union[bytes, memoryview]) -> Dict[str, Any]:
+    # Converts a trajectory in the binary format into the JSON representation expected by TrajectorySpecification.
+    # The arrays are read in place and turned into Python lists in one go, per array.
+    magic, version, num_points, num_controls, takeoff_time, landing_time = _HEADER.unpack_from(payload, 0)
+    if magic != BINARY_TRAJECTORY_MAGIC:
+        raise ValueError("Not a binary trajectory")
+    if version != BINARY_TRAJECTORY_VERSION:
+        raise ValueError(f"Unsupported binary trajectory version: {version}")
+    offset = _HEADER.size
+    size = offset + num_points * 16 + num_points * 2 + num_controls * 12
+    if len(payload) != size:
+        raise ValueError(f"Binary trajectory should be {size} bytes long, got {len(payload)}")
+    points = np.frombuffer(payload, dtype="<f4", count=num_points * 4, offset=offset).reshape(-1, 4)
+    offset += points.nbytes
+    counts = np.frombuffer(payload, dtype="<u2", count=num_points, offset=offset)
+    offset += counts.nbytes
+    if int(counts.sum()) != num_controls:
+        raise ValueError("Control point counts of binary trajectory don't add up")
+    controls = np.frombuffer(payload, dtype="<f4", count=num_controls * 3, offset=offset).reshape(-1, 3).tolist()
+
+    times = points[:, 0].tolist()
+    positions = points[:, 1:].tolist()
+    if num_controls:
+        ends = np.cumsum(counts).tolist()
+        starts = [0] + ends[:-1]
+        result = [[t, position, controls[start:end]] for t, position, start, end in zip(times, positions, starts, ends)]
+    else:
+        result = [[t, position, []] for t, position in zip(times, positions)]
+    return {
+        "version": 1,
+        "points": result,
+        "takeoffTime": takeoff_time,
+        "landingTime": landing_time,
+    }
+
+
+def parse_trajectory(payload: bytes) -> Dict[str, Any]:
+    # Returns the JSON representation of a trajectory payload in either format.
+    if payload[:len(BINARY_TRAJECTORY_MAGIC)] == BINARY_TRAJECTORY_MAGIC:
+        return decode_binary_trajectory(payload)
+    return json.loads(payload.decode("utf-8"))
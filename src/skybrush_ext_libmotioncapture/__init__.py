@@ -23,6 +23,7 @@ schema = {
                             "qualisys",
                             "nokov",
                             "vrpn",
+                            "replay",
                         ],
                         "default": "optitrack",
                     },
@@ -32,8 +33,170 @@ schema = {
                         "type": "string",
                         "default": "localhost",
                     },
+                    "format": {
+                        "title": "Wire format",
+                        "description": (
+                            "Format in which the driver process sends frames to "
+                            "the server. The binary format is considerably "
+                            "cheaper to encode and decode at high frame rates."
+                        ),
+                        "enum": ["json", "binary"],
+                        "default": "json",
+                    },
+                    "transport": {
+                        "title": "Frame transport",
+                        "description": (
+                            "How frames are passed from the driver process to "
+                            "the server. 'shm' uses a shared memory buffer from "
+                            "which only the newest frame is read at the configured "
+                            "frame rate; it implies the binary format. 'thread' "
+                            "runs libmotioncapture in a worker thread of the "
+                            "server instead of a driver process and also reads "
+                            "only the newest frame at the configured frame rate; "
+                            "it starts and reconnects faster."
+                        ),
+                        "enum": ["pipe", "shm", "thread"],
+                        "default": "pipe",
+                    },
+                    "rate": {
+                        "title": "Target output rate",
+                        "description": (
+                            "Maximum number of frames per second that the driver "
+                            "process forwards to the server; excess frames are "
+                            "dropped before they are encoded"
+                        ),
+                        "type": "number",
+                        "minimum": 0,
+                    },
+                    "drop_policy": {
+                        "title": "Frame drop policy",
+                        "description": (
+                            "'latest' forwards the newest frame at the target "
+                            "rate, 'decimate' forwards every N-th frame. Defaults "
+                            "to 'latest' when a target rate is given."
+                        ),
+                        "enum": ["none", "latest", "decimate"],
+                    },
+                    "decimation": {
+                        "title": "Decimation factor",
+                        "description": "Forward every N-th frame with the 'decimate' policy",
+                        "type": "integer",
+                        "minimum": 1,
+                    },
+                    "record": {
+                        "title": "Record to",
+                        "description": (
+                            "Path of a log file to record every decoded frame "
+                            "into, with the timestamps of the mocap system. "
+                            "strftime() placeholders (e.g. %Y%m%d-%H%M%S) are "
+                            "expanded; existing files are never overwritten."
+                        ),
+                        "type": "string",
+                    },
+                    "path": {
+                        "title": "Log file",
+                        "description": "Recorded log file to play back with the 'replay' type",
+                        "type": "string",
+                    },
+                    "speed": {
+                        "title": "Replay speed",
+                        "description": (
+                            "Playback speed of the 'replay' type relative to the "
+                            "recording; zero plays back frames as fast as possible"
+                        ),
+                        "type": "number",
+                        "minimum": 0,
+                        "default": 1,
+                    },
+                    "loop": {
+                        "title": "Loop replay",
+                        "description": "Start over at the end of the log with the 'replay' type",
+                        "type": "boolean",
+                        "default": False,
+                    },
+                    "start": {
+                        "title": "Replay start",
+                        "description": "Seconds to skip from the start of the log with the 'replay' type",
+                        "type": "number",
+                        "minimum": 0,
+                        "default": 0,
+                    },
+                    "priority": {
+                        "title": "Merge priority",
+                        "description": (
+                            "Priority of the poses from this connection when the "
+                            "frames of multiple connections are merged with the "
+                            "'priority' policy"
+                        ),
+                        "type": "number",
+                        "default": 0,
+                    },
+                    "clock_offset": {
+                        "title": "Clock offset",
+                        "description": (
+                            "Seconds to add to the capture timestamps of this "
+                            "connection to get the time of the server when the "
+                            "frames of multiple connections are merged. Estimated "
+                            "from the arrival times of the frames if omitted."
+                        ),
+                        "type": "number",
+                    },
                 },
             },
-        }
+        },
+        "merge": {
+            "title": "Merge connections",
+            "description": (
+                "Merge the frames of multiple connections into a single frame per "
+                "tick of the frame rate instead of passing on the frames of each "
+                "connection separately"
+            ),
+            "type": "boolean",
+            "default": True,
+        },
+        "merge_policy": {
+            "title": "Merge policy",
+            "description": (
+                "How to choose between the poses of a rigid body seen by more than "
+                "one connection. 'freshest' takes the pose with the most recent "
+                "capture time, 'priority' takes the pose from the connection with "
+                "the highest priority unless it is stale."
+            ),
+            "enum": ["freshest", "priority"],
+            "default": "freshest",
+        },
+        "merge_max_age": {
+            "title": "Maximum pose age",
+            "description": (
+                "Number of seconds after which the pose of a rigid body is stale "
+                "when merging connections"
+            ),
+            "type": "number",
+            "minimum": 0,
+            "default": 0.1,
+        },
+        "frame_rate": {
+            "title": "Frame rate",
+            "description": (
+                "Rate at which frames are polled from shared memory buffers "
+                "and worker threads, and at which the frames of multiple "
+                "connections are merged. "
+                "Should match the frame rate of the motion capture extension."
+            ),
+            "type": "number",
+            "minimum": 1,
+            "default": 50,
+        },
+        "latency_report_interval": {
+            "title": "Latency report interval",
+            "description": (
+                "Number of seconds between consecutive log entries about the "
+                "per-stage latencies and frame gaps of each connection. Zero "
+                "disables latency instrumentation."
+            ),
+            "type": "number",
+            "minimum": 0,
+            "default": 0,
+        },
     }
 }
@@ -1,11 +1,13 @@
 from __future__ import annotations
 
 from contextlib import aclosing
+from time import time
 from typing import (
     Any,
     AsyncIterable,
     Callable,
     Iterable,
+    List,
     Optional,
     Tuple,
     TYPE_CHECKING,
@@ -16,6 +18,18 @@ from flockwave.connections import Connection
 from flockwave.encoders.json import create_json_encoder
 from flockwave.parsers.json import create_json_parser
 
+from .latency import FrameTimeline, LatencyStats, attach_timeline
+from .protocol import (
+    BinaryError,
+    BinaryFrame,
+    DriverStats,
+    NameTable,
+    create_binary_parser,
+    iter_poses,
+)
+from .recording import MocapLogWriter
+from .shm import SharedFrameBuffer
+
 if TYPE_CHECKING:
     from flockwave.server.ext.motion_capture import MotionCaptureFrame
 
@@ -24,25 +38,145 @@ __all__ = ("LibmotioncaptureConnection",)
 
 class LibmotioncaptureConnection:
     """Connection to our libmotioncapture wrapper process that prints frames in
-    JSON format.
+    JSON format or in the compact binary format defined in the ``protocol``
+    module.
     """
 
     _channel: MessageChannel[Any]
-    """The message channel on which the JSON messages are received from the
+    """The message channel on which the messages are received from the
     libmotioncapture wrapper process
     """
 
+    _names: List[str]
+    """The most recent name table received from the wrapper process when using
+    the binary format.
+    """
+
+    _names_generation: Optional[int]
+    """Generation number of the most recent name table received from the
+    wrapper process; ``None`` if no name table was received yet.
+    """
+
+    _shared_memory: Optional[SharedFrameBuffer]
+    """Shared memory buffer that the wrapper process writes frames into, if
+    the connection uses the shared memory transport.
+    """
+
+    dropped_frame_count: int = 0
+    """Number of frames dropped by the wrapper process according to its frame
+    drop policy, as reported most recently by the process.
+    """
+
+    sent_frame_count: int = 0
+    """Number of frames sent by the wrapper process, as reported most recently
+    by the process together with ``dropped_frame_count``.
+    """
+
+    latency_stats: Optional[LatencyStats] = None
+    """Latency statistics of the connection. When set, each frame gets a
+    ``FrameTimeline`` attached that starts from the capture timestamp sent by
+    the wrapper process.
+    """
+
     frame_factory: Optional[Callable[[], "MotionCaptureFrame"]] = None
     """Function that can be called with no arguments and that returns a new
     MotionCaptureFrame_ instance. Must be set before calling ``iter_frames()``.
     """
 
-    def __init__(self, connection: Connection):
-        """Constructor."""
-        parser = create_json_parser()
+    last_timestamp: Optional[float] = None
+    """Capture timestamp of the frame returned most recently, as sent by the
+    wrapper process; ``None`` if the wrapper process did not send one.
+    """
+
+    recorder: Optional[MocapLogWriter] = None
+    """Log that every decoded frame is appended to, with the capture timestamp
+    sent by the wrapper process; ``None`` if frames are not recorded.
+    """
+
+    def __init__(
+        self,
+        connection: Connection,
+        format: str = "json",
+        shared_memory: Optional[SharedFrameBuffer] = None,
+    ):
+        """Constructor.
+
+        Parameters:
+            connection: the connection to the wrapper process
+            format: the wire format used by the wrapper process; ``json`` or
+                ``binary``. Ignored and assumed to be ``binary`` when a shared
+                memory buffer is given.
+            shared_memory: shared memory buffer that the wrapper process writes
+                frames into. When given, the connection itself carries name
+                tables and errors only, and frames must be retrieved with
+                ``read_latest_frame()``.
+        """
+        if shared_memory is not None:
+            format = "binary"
+
+        if format == "binary":
+            parser = create_binary_parser()
+        elif format == "json":
+            parser = create_json_parser()
+        else:
+            raise RuntimeError(f"unknown wire format: {format!r}")
+
         encoder = create_json_encoder()
 
         self._channel = MessageChannel(connection, parser, encoder)
+        self._names = []
+        self._names_generation = None
+        self._shared_memory = shared_memory
+
+    @property
+    def uses_shared_memory(self) -> bool:
+        """Returns whether frames are received via a shared memory buffer
+        instead of the connection itself.
+        """
+        return self._shared_memory is not None
+
+    def read_latest_frame(self) -> Optional["MotionCaptureFrame"]:
+        """Returns the newest frame from the shared memory buffer if a new
+        frame was published since the last call and its name table is already
+        known, ``None`` otherwise.
+        """
+        frame_factory = self.frame_factory
+        assert frame_factory is not None
+        assert self._shared_memory is not None
+
+        message = self._shared_memory.read_latest()
+        if message is None or message.generation != self._names_generation:
+            return None
+
+        return self._create_frame(message, frame_factory)
+
+    def _update_stats(self, dropped: int, sent: int) -> None:
+        self.dropped_frame_count = dropped
+        self.sent_frame_count = sent
+
+    def _create_frame(
+        self,
+        message: BinaryFrame,
+        frame_factory: Callable[[], "MotionCaptureFrame"],
+    ) -> "MotionCaptureFrame":
+        frame = frame_factory()
+        for name, position, rotation in iter_poses(message, self._names):
+            frame.add_item(name, position, rotation)
+        self._add_timeline(frame, message.timestamp)
+        self.last_timestamp = message.timestamp
+        if self.recorder is not None:
+            self.recorder.write_records(
+                message.timestamp, message.records, self._names
+            )
+        return frame
+
+    def _add_timeline(self, frame: "MotionCaptureFrame", capture: float) -> None:
+        stats = self.latency_stats
+        if stats is not None:
+            stats.intervals.add(capture)
+            timeline = FrameTimeline(capture, stats)
+            timeline.stamp("decode")
+            attach_timeline(frame, timeline)
 
     async def iter_frames(self) -> AsyncIterable["MotionCaptureFrame"]:
         frame_factory = self.frame_factory
@@ -50,6 +184,20 @@ class LibmotioncaptureConnection:
 
         async with aclosing(self._channel):
             async for message in self._channel:
+                if isinstance(message, BinaryFrame):
+                    if message.generation == self._names_generation:
+                        yield self._create_frame(message, frame_factory)
+                    continue
+                elif isinstance(message, NameTable):
+                    self._names = message.names
+                    self._names_generation = message.generation
+                    continue
+                elif isinstance(message, BinaryError):
+                    raise RuntimeError(message.error)
+                elif isinstance(message, DriverStats):
+                    self._update_stats(message.dropped, message.sent)
+                    continue
+
                 type = message.get("type", "frame")
                 if type == "error":
                     raise RuntimeError(
@@ -72,8 +220,22 @@ class LibmotioncaptureConnection:
                     for name, position, rotation in items:
                         frame.add_item(name, position, rotation)
 
+                    if "t" in message:
+                        self.last_timestamp = float(message["t"])
+                        self._add_timeline(frame, self.last_timestamp)
+                    else:
+                        self.last_timestamp = None
+                    if self.recorder is not None:
+                        self.recorder.write_items(
+                            float(message.get("t", time())), items
+                        )
+
                     yield frame
+                elif type == "stats":
+                    self._update_stats(
+                        int(message.get("dropped", 0)), int(message.get("sent", 0))
+                    )
                 else:
                     raise RuntimeError(
-                        "unknown message type received from driver process: {type!r}"
+                        f"unknown message type received from driver process: {type!r}"
                     )
@@ -1,10 +1,13 @@
 """Driver script that connects to a remote mocap system with libmotioncapture
-and prints the frames in JSON format to stdout.
+and prints the frames in JSON format (or optionally in a compact binary
+format) to stdout.
 
 This script is meant to be executed in a separate process outside the context
 of Skybrush, using the same Python interpreter as the one used by Skybrush
 itself. The ``libmotioncapture`` extension in Skybrush takes care of
-starting this script and reading its stdout in a timely manner.
+starting this script and reading its stdout in a timely manner. When the
+extension runs libmotioncapture in a worker thread instead, it imports
+``connect()`` from this module.
 """
 
 import json
@@ -12,14 +15,44 @@ import motioncapture
 import sys
 
 from argparse import ArgumentParser
+from mmap import mmap
+from struct import Struct
 from time import time
-from typing import Any, Callable, Optional, Tuple, TypeVar
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
 
 
 T = TypeVar("T")
 
 encoder = json.JSONEncoder(ensure_ascii=True, sort_keys=True, separators=(",", ":"))
 
+# Layout of the binary wire format; must be kept in sync with protocol.py in
+# the extension
+MSG_NAMES = 1
+MSG_FRAME = 2
+MSG_ERROR = 3
+MSG_STATS = 4
+
+FLAG_HAS_ROTATION = 1
+
+_HEADER = Struct("<IB")
+_NAMES_HEADER = Struct("<HH")
+_NAME_LENGTH = Struct("<H")
+_FRAME_HEADER = Struct("<dHH")
+_RECORD = Struct("<HBx3f4f")
+_STATS = Struct("<II")
+
+STATS_INTERVAL = 1.0
+"""Number of seconds between consecutive reports about dropped frames."""
+
+# Layout of the shared memory frame buffer; must be kept in sync with shm.py
+# in the extension
+_SHM_HEADER = Struct("<4sHxxI")
+_SHM_SEQ = Struct("<Q")
+_SHM_SLOT_LENGTH = Struct("<I")
+SHM_MAGIC = b"LMCF"
+SHM_SEQ_OFFSET = 16
+SHM_SLOTS_OFFSET = 32
+
 
 def key_value_pair(value: str) -> Tuple[str, str]:
     """Parser function for the argument parser that takes a string in key=value
@@ -35,6 +68,44 @@ def create_parser() -> ArgumentParser:
     parser = ArgumentParser()
 
     parser.add_argument("type", help="type of the mocap system to connect to")
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=("json", "binary"),
+        default="json",
+        help="wire format to use on the standard output",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help="target output frame rate; frames above this rate are dropped",
+    )
+    parser.add_argument(
+        "--drop-policy",
+        choices=("none", "latest", "decimate"),
+        default=None,
+        help=(
+            "policy for dropping frames; 'latest' sends the newest frame at the "
+            "target rate, 'decimate' sends every N-th frame. Defaults to "
+            "'latest' if a target rate is given, 'none' otherwise"
+        ),
+    )
+    parser.add_argument(
+        "--decimation",
+        type=int,
+        default=None,
+        help="send only every N-th frame when using the 'decimate' policy",
+    )
+    parser.add_argument(
+        "--shm",
+        metavar="PATH",
+        default=None,
+        help=(
+            "path of a shared memory frame buffer to write frames into; the "
+            "standard output then carries name tables and errors only"
+        ),
+    )
     parser.add_argument(
         "-p",
         "--param",
@@ -53,6 +124,208 @@ def send(obj: Any) -> None:
     sys.stdout.flush()
 
 
+def send_binary(type: int, body: bytes) -> None:
+    """Sends a single length-prefixed binary message to the standard output
+    stream.
+    """
+    out = sys.stdout.buffer
+    out.write(_HEADER.pack(len(body) + 1, type))
+    out.write(body)
+    out.flush()
+
+
+class JSONFrameWriter:
+    """Writes frames and errors to the standard output in JSON format."""
+
+    def __init__(self):
+        self._items = []
+        self._message = {"items": self._items, "t": 0}
+
+    def write_error(self, error: str) -> None:
+        send({"type": "error", "error": error})
+
+    def write_stats(self, dropped: int, sent: int) -> None:
+        send({"type": "stats", "dropped": dropped, "sent": sent})
+
+    def write_frame(self, timestamp: float, rigid_bodies: Dict[str, Any]) -> None:
+        items = self._items
+        items.clear()
+        for name, obj in rigid_bodies.items():
+            rot = obj.rotation
+            encoded_pos = tuple(round(float(x), 3) for x in obj.position)
+            encoded_rot = (rot.w, rot.x, rot.y, rot.z) if rot is not None else None
+            items.append((name, encoded_pos, encoded_rot))
+
+        if items:
+            self._message["t"] = timestamp
+            send(self._message)
+
+
+class BinaryFrameWriter:
+    """Writes frames and errors to the standard output in the compact binary
+    format. The name table is sent before the first frame and whenever the set
+    of rigid bodies changes; frames refer to rigid bodies by their index in
+    the name table.
+    """
+
+    def __init__(self):
+        self._names: List[str] = []
+        self._ids: Dict[str, int] = {}
+        self._generation = 0
+
+    def write_error(self, error: str) -> None:
+        send_binary(MSG_ERROR, error.encode("utf-8"))
+
+    def write_stats(self, dropped: int, sent: int) -> None:
+        send_binary(MSG_STATS, _STATS.pack(dropped & 0xFFFFFFFF, sent & 0xFFFFFFFF))
+
+    def write_frame(self, timestamp: float, rigid_bodies: Dict[str, Any]) -> None:
+        body = self.encode_frame(timestamp, rigid_bodies)
+        if body is not None:
+            send_binary(MSG_FRAME, body)
+
+    def encode_frame(
+        self, timestamp: float, rigid_bodies: Dict[str, Any]
+    ) -> Optional[bytes]:
+        """Encodes the given rigid bodies into the body of a frame message,
+        sending an updated name table first if needed. Returns ``None`` if
+        there are no rigid bodies in the frame.
+        """
+        if not rigid_bodies:
+            return None
+
+        ids = self._ids
+        if len(ids) != len(rigid_bodies) or any(
+            name not in ids for name in rigid_bodies
+        ):
+            self._update_name_table(list(rigid_bodies.keys()))
+            ids = self._ids
+
+        parts = [_FRAME_HEADER.pack(timestamp, self._generation, len(rigid_bodies))]
+        pack = _RECORD.pack
+        for name, obj in rigid_bodies.items():
+            x, y, z = obj.position
+            rot = obj.rotation
+            if rot is not None:
+                flags, qw, qx, qy, qz = FLAG_HAS_ROTATION, rot.w, rot.x, rot.y, rot.z
+            else:
+                flags, qw, qx, qy, qz = 0, 0.0, 0.0, 0.0, 0.0
+            parts.append(pack(ids[name], flags, x, y, z, qw, qx, qy, qz))
+
+        return b"".join(parts)
+
+    def _update_name_table(self, names: List[str]) -> None:
+        self._names = names
+        self._ids = {name: index for index, name in enumerate(names)}
+        self._generation = (self._generation + 1) & 0xFFFF
+
+        parts = [_NAMES_HEADER.pack(self._generation, len(names))]
+        for name in names:
+            encoded = name.encode("utf-8")
+            parts.append(_NAME_LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+
+        send_binary(MSG_NAMES, b"".join(parts))
+
+
+class SharedMemoryFrameWriter(BinaryFrameWriter):
+    """Writes frames into a memory-mapped, seqlock-protected double buffer
+    that is polled by the extension. Name tables and errors are still written
+    to the standard output in the binary format.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+
+        self._fp = open(path, "r+b")
+        self._mm = mmap(self._fp.fileno(), 0)
+
+        magic, _, self._slot_size = _SHM_HEADER.unpack_from(self._mm, 0)
+        if magic != SHM_MAGIC:
+            raise RuntimeError(f"not a shared memory frame buffer: {path}")
+
+        self._seq = 0
+        _SHM_SEQ.pack_into(self._mm, SHM_SEQ_OFFSET, 0)
+
+    def write_frame(self, timestamp: float, rigid_bodies: Dict[str, Any]) -> None:
+        body = self.encode_frame(timestamp, rigid_bodies)
+        if body is None:
+            return
+
+        if len(body) > self._slot_size - _SHM_SLOT_LENGTH.size:
+            raise RuntimeError("frame does not fit into the shared memory buffer")
+
+        mm, seq = self._mm, self._seq
+        start = SHM_SLOTS_OFFSET + (((seq >> 1) + 1) & 1) * self._slot_size
+
+        _SHM_SEQ.pack_into(mm, SHM_SEQ_OFFSET, seq + 1)
+        _SHM_SLOT_LENGTH.pack_into(mm, start, len(body))
+        mm[start + 4 : start + 4 + len(body)] = body
+        _SHM_SEQ.pack_into(mm, SHM_SEQ_OFFSET, seq + 2)
+
+        self._seq = seq + 2
+
+
+class FrameDropPolicy:
+    """Decides which frames received from the mocap system are forwarded to
+    the server and keeps track of how many frames were dropped.
+    """
+
+    def __init__(
+        self,
+        policy: Optional[str] = None,
+        rate: Optional[float] = None,
+        decimation: Optional[int] = None,
+    ):
+        if policy is None:
+            policy = "latest" if rate else "none"
+
+        if policy == "latest" and (rate is None or rate <= 0):
+            raise RuntimeError("the 'latest' drop policy needs a positive rate")
+        if policy == "decimate" and (decimation is None or decimation < 1):
+            raise RuntimeError("the 'decimate' drop policy needs a decimation >= 1")
+
+        self.policy = policy
+        self.dropped = 0
+        self.sent = 0
+
+        self._period = 1.0 / rate if rate else 0.0
+        self._next_due = 0.0
+        self._decimation = decimation or 1
+        self._counter = 0
+
+    def should_send(self, now: float) -> bool:
+        """Returns whether the frame received at the given time should be
+        forwarded to the server, and updates the counters accordingly.
+        """
+        if self.policy == "latest":
+            send = now >= self._next_due
+            if send:
+                # Keep the schedule in step with the target rate, but do not
+                # try to catch up after a gap in the incoming frames
+                self._next_due += self._period
+                if self._next_due < now:
+                    self._next_due = now + self._period
+        elif self.policy == "decimate":
+            send = self._counter == 0
+            self._counter = (self._counter + 1) % self._decimation
+        else:
+            send = True
+
+        if send:
+            self.sent += 1
+        else:
+            self.dropped += 1
+
+        return send
+
+
+writer: Any = JSONFrameWriter()
+"""Object that is responsible for writing frames and errors to the standard
+output in the format requested on the command line.
+"""
+
+
 def wrap_exceptions(func: Callable[[], T]) -> Callable[[], Optional[T]]:
     """Decorator that takes a function and converts it into another function
     that catches all exceptions from the function and logs them in JSON
@@ -63,28 +336,25 @@ def wrap_exceptions(func: Callable[[], T]) -> Callable[[], Optional[T]]:
         try:
             return func()
         except Exception as ex:
-            send({"type": "error", "error": str(ex)})
+            writer.write_error(str(ex))
 
     return decorated
 
 
-@wrap_exceptions
-def main() -> int:
-    """Main entry point of the script.
+def connect(type: str, options: Dict[str, str]) -> Any:
+    """Connects to the mocap system of the given type with libmotioncapture,
+    passing the given options to libmotioncapture as connection parameters.
 
-    Returns:
-        error code to return to the OS
+    Also used by the extension when it runs libmotioncapture in a worker
+    thread instead of a separate process.
     """
-    parser = create_parser()
-    args = parser.parse_args()
-
-    options = dict(args.parameters)
+    options = dict(options)
 
     try:
-        if args.type == "test":
-            mc = motioncapture.MotionCaptureTest(0.04, [])
+        if type == "test":
+            return motioncapture.MotionCaptureTest(0.04, [])
         else:
-            mc = motioncapture.connect(args.type, options)
+            return motioncapture.connect(type, options)
     except Exception as ex:
         if "incompatible function arguments" in str(ex):
             # old libmotioncapture where 'options' had to be a string
@@ -96,25 +366,48 @@ def main() -> int:
             if options:
                 raise RuntimeError("unhandled options: " + ", ".join(options.keys()))
 
-            mc = motioncapture.connect(args.type, hostname)
+            return motioncapture.connect(type, hostname)
         else:
             raise
 
-    items = []
-    message = {"items": items, "t": 0}
+
+@wrap_exceptions
+def main() -> int:
+    """Main entry point of the script.
+
+    Returns:
+        error code to return to the OS
+    """
+    global writer
+
+    parser = create_parser()
+    args = parser.parse_args()
+
+    if args.shm:
+        writer = SharedMemoryFrameWriter(args.shm)
+    elif args.format == "binary":
+        writer = BinaryFrameWriter()
+
+    mc = connect(args.type, dict(args.parameters))
+
+    policy = FrameDropPolicy(args.drop_policy, args.rate, args.decimation)
+    next_stats_at = time() + STATS_INTERVAL
+    last_reported_dropped = 0
+
     while True:
         mc.waitForNextFrame()
-        message["t"] = time()
+        now = time()
 
-        items.clear()
-        for name, obj in mc.rigidBodies.items():
-            rot = obj.rotation
-            encoded_pos = tuple(round(float(x), 3) for x in obj.position)
-            encoded_rot = (rot.w, rot.x, rot.y, rot.z) if rot is not None else None
-            items.append((name, encoded_pos, encoded_rot))
+        # Dropped frames are not even retrieved from libmotioncapture so we
+        # do not pay the conversion cost for them
+        if policy.should_send(now):
+            writer.write_frame(now, mc.rigidBodies)
 
-        if items:
-            send(message)
+        if now >= next_stats_at:
+            next_stats_at = now + STATS_INTERVAL
+            if policy.dropped != last_reported_dropped:
+                last_reported_dropped = policy.dropped
+                writer.write_stats(policy.dropped, policy.sent)
 
     return 0
 
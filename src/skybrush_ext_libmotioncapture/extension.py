@@ -2,18 +2,25 @@ import sys
 
 from contextlib import ExitStack
 from functools import partial
-from trio import open_nursery
-from typing import Any, Dict, Sequence, TYPE_CHECKING
+from trio import current_time, open_nursery, sleep, sleep_until
+from typing import Any, Callable, Dict, Optional, Sequence, Union, TYPE_CHECKING
 
 from flockwave.connections.process import ProcessConnection
 from flockwave.server.ext.base import Extension
 from flockwave.server.model import ConnectionPurpose
 
 from .channel import LibmotioncaptureConnection
+from .fusion import DEFAULT_MAX_AGE, FrameMerger
+from .latency import LatencyStats, get_timeline
+from .recording import MocapLogWriter
+from .replay import ReplayConnection
+from .shm import SharedFrameBuffer, shared_frame_buffer
+from .threaded import ThreadedLibmotioncaptureConnection
 from .utils import extracted_driver_script
 
 if TYPE_CHECKING:
     from flockwave.server.app import SkybrushServer
+    from flockwave.server.ext.motion_capture import MotionCaptureFrame
 
 __all__ = ("LibmotioncaptureMocapExtension",)
 
@@ -22,8 +29,52 @@ ConnectionSpec = Dict[str, Any]
 configuration.
 """
 
+DRIVER_OPTIONS: Dict[str, str] = {
+    "format": "--format",
+    "rate": "--rate",
+    "drop_policy": "--drop-policy",
+    "decimation": "--decimation",
+}
+"""Mapping from keys of a connection specification that configure the driver
+script itself to the corresponding command line options of the driver script.
+Keys not listed here (and not in ``EXTENSION_OPTIONS``) are forwarded to
+libmotioncapture as connection parameters.
+"""
+
+EXTENSION_OPTIONS = frozenset(("transport", "record", "priority", "clock_offset"))
+"""Keys of a connection specification that are handled by the extension
+itself and that are not passed on to the driver script.
+"""
+
+REPLAY_TYPE = "replay"
+"""Connection type that plays back a recorded mocap log instead of starting a
+driver process.
+"""
+
+DEFAULT_FRAME_RATE = 50
+"""Default rate at which frames are polled from shared memory buffers and
+worker threads, and at which the frames of multiple connections are merged;
+should match the frame rate of the ``motion_capture`` extension.
+"""
+
 
 class LibmotioncaptureMocapExtension(Extension):
+    _latency_stats: Dict[str, LatencyStats]
+    """Latency statistics of each connection, keyed by connection ID. Empty if
+    latency instrumentation is disabled.
+    """
+
+    _merger: Optional[FrameMerger]
+    """Merge stage that combines the frames of all the connections into one
+    frame per tick; ``None`` if frames are passed on to the ``motion_capture``
+    extension directly.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._latency_stats = {}
+        self._merger = None
+
     async def run(self, app: "SkybrushServer", configuration):
         """This function is called when the extension was loaded.
 
@@ -43,11 +94,39 @@ class LibmotioncaptureMocapExtension(Extension):
         connection_specs: Sequence[ConnectionSpec] = configuration.get(
             "connections", ()
         )
+        frame_rate = float(configuration.get("frame_rate", DEFAULT_FRAME_RATE))
+        latency_report_interval = float(
+            configuration.get("latency_report_interval", 0)
+        )
+        self._latency_stats = {}
+        self._merger = None
 
         assert self.log is not None
 
+        if len(connection_specs) > 1 and configuration.get("merge", True):
+            mocap = app.import_api("motion_capture")
+            enqueue_frame = mocap.enqueue_frame
+            if latency_report_interval > 0:
+                enqueue_frame = partial(
+                    self._enqueue_frame_with_timeline, enqueue_frame
+                )
+            try:
+                self._merger = FrameMerger(
+                    mocap.create_frame,
+                    enqueue_frame,
+                    policy=configuration.get("merge_policy", "freshest"),
+                    max_age=float(
+                        configuration.get("merge_max_age", DEFAULT_MAX_AGE)
+                    ),
+                )
+            except RuntimeError as ex:
+                self.log.error(f"Frames of the connections are not merged: {ex}")
+
         with ExitStack() as stack:
-            if connection_specs:
+            if any(
+                spec.get("type") != REPLAY_TYPE and spec.get("transport") != "thread"
+                for spec in connection_specs
+            ):
                 driver_script = stack.enter_context(extracted_driver_script())
             else:
                 driver_script = None
@@ -66,13 +145,117 @@ class LibmotioncaptureMocapExtension(Extension):
                         or f"Mocap connection {index} ({type})"
                     )
 
+                    if type == REPLAY_TYPE:
+                        path = connection_spec.get("path")
+                        if not path:
+                            self.log.error(
+                                f"Connection specification #{index} has no log "
+                                f"file to replay"
+                            )
+                            continue
+
+                        if latency_report_interval > 0:
+                            self._latency_stats[conn_id] = LatencyStats()
+                        self._add_merge_source(conn_id, connection_spec)
+
+                        nursery.start_soon(
+                            partial(
+                                self.handle_replay_connection,
+                                id=conn_id,
+                                name=name,
+                                path=str(path),
+                                speed=float(connection_spec.get("speed", 1)),
+                                loop=bool(connection_spec.get("loop", False)),
+                                start=float(connection_spec.get("start", 0)),
+                                frame_rate=frame_rate,
+                            )
+                        )
+
+                        count += 1
+                        continue
+
+                    format = connection_spec.get("format", "json")
+                    if format not in ("json", "binary"):
+                        self.log.error(
+                            f"Connection specification #{index} has an unknown "
+                            f"format: {format!r}"
+                        )
+                        continue
+
+                    transport = connection_spec.get("transport", "pipe")
+                    if transport not in ("pipe", "shm", "thread"):
+                        self.log.error(
+                            f"Connection specification #{index} has an unknown "
+                            f"transport: {transport!r}"
+                        )
+                        continue
+
+                    if transport == "thread":
+                        # The options of the driver script are not needed
+                        # here; the latest frame is always read at the
+                        # frame rate
+                        parameters = {
+                            key: str(value)
+                            for key, value in connection_spec.items()
+                            if key != "type"
+                            and key not in DRIVER_OPTIONS
+                            and key not in EXTENSION_OPTIONS
+                        }
+
+                        if latency_report_interval > 0:
+                            self._latency_stats[conn_id] = LatencyStats()
+                        self._add_merge_source(conn_id, connection_spec)
+
+                        threaded_connection = ThreadedLibmotioncaptureConnection(
+                            type, parameters
+                        )
+                        stack.enter_context(
+                            app.connection_registry.use(
+                                threaded_connection,
+                                conn_id,
+                                name,
+                                purpose=ConnectionPurpose.mocap,  # type: ignore
+                            )
+                        )
+
+                        nursery.start_soon(
+                            partial(
+                                app.supervise,
+                                threaded_connection,
+                                task=partial(
+                                    self.handle_threaded_connection,
+                                    id=conn_id,
+                                    name=name,
+                                    frame_rate=frame_rate,
+                                    record=connection_spec.get("record"),
+                                ),  # type: ignore
+                            )
+                        )
+
+                        count += 1
+                        continue
+
                     args = [sys.executable, str(driver_script)]
                     for key, value in connection_spec.items():
-                        if key != "type":
+                        if key in DRIVER_OPTIONS:
+                            args.append(DRIVER_OPTIONS[key])
+                            args.append(str(value))
+                        elif key != "type" and key not in EXTENSION_OPTIONS:
                             args.append("-p")
                             args.append(f"{key}={value}")
+
+                    shared_memory: Optional[SharedFrameBuffer] = None
+                    if transport == "shm":
+                        shared_memory = stack.enter_context(shared_frame_buffer())
+                        args.append("--shm")
+                        args.append(str(shared_memory.path))
+
                     args.append(type)
 
+                    if latency_report_interval > 0:
+                        self._latency_stats[conn_id] = LatencyStats()
+                    self._add_merge_source(conn_id, connection_spec)
+
                     connection = ProcessConnection.create_in_nursery(nursery, args)
                     stack.enter_context(
                         app.connection_registry.use(
@@ -91,6 +274,10 @@ class LibmotioncaptureMocapExtension(Extension):
                                 self.handle_libmotioncapture_connection,
                                 id=conn_id,
                                 name=name,
+                                format=format,
+                                shared_memory=shared_memory,
+                                frame_rate=frame_rate,
+                                record=connection_spec.get("record"),
                             ),  # type: ignore
                         )
                     )
@@ -102,8 +289,27 @@ class LibmotioncaptureMocapExtension(Extension):
                 elif count:
                     self.log.info(f"Using libmotioncapture connection")
 
+                # The connection tasks have not started yet, so it is not too
+                # late to decide that there is nothing to merge
+                if self._merger is not None and count > 1:
+                    nursery.start_soon(self._merger.run, frame_rate)
+                else:
+                    self._merger = None
+
+                if self._latency_stats:
+                    nursery.start_soon(
+                        self._report_latency_stats, latency_report_interval
+                    )
+
     async def handle_libmotioncapture_connection(
-        self, connection: ProcessConnection, id: str, name: str
+        self,
+        connection: ProcessConnection,
+        id: str,
+        name: str,
+        format: str = "json",
+        shared_memory: Optional[SharedFrameBuffer] = None,
+        frame_rate: float = DEFAULT_FRAME_RATE,
+        record: Optional[str] = None,
     ) -> None:
         assert self.log is not None
 
@@ -114,9 +320,18 @@ class LibmotioncaptureMocapExtension(Extension):
             extra={"semantics": "success", "id": id},
         )
 
+        conn = LibmotioncaptureConnection(
+            connection, format=format, shared_memory=shared_memory
+        )
+        conn.latency_stats = self._latency_stats.get(id)
+
         try:
+            if record:
+                # Opened here so that each run of the driver process gets a
+                # new log file
+                self._start_recording(conn, record, name, id)
             await self._handle_libmotioncapture_connection(
-                LibmotioncaptureConnection(connection)
+                conn, id, frame_rate=frame_rate
             )
         except RuntimeError as ex:
             log.error(str(ex))
@@ -126,14 +341,149 @@ class LibmotioncaptureMocapExtension(Extension):
                 extra={"id": id},
             )
         finally:
+            self._stop_recording(conn, name, id)
+            if conn.dropped_frame_count:
+                log.info(
+                    f"libmotioncapture process for {name!r} dropped "
+                    f"{conn.dropped_frame_count} frame(s) and sent "
+                    f"{conn.sent_frame_count}",
+                    extra={"id": id},
+                )
             log.info(
                 f"Connection to libmotioncapture process closed for {name!r}",
                 extra={"id": id},
             )
             await connection.close()
 
+    async def handle_replay_connection(
+        self,
+        id: str,
+        name: str,
+        path: str,
+        speed: float = 1.0,
+        loop: bool = False,
+        start: float = 0.0,
+        frame_rate: float = DEFAULT_FRAME_RATE,
+    ) -> None:
+        assert self.log is not None
+
+        log = self.log
+
+        try:
+            conn = ReplayConnection(path, speed=speed, loop=loop, start=start)
+        except (OSError, RuntimeError) as ex:
+            log.error(f"Cannot replay mocap log {path!r}: {ex}", extra={"id": id})
+            return
+
+        conn.latency_stats = self._latency_stats.get(id)
+
+        log.info(
+            f"Replaying mocap log {path!r} for {name!r}",
+            extra={"semantics": "success", "id": id},
+        )
+
+        try:
+            await self._handle_libmotioncapture_connection(
+                conn, id, frame_rate=frame_rate
+            )
+        except RuntimeError as ex:
+            log.error(str(ex))
+        except Exception:
+            log.exception(
+                f"Unexpected error while replaying mocap log for {name!r}",
+                extra={"id": id},
+            )
+        finally:
+            log.info(
+                f"Replay finished for {name!r} after {conn.sent_frame_count} frame(s)",
+                extra={"id": id},
+            )
+
+    async def handle_threaded_connection(
+        self,
+        conn: ThreadedLibmotioncaptureConnection,
+        id: str,
+        name: str,
+        frame_rate: float = DEFAULT_FRAME_RATE,
+        record: Optional[str] = None,
+    ) -> None:
+        assert self.log is not None
+
+        log = self.log
+
+        log.info(
+            f"Started libmotioncapture thread for {name!r}",
+            extra={"semantics": "success", "id": id},
+        )
+
+        conn.latency_stats = self._latency_stats.get(id)
+
+        try:
+            if record:
+                self._start_recording(conn, record, name, id)
+            await self._handle_libmotioncapture_connection(
+                conn, id, frame_rate=frame_rate
+            )
+        except RuntimeError as ex:
+            log.error(str(ex))
+        except Exception:
+            log.exception(
+                f"Unexpected error in libmotioncapture thread for {name!r}",
+                extra={"id": id},
+            )
+        finally:
+            self._stop_recording(conn, name, id)
+            if conn.dropped_frame_count:
+                log.info(
+                    f"libmotioncapture thread for {name!r} received "
+                    f"{conn.dropped_frame_count} frame(s) that were never "
+                    f"read and {conn.sent_frame_count} that were",
+                    extra={"id": id},
+                )
+            log.info(
+                f"libmotioncapture thread stopped for {name!r}",
+                extra={"id": id},
+            )
+            await conn.close()
+
+    def _start_recording(
+        self,
+        conn: Union[LibmotioncaptureConnection, ThreadedLibmotioncaptureConnection],
+        record: str,
+        name: str,
+        id: str,
+    ) -> None:
+        assert self.log is not None
+        conn.recorder = MocapLogWriter(record)
+        self.log.info(
+            f"Recording frames of {name!r} to {str(conn.recorder.path)!r}",
+            extra={"id": id},
+        )
+
+    def _stop_recording(
+        self,
+        conn: Union[LibmotioncaptureConnection, ThreadedLibmotioncaptureConnection],
+        name: str,
+        id: str,
+    ) -> None:
+        assert self.log is not None
+        if conn.recorder is not None:
+            conn.recorder.close()
+            self.log.info(
+                f"Recorded {conn.recorder.frame_count} frame(s) of {name!r}",
+                extra={"id": id},
+            )
+            conn.recorder = None
+
     async def _handle_libmotioncapture_connection(
-        self, conn: LibmotioncaptureConnection
+        self,
+        conn: Union[
+            LibmotioncaptureConnection,
+            ReplayConnection,
+            ThreadedLibmotioncaptureConnection,
+        ],
+        id: str,
+        frame_rate: float,
     ) -> None:
         assert self.app is not None
         assert self.log is not None
@@ -145,6 +495,97 @@ class LibmotioncaptureMocapExtension(Extension):
 
         # Wire the signals to the connection object
         conn.frame_factory = create_frame
+        if self._merger is not None and id in self._merger:
+            enqueue_frame = partial(self._merge_frame, self._merger, id, conn)
+        elif conn.latency_stats is not None:
+            enqueue_frame = partial(self._enqueue_frame_with_timeline, enqueue_frame)
+
+        if isinstance(conn, ThreadedLibmotioncaptureConnection):
+            # Frames are polled from the latest frame slot of the worker
+            # thread, which runs until the connection fails
+            async with open_nursery() as nursery:
+                nursery.start_soon(
+                    self._poll_latest_frames, conn, enqueue_frame, frame_rate
+                )
+                await conn.run()
+                nursery.cancel_scope.cancel()
+        elif (
+            isinstance(conn, LibmotioncaptureConnection)
+            and conn.uses_shared_memory
+        ):
+            # Frames are polled from shared memory; the connection itself
+            # carries name tables and errors only
+            async with open_nursery() as nursery:
+                nursery.start_soon(
+                    self._poll_latest_frames, conn, enqueue_frame, frame_rate
+                )
+                async for frame in conn.iter_frames():
+                    enqueue_frame(frame)
+                nursery.cancel_scope.cancel()
+        else:
+            async for frame in conn.iter_frames():
+                enqueue_frame(frame)
+
+    def _add_merge_source(self, id: str, connection_spec: ConnectionSpec) -> None:
+        if self._merger is not None:
+            clock_offset = connection_spec.get("clock_offset")
+            self._merger.add_source(
+                id,
+                priority=float(connection_spec.get("priority", 0)),
+                clock_offset=float(clock_offset) if clock_offset is not None else None,
+            )
+
+    @staticmethod
+    def _merge_frame(
+        merger: FrameMerger,
+        id: str,
+        conn: Union[
+            LibmotioncaptureConnection,
+            ReplayConnection,
+            ThreadedLibmotioncaptureConnection,
+        ],
+        frame: "MotionCaptureFrame",
+    ) -> None:
+        merger.add_frame(id, frame, conn.last_timestamp)
+
+    @staticmethod
+    def _enqueue_frame_with_timeline(
+        enqueue_frame: Callable[["MotionCaptureFrame"], None],
+        frame: "MotionCaptureFrame",
+    ) -> None:
+        timeline = get_timeline(frame)
+        if timeline is not None:
+            timeline.stamp("enqueue")
+        enqueue_frame(frame)
+
+    async def _report_latency_stats(self, interval: float) -> None:
+        """Task that periodically logs the latency statistics of each
+        connection and then resets them.
+        """
+        assert self.log is not None
+
+        while True:
+            await sleep(interval)
+            for conn_id, stats in self._latency_stats.items():
+                self.log.info(f"Latency: {stats.format()}", extra={"id": conn_id})
+                stats.reset()
+
+    async def _poll_latest_frames(
+        self,
+        conn: Union[LibmotioncaptureConnection, ThreadedLibmotioncaptureConnection],
+        enqueue_frame: Callable[["MotionCaptureFrame"], None],
+        frame_rate: float,
+    ) -> None:
+        """Task that reads the newest frame from the shared memory buffer or
+        the worker thread of the given connection at the given rate, skipping
+        all the frames that were published in the meanwhile.
+        """
+        period = 1.0 / frame_rate
+        deadline = current_time()
+        while True:
+            frame = conn.read_latest_frame()
+            if frame is not None:
+                enqueue_frame(frame)
 
-        async for frame in conn.iter_frames():
-            enqueue_frame(frame)
+            deadline = max(deadline + period, current_time())
+            await sleep_until(deadline)
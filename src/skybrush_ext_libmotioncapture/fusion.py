@@ -0,0 +1,242 @@
+"""Time-aligned fusion of the frames of multiple mocap connections.
+
+Each connection of the extension produces frames of its own, at its own rate
+and with timestamps from its own clock. When several connections are used,
+their frames are not passed on to the ``motion_capture`` extension one by
+one; ``FrameMerger`` collects them instead and emits a single merged frame
+per tick, with the rigid bodies that were updated since the previous tick.
+
+Rigid bodies seen by more than one connection are deduplicated: with the
+``freshest`` policy, the pose with the most recent capture time wins; with the
+``priority`` policy, the pose from the connection with the highest priority
+wins as long as it is not older than the maximum age.
+
+Capture times are converted to the clock of the server with a per-connection
+clock offset. The offset is either configured explicitly or estimated from
+the smallest observed difference between the arrival time and the capture
+time of the frames of the connection.
+"""
+
+from __future__ import annotations
+
+from time import time
+from trio import current_time, sleep_until
+from typing import Any, Callable, Dict, Optional, TYPE_CHECKING
+
+from .latency import FrameTimeline, attach_timeline, get_timeline
+
+if TYPE_CHECKING:
+    from flockwave.server.ext.motion_capture import MotionCaptureFrame
+
+__all__ = ("ClockOffsetEstimator", "FrameMerger", "MERGE_POLICIES")
+
+
+MERGE_POLICIES = ("freshest", "priority")
+"""Policies for choosing between the poses of a rigid body seen by more than
+one connection.
+"""
+
+DEFAULT_MAX_AGE = 0.1
+"""Default number of seconds after which the pose of a rigid body is
+considered stale.
+"""
+
+
+class ClockOffsetEstimator:
+    """Estimates the offset between the clock of a mocap source and the clock
+    of the server.
+
+    The estimate is the smallest observed difference between the arrival time
+    and the capture time of a frame, i.e. the clock offset plus the smallest
+    transport delay. It is allowed to grow slowly to follow clock drift.
+    """
+
+    offset: Optional[float]
+    """The current estimate; ``None`` until the first frame arrives."""
+
+    def __init__(self, offset: Optional[float] = None, drift: float = 1e-3):
+        """Constructor.
+
+        Parameters:
+            offset: fixed offset to add to capture times; ``None`` to estimate
+                the offset from the frames
+            drift: number of seconds per second by which the estimate may grow
+        """
+        self.offset = offset
+        self._fixed = offset is not None
+        self._drift = drift
+        self._updated_at = 0.0
+
+    def to_local_time(self, capture: float, arrival: float) -> float:
+        """Updates the estimate with a frame captured and received at the
+        given times, and returns the capture time in the clock of the server.
+        """
+        if not self._fixed:
+            sample = arrival - capture
+            offset = self.offset
+            if offset is None:
+                self.offset = sample
+            else:
+                offset += self._drift * (arrival - self._updated_at)
+                self.offset = sample if sample < offset else offset
+            self._updated_at = arrival
+
+        assert self.offset is not None
+        return capture + self.offset
+
+
+class _Source:
+    __slots__ = ("priority", "clock")
+
+    def __init__(self, priority: float, clock: ClockOffsetEstimator):
+        self.priority = priority
+        self.clock = clock
+
+
+class _Body:
+    """Most recent pose of a single rigid body, and where it came from."""
+
+    __slots__ = ("time", "priority", "position", "attitude", "timeline", "pending")
+
+    def __init__(self):
+        self.time = 0.0
+        self.priority = 0.0
+        self.position: Any = None
+        self.attitude: Any = None
+        self.timeline: Optional[FrameTimeline] = None
+        self.pending = False
+
+
+class FrameMerger:
+    """Merges the frames of multiple mocap connections into one frame per
+    tick.
+    """
+
+    def __init__(
+        self,
+        create_frame: Callable[[], "MotionCaptureFrame"],
+        enqueue_frame: Callable[["MotionCaptureFrame"], None],
+        policy: str = "freshest",
+        max_age: float = DEFAULT_MAX_AGE,
+    ):
+        """Constructor.
+
+        Parameters:
+            create_frame: function that returns a new, empty frame
+            enqueue_frame: function that the merged frames are passed to
+            policy: policy for choosing between the poses of a rigid body
+                seen by more than one connection; one of ``MERGE_POLICIES``
+            max_age: number of seconds after which the pose of a rigid body
+                is considered stale; stale poses are not emitted and are
+                replaced by the pose from any other connection
+        """
+        if policy not in MERGE_POLICIES:
+            raise RuntimeError(f"unknown merge policy: {policy!r}")
+
+        self._create_frame = create_frame
+        self._enqueue_frame = enqueue_frame
+        self._prefer_priority = policy == "priority"
+        self._max_age = max_age
+        self._sources: Dict[str, _Source] = {}
+        self._bodies: Dict[str, _Body] = {}
+
+    def add_source(
+        self, id: str, priority: float = 0, clock_offset: Optional[float] = None
+    ) -> None:
+        """Registers a connection whose frames are to be merged.
+
+        Parameters:
+            id: ID of the connection
+            priority: priority of the poses from this connection
+            clock_offset: number of seconds to add to the capture times of the
+                frames of this connection to get the time of the server;
+                ``None`` to estimate it
+        """
+        self._sources[id] = _Source(priority, ClockOffsetEstimator(clock_offset))
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._sources
+
+    def add_frame(
+        self, source: str, frame: "MotionCaptureFrame", capture: Optional[float]
+    ) -> None:
+        """Takes the poses of a frame received from the given connection.
+
+        Parameters:
+            source: ID of the connection
+            frame: the frame received from the connection
+            capture: capture time of the frame in the clock of the connection;
+                ``None`` if unknown, in which case the arrival time is used
+        """
+        now = time()
+        src = self._sources[source]
+        at = now if capture is None else src.clock.to_local_time(capture, now)
+        priority = src.priority
+        timeline = get_timeline(frame)
+
+        bodies = self._bodies
+        prefer_priority = self._prefer_priority
+        oldest = now - self._max_age
+
+        for item in frame.items:
+            body = bodies.get(item.name)
+            if body is None:
+                body = bodies[item.name] = _Body()
+            elif body.time >= oldest:
+                if prefer_priority and priority != body.priority:
+                    if priority < body.priority:
+                        continue
+                elif at < body.time or (at == body.time and priority < body.priority):
+                    continue
+
+            body.time = at
+            body.priority = priority
+            body.position = item.position
+            body.attitude = item.attitude
+            body.timeline = timeline
+            body.pending = True
+
+    def flush(self) -> Optional["MotionCaptureFrame"]:
+        """Emits a merged frame with the rigid bodies that were updated since
+        the previous call, and forgets about the rigid bodies whose poses are
+        stale. Returns the merged frame, or ``None`` if there were no updates.
+        """
+        oldest = time() - self._max_age
+        frame: Optional["MotionCaptureFrame"] = None
+        timeline: Optional[FrameTimeline] = None
+        timeline_time = 0.0
+        stale = []
+
+        for name, body in self._bodies.items():
+            if body.time < oldest:
+                stale.append(name)
+            elif body.pending:
+                if frame is None:
+                    frame = self._create_frame()
+                frame.add_item(name, body.position, body.attitude)
+
+                # The latency of the merged frame is that of its oldest part
+                if body.timeline is not None and (
+                    timeline is None or body.time < timeline_time
+                ):
+                    timeline, timeline_time = body.timeline, body.time
+            body.pending = False
+
+        for name in stale:
+            del self._bodies[name]
+
+        if frame is not None:
+            if timeline is not None:
+                attach_timeline(frame, timeline)
+            self._enqueue_frame(frame)
+
+        return frame
+
+    async def run(self, frame_rate: float) -> None:
+        """Task that emits a merged frame at the given rate."""
+        period = 1.0 / frame_rate
+        deadline = current_time()
+        while True:
+            self.flush()
+            deadline = max(deadline + period, current_time())
+            await sleep_until(deadline)
@@ -0,0 +1,223 @@
+"""Latency instrumentation for the mocap pipeline.
+
+Frames coming from libmotioncapture may carry a ``FrameTimeline`` that
+records when the frame passed through each stage of the pipeline, from the
+moment the driver process received it from the mocap system up to the moment
+the poses were handed over to the radio. All timestamps are UNIX timestamps
+as returned by ``time.time()`` because the driver process runs in a separate
+interpreter and uses the same clock.
+
+Consumers further down the pipeline (e.g., the aimotionlab extension) should
+use ``get_timeline()`` to retrieve the timeline of a frame as frames from
+other sources do not have one.
+"""
+
+from __future__ import annotations
+
+from bisect import bisect_right
+from time import time
+from typing import Any, Dict, List, Optional, Sequence
+
+__all__ = (
+    "STAGES",
+    "FrameTimeline",
+    "IntervalStats",
+    "LatencyHistogram",
+    "LatencyStats",
+    "attach_timeline",
+    "get_timeline",
+)
+
+
+STAGES = ("decode", "enqueue", "dispatch", "handler", "broadcast")
+"""Names of the pipeline stages whose latency is measured relative to the
+capture timestamp of the frame, in the order the frame passes through them.
+"""
+
+BUCKET_EDGES: List[float] = [0.0001 * 2 ** (i / 2) for i in range(30)]
+"""Upper edges of the latency histogram buckets in seconds, log-spaced from
+0.1 ms to ~3 s.
+"""
+
+
+class LatencyHistogram:
+    """Histogram of latencies with logarithmically spaced buckets."""
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.reset()
+
+    def add(self, value: float) -> None:
+        """Adds a single latency (in seconds) to the histogram."""
+        self.counts[bisect_right(BUCKET_EDGES, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q: float) -> float:
+        """Returns an upper estimate of the given percentile (0-100) of the
+        latencies, based on the bucket edges.
+        """
+        if not self.count:
+            return 0.0
+
+        threshold = self.count * q / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= threshold:
+                if index < len(BUCKET_EDGES):
+                    return min(BUCKET_EDGES[index], self.max)
+                break
+
+        return self.max
+
+    def reset(self) -> None:
+        self.counts = [0] * (len(BUCKET_EDGES) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class IntervalStats:
+    """Frame gap and jitter counters for a stream of events that are expected
+    to arrive at a steady rate.
+    """
+
+    __slots__ = ("last", "mean_interval", "jitter", "gaps", "count")
+
+    GAP_FACTOR = 2.5
+    """An interval is counted as a gap if it is longer than the mean interval
+    multiplied by this factor.
+    """
+
+    def __init__(self):
+        self.last: Optional[float] = None
+        self.mean_interval = 0.0
+        self.jitter = 0.0
+        self.gaps = 0
+        self.count = 0
+
+    def add(self, timestamp: float) -> None:
+        """Registers an event that happened at the given timestamp."""
+        last, self.last = self.last, timestamp
+        if last is None:
+            return
+
+        interval = timestamp - last
+        self.count += 1
+        if self.count == 1:
+            self.mean_interval = interval
+            return
+
+        if interval > self.GAP_FACTOR * self.mean_interval:
+            self.gaps += 1
+        else:
+            # Gaps are excluded so that a single dropout does not distort the
+            # estimated frame rate; jitter follows RFC 3550
+            self.mean_interval += (interval - self.mean_interval) / 16
+        self.jitter += (abs(interval - self.mean_interval) - self.jitter) / 16
+
+
+class LatencyStats:
+    """Per-stage latency histograms and frame interval statistics of a single
+    connection or object.
+    """
+
+    histograms: Dict[str, LatencyHistogram]
+    intervals: IntervalStats
+
+    def __init__(self, stages: Sequence[str] = STAGES):
+        self.histograms = {stage: LatencyHistogram() for stage in stages}
+        self.intervals = IntervalStats()
+
+    def record(self, stage: str, latency: float) -> None:
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.add(latency)
+
+    def reset(self) -> None:
+        """Clears the histograms and the gap counter; the frame interval and
+        jitter estimates are kept.
+        """
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.intervals.gaps = 0
+
+    def format(self) -> str:
+        """Returns a human-readable one-line summary of the statistics."""
+        parts = []
+        for stage, histogram in self.histograms.items():
+            if histogram.count:
+                parts.append(
+                    f"{stage} {histogram.mean * 1000:.1f}/"
+                    f"{histogram.percentile(99) * 1000:.1f}/"
+                    f"{histogram.max * 1000:.1f}ms"
+                )
+        intervals = self.intervals
+        parts.append(
+            f"interval {intervals.mean_interval * 1000:.1f}ms, "
+            f"jitter {intervals.jitter * 1000:.1f}ms, {intervals.gaps} gap(s)"
+        )
+        return "; ".join(parts)
+
+
+class FrameTimeline:
+    """Timestamps of a single frame as it passes through the pipeline."""
+
+    __slots__ = ("capture", "stamps", "stats")
+
+    capture: float
+    """Time when the driver process received the frame from the mocap system."""
+
+    stamps: Dict[str, float]
+    """Time when the frame reached each stage of the pipeline so far."""
+
+    stats: Optional[LatencyStats]
+    """Statistics of the connection that the frame came from. Latencies are
+    recorded here whenever a new stage is stamped.
+    """
+
+    def __init__(self, capture: float, stats: Optional[LatencyStats] = None):
+        self.capture = capture
+        self.stamps = {}
+        self.stats = stats
+
+    def stamp(self, stage: str, now: Optional[float] = None) -> float:
+        """Records that the frame reached the given stage and returns the
+        timestamp.
+        """
+        if now is None:
+            now = time()
+        self.stamps[stage] = now
+        if self.stats is not None:
+            self.stats.record(stage, now - self.capture)
+        return now
+
+    @property
+    def age(self) -> float:
+        """Returns the time elapsed since the frame was captured."""
+        return time() - self.capture
+
+
+def attach_timeline(frame: Any, timeline: FrameTimeline) -> None:
+    """Attaches the given timeline to a motion capture frame."""
+    try:
+        frame.timeline = timeline
+    except AttributeError:
+        # frame class does not support extra attributes; this is okay
+        pass
+
+
+def get_timeline(frame: Any) -> Optional[FrameTimeline]:
+    """Returns the timeline attached to the given motion capture frame, or
+    ``None`` if the frame has no timeline.
+    """
+    return getattr(frame, "timeline", None)
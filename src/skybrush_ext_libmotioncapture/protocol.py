@@ -0,0 +1,214 @@
+"""Binary wire format used between the libmotioncapture driver process and
+the extension.
+
+Every message is prefixed by its length as a little-endian 32-bit unsigned
+integer, followed by a single byte that identifies the type of the message.
+The layout of the remainder depends on the message type:
+
+``MSG_NAMES``
+    generation (uint16), number of names (uint16), then each name as a
+    length-prefixed (uint16) UTF-8 string. The numeric ID of a rigid body is
+    its index in this table.
+
+``MSG_FRAME``
+    timestamp (float64), name table generation (uint16), number of records
+    (uint16), then the records themselves in the layout of ``RECORD_DTYPE``.
+
+``MSG_ERROR``
+    UTF-8 encoded error message.
+
+``MSG_STATS``
+    total number of frames dropped and sent by the driver process so far
+    (two uint32 values).
+
+The driver script cannot import this module (it is extracted into a temporary
+file and executed in a separate process), so the layout is mirrored there.
+Keep the two in sync.
+"""
+
+from __future__ import annotations
+
+from numpy import dtype, frombuffer, ndarray
+from struct import Struct
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+__all__ = (
+    "BinaryFrame",
+    "BinaryError",
+    "DriverStats",
+    "NameTable",
+    "create_binary_parser",
+    "decode_frame_body",
+    "encode_frame_message",
+    "encode_names_message",
+    "iter_poses",
+)
+
+
+MSG_NAMES = 1
+MSG_FRAME = 2
+MSG_ERROR = 3
+MSG_STATS = 4
+
+FLAG_HAS_ROTATION = 1
+
+_LENGTH = Struct("<I")
+_MESSAGE_HEADER = Struct("<IB")
+_NAMES_HEADER = Struct("<HH")
+_NAME_LENGTH = Struct("<H")
+_FRAME_HEADER = Struct("<dHH")
+_STATS = Struct("<II")
+
+RECORD_DTYPE = dtype(
+    [
+        ("id", "<u2"),
+        ("flags", "u1"),
+        ("_pad", "u1"),
+        ("pos", "<f4", (3,)),
+        ("rot", "<f4", (4,)),
+    ]
+)
+"""NumPy data type of a single pose record in a frame message. Rotations are
+stored in ``(w, x, y, z)`` order.
+"""
+
+
+class NameTable(NamedTuple):
+    """Name table message received from the driver process."""
+
+    generation: int
+    names: List[str]
+
+
+class BinaryFrame(NamedTuple):
+    """Frame message received from the driver process, with the pose records
+    still in packed form.
+    """
+
+    timestamp: float
+    generation: int
+    records: ndarray
+
+
+class BinaryError(NamedTuple):
+    """Error message received from the driver process."""
+
+    error: str
+
+
+class DriverStats(NamedTuple):
+    """Frame drop statistics reported by the driver process."""
+
+    dropped: int
+    sent: int
+
+
+BinaryMessage = Union[NameTable, BinaryFrame, BinaryError, DriverStats]
+
+
+def decode_frame_body(body: Union[bytes, memoryview]) -> BinaryFrame:
+    """Decodes the body of a frame message (without the length prefix and the
+    type byte).
+    """
+    timestamp, generation, count = _FRAME_HEADER.unpack_from(body, 0)
+    records = frombuffer(
+        body, dtype=RECORD_DTYPE, count=count, offset=_FRAME_HEADER.size
+    )
+    return BinaryFrame(timestamp, generation, records)
+
+
+def encode_names_message(generation: int, names: Sequence[str]) -> bytes:
+    """Encodes a complete name table message, including the length prefix and
+    the type byte, in the same way as the driver process does.
+    """
+    parts = [_NAMES_HEADER.pack(generation & 0xFFFF, len(names))]
+    for name in names:
+        encoded = name.encode("utf-8")
+        parts.append(_NAME_LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+    body = b"".join(parts)
+    return _MESSAGE_HEADER.pack(len(body) + 1, MSG_NAMES) + body
+
+
+def encode_frame_message(timestamp: float, generation: int, records: ndarray) -> bytes:
+    """Encodes a complete frame message, including the length prefix and the
+    type byte, from pose records in the layout of ``RECORD_DTYPE``.
+    """
+    body = _FRAME_HEADER.pack(timestamp, generation & 0xFFFF, len(records))
+    data = records.astype(RECORD_DTYPE, copy=False).tobytes()
+    return _MESSAGE_HEADER.pack(len(body) + len(data) + 1, MSG_FRAME) + body + data
+
+
+def _decode_names_body(body: bytes) -> NameTable:
+    generation, count = _NAMES_HEADER.unpack_from(body, 0)
+    offset = _NAMES_HEADER.size
+    names: List[str] = []
+    for _ in range(count):
+        (length,) = _NAME_LENGTH.unpack_from(body, offset)
+        offset += _NAME_LENGTH.size
+        names.append(body[offset : offset + length].decode("utf-8"))
+        offset += length
+    return NameTable(generation, names)
+
+
+def _decode_message(type: int, body: bytes) -> BinaryMessage:
+    if type == MSG_FRAME:
+        return decode_frame_body(body)
+    elif type == MSG_NAMES:
+        return _decode_names_body(body)
+    elif type == MSG_ERROR:
+        return BinaryError(body.decode("utf-8", errors="replace"))
+    elif type == MSG_STATS:
+        return DriverStats(*_STATS.unpack_from(body, 0))
+    else:
+        raise RuntimeError(
+            f"unknown binary message type received from driver process: {type!r}"
+        )
+
+
+def create_binary_parser():
+    """Creates a parser function that can be fed with chunks of bytes read
+    from the driver process and that returns the binary messages that were
+    completed by each chunk.
+    """
+    buffer = bytearray()
+
+    def parser(data: bytes) -> Iterable[BinaryMessage]:
+        buffer.extend(data)
+
+        result: List[BinaryMessage] = []
+        offset, end = 0, len(buffer)
+        while end - offset >= _LENGTH.size:
+            (length,) = _LENGTH.unpack_from(buffer, offset)
+            start = offset + _LENGTH.size
+            if end - start < length:
+                break
+
+            body = bytes(buffer[start + 1 : start + length])
+            result.append(_decode_message(buffer[start], body))
+            offset = start + length
+
+        if offset:
+            del buffer[:offset]
+
+        return result
+
+    return parser
+
+
+def iter_poses(
+    frame: BinaryFrame, names: List[str]
+) -> Iterable[Tuple[str, List[float], Optional[List[float]]]]:
+    """Iterates over the poses in a binary frame, resolving numeric IDs with
+    the given name table.
+    """
+    records = frame.records
+    ids = records["id"].tolist()
+    positions = records["pos"].tolist()
+    rotations = records["rot"].tolist()
+    has_rotation = (records["flags"] & FLAG_HAS_ROTATION).tolist()
+
+    for id, position, rotation, has_rot in zip(
+        ids, positions, rotations, has_rotation
+    ):
+        yield names[id], position, rotation if has_rot else None
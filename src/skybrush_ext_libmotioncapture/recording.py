@@ -0,0 +1,335 @@
+"""Append-only binary log of motion capture frames, and its reader.
+
+A log starts with a file header: the magic bytes ``LMCL``, the format version
+(uint16), the size of a pose record (uint16) and the time when the recording
+was started (float64), all little-endian. The header is followed by blocks,
+each starting with the type of the block (uint8, padded to four bytes) and
+the length of its body (uint32):
+
+``BLOCK_NAMES``
+    ID of the first name (uint16) and number of names (uint16), then each name
+    as a length-prefixed (uint16) UTF-8 string. Names get consecutive IDs in
+    the order they were first seen, and a names block is written whenever a
+    new rigid body shows up.
+
+``BLOCK_FRAME``
+    source timestamp of the frame (float64), number of pose records (uint32),
+    then the records in the layout of ``RECORD_DTYPE`` of the ``protocol``
+    module, with IDs referring to the name table of the log.
+
+``BLOCK_INDEX``
+    number of frames (uint32, padded to eight bytes), then the timestamp
+    (float64) and the file offset of the body (uint64) of each frame block.
+
+When the log is closed, the complete name table and the index are appended,
+followed by a trailer with the offsets of these two blocks and the magic bytes
+``LMCI``. The reader memory-maps the file and uses the index to seek; logs
+without a trailer (e.g. because the server crashed while recording) are
+scanned block by block instead, up to the last complete block.
+"""
+
+from __future__ import annotations
+
+from numpy import dtype, frombuffer, memmap, ndarray, uint8, zeros
+from pathlib import Path
+from struct import Struct
+from time import strftime, time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from .protocol import FLAG_HAS_ROTATION, RECORD_DTYPE
+
+__all__ = ("MocapLog", "MocapLogWriter")
+
+
+MAGIC = b"LMCL"
+INDEX_MAGIC = b"LMCI"
+VERSION = 1
+
+BLOCK_NAMES = 1
+BLOCK_FRAME = 2
+BLOCK_INDEX = 3
+
+_FILE_HEADER = Struct("<4sHHd")
+_BLOCK_HEADER = Struct("<BxxxI")
+_NAMES_HEADER = Struct("<HH")
+_NAME_LENGTH = Struct("<H")
+_FRAME_HEADER = Struct("<dI")
+_INDEX_HEADER = Struct("<Ixxxx")
+_TRAILER = Struct("<QQ4s")
+
+INDEX_DTYPE = dtype([("timestamp", "<f8"), ("offset", "<u8")])
+"""NumPy data type of a single entry in the index block."""
+
+Item = Tuple[str, Iterable[float], Optional[Iterable[float]]]
+
+
+def _unique_path(path: Union[str, Path]) -> Path:
+    """Expands ``strftime()`` placeholders in the given path and appends a
+    counter to the name of the file if it exists already, so that a recording
+    never overwrites an earlier one.
+    """
+    result = Path(strftime(str(path)))
+    candidate, counter = result, 1
+    while candidate.exists():
+        candidate = result.with_name(f"{result.stem}-{counter}{result.suffix}")
+        counter += 1
+    return candidate
+
+
+def _encode_names(first: int, names: List[str]) -> bytes:
+    parts = [_NAMES_HEADER.pack(first, len(names))]
+    for name in names:
+        encoded = name.encode("utf-8")
+        parts.append(_NAME_LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+    return b"".join(parts)
+
+
+class MocapLogWriter:
+    """Writes motion capture frames into a new log file."""
+
+    path: Path
+    """Path of the log file; ``strftime()`` placeholders of the path given to
+    the constructor are expanded.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = _unique_path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._fp = open(self.path, "wb")
+        self._offset = 0
+        self._names: List[str] = []
+        self._ids: Dict[str, int] = {}
+        self._index: List[Tuple[float, int]] = []
+
+        # Mapping from the IDs of the most recent name table of a connection
+        # to our IDs, and the name table it was made for
+        self._source_names: Optional[List[str]] = None
+        self._source_ids: Optional[ndarray] = None
+
+        self._write(_FILE_HEADER.pack(MAGIC, VERSION, RECORD_DTYPE.itemsize, time()))
+
+    @property
+    def frame_count(self) -> int:
+        return len(self._index)
+
+    def write_records(
+        self, timestamp: float, records: ndarray, names: List[str]
+    ) -> None:
+        """Appends a frame given as records in the layout of ``RECORD_DTYPE``,
+        whose IDs refer to the given name table.
+        """
+        if names is not self._source_names:
+            self._source_ids = zeros(max(len(names), 1), dtype="<u2")
+            for index, name in enumerate(names):
+                self._source_ids[index] = self._get_id(name)
+            self._source_names = names
+
+        assert self._source_ids is not None
+        translated = records.copy()
+        translated["id"] = self._source_ids[records["id"]]
+        self._write_frame(timestamp, translated)
+
+    def write_items(self, timestamp: float, items: Iterable[Item]) -> None:
+        """Appends a frame given as (name, position, rotation) tuples, with
+        rotations in ``(w, x, y, z)`` order.
+        """
+        items = list(items)
+        records = zeros(len(items), dtype=RECORD_DTYPE)
+        for record, (name, position, rotation) in zip(records, items):
+            record["id"] = self._get_id(name)
+            record["pos"] = position
+            if rotation is not None:
+                record["flags"] = FLAG_HAS_ROTATION
+                record["rot"] = rotation
+        self._write_frame(timestamp, records)
+
+    def close(self) -> None:
+        """Appends the name table, the index and the trailer, and closes the
+        file.
+        """
+        if self._fp.closed:
+            return
+
+        names_offset = self._offset
+        self._write_block(BLOCK_NAMES, _encode_names(0, self._names))
+
+        index = zeros(len(self._index), dtype=INDEX_DTYPE)
+        if self._index:
+            index["timestamp"], index["offset"] = zip(*self._index)
+        index_offset = self._offset
+        self._write_block(
+            BLOCK_INDEX, _INDEX_HEADER.pack(len(index)) + index.tobytes()
+        )
+
+        self._write(_TRAILER.pack(names_offset, index_offset, INDEX_MAGIC))
+        self._fp.close()
+
+    def __enter__(self) -> "MocapLogWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _get_id(self, name: str) -> int:
+        id = self._ids.get(name)
+        if id is None:
+            id = self._ids[name] = len(self._names)
+            self._names.append(name)
+            self._write_block(BLOCK_NAMES, _encode_names(id, [name]))
+        return id
+
+    def _write_frame(self, timestamp: float, records: ndarray) -> None:
+        self._index.append((timestamp, self._offset + _BLOCK_HEADER.size))
+        self._write_block(
+            BLOCK_FRAME,
+            _FRAME_HEADER.pack(timestamp, len(records)) + records.tobytes(),
+        )
+
+    def _write_block(self, type: int, body: bytes) -> None:
+        self._write(_BLOCK_HEADER.pack(type, len(body)) + body)
+
+    def _write(self, data: bytes) -> None:
+        self._fp.write(data)
+        self._offset += len(data)
+
+
+class MocapLog:
+    """Memory-mapped reader of a log written by ``MocapLogWriter``."""
+
+    names: List[str]
+    """Name table of the log; the IDs of the pose records are indices into
+    this list.
+    """
+
+    timestamps: ndarray
+    """Source timestamps of the frames, in the order they were recorded."""
+
+    started_at: float
+    """Time when the recording was started."""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._data = memmap(self.path, dtype=uint8, mode="r")
+
+        if len(self._data) < _FILE_HEADER.size:
+            raise RuntimeError(f"not a mocap log: {self.path}")
+        magic, version, record_size, self.started_at = _FILE_HEADER.unpack_from(
+            self._data, 0
+        )
+        if magic != MAGIC:
+            raise RuntimeError(f"not a mocap log: {self.path}")
+        if version != VERSION or record_size != RECORD_DTYPE.itemsize:
+            raise RuntimeError(f"unsupported mocap log version: {version}")
+
+        if not self._read_index():
+            self._scan()
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    @property
+    def duration(self) -> float:
+        return float(self.timestamps[-1] - self.timestamps[0]) if len(self) else 0.0
+
+    def frame(self, index: int) -> Tuple[float, ndarray]:
+        """Returns the timestamp and the pose records of the frame with the
+        given index. The records are a read-only view into the file.
+        """
+        offset = int(self._offsets[index])
+        timestamp, count = _FRAME_HEADER.unpack_from(self._data, offset)
+        start = offset + _FRAME_HEADER.size
+        records = self._data[start : start + count * RECORD_DTYPE.itemsize]
+        return timestamp, records.view(RECORD_DTYPE)
+
+    def find(self, timestamp: float) -> int:
+        """Returns the index of the first frame recorded at or after the given
+        source timestamp.
+        """
+        return int(self.timestamps.searchsorted(timestamp))
+
+    def iter_frames(
+        self, start: int = 0, end: Optional[int] = None
+    ) -> Iterator[Tuple[float, ndarray]]:
+        """Iterates over the timestamps and pose records of the frames in the
+        given range.
+        """
+        for index in range(start, len(self) if end is None else min(end, len(self))):
+            yield self.frame(index)
+
+    def _read_index(self) -> bool:
+        data = self._data
+        if len(data) < _FILE_HEADER.size + _TRAILER.size:
+            return False
+
+        names_offset, index_offset, magic = _TRAILER.unpack_from(
+            data, len(data) - _TRAILER.size
+        )
+        if magic != INDEX_MAGIC:
+            return False
+
+        type, _ = _BLOCK_HEADER.unpack_from(data, names_offset)
+        if type != BLOCK_NAMES:
+            return False
+        names: List[str] = []
+        self._decode_names(names_offset + _BLOCK_HEADER.size, names)
+
+        type, _ = _BLOCK_HEADER.unpack_from(data, index_offset)
+        if type != BLOCK_INDEX:
+            return False
+        start = index_offset + _BLOCK_HEADER.size
+        (count,) = _INDEX_HEADER.unpack_from(data, start)
+        index = frombuffer(
+            data, dtype=INDEX_DTYPE, count=count, offset=start + _INDEX_HEADER.size
+        )
+
+        self.names = names
+        self.timestamps = index["timestamp"]
+        self._offsets = index["offset"]
+        return True
+
+    def _scan(self) -> None:
+        data = self._data
+        end = len(data)
+        names: List[str] = []
+        timestamps: List[float] = []
+        offsets: List[int] = []
+
+        offset = _FILE_HEADER.size
+        while end - offset >= _BLOCK_HEADER.size:
+            type, length = _BLOCK_HEADER.unpack_from(data, offset)
+            body = offset + _BLOCK_HEADER.size
+            if end - body < length:
+                break  # truncated by a crash while recording
+
+            if type == BLOCK_FRAME:
+                timestamp, count = _FRAME_HEADER.unpack_from(data, body)
+                if _FRAME_HEADER.size + count * RECORD_DTYPE.itemsize > length:
+                    break
+                timestamps.append(timestamp)
+                offsets.append(body)
+            elif type == BLOCK_NAMES:
+                self._decode_names(body, names)
+
+            offset = body + length
+
+        self.names = names
+        self.timestamps = zeros(len(timestamps), dtype="<f8")
+        self.timestamps[:] = timestamps
+        self._offsets = zeros(len(offsets), dtype="<u8")
+        self._offsets[:] = offsets
+
+    def _decode_names(self, offset: int, names: List[str]) -> None:
+        # Decodes a names block into the given name table, which is extended
+        # as needed
+        data = self._data
+        first, count = _NAMES_HEADER.unpack_from(data, offset)
+        offset += _NAMES_HEADER.size
+        if len(names) < first + count:
+            names.extend([""] * (first + count - len(names)))
+        for index in range(first, first + count):
+            (length,) = _NAME_LENGTH.unpack_from(data, offset)
+            offset += _NAME_LENGTH.size
+            names[index] = bytes(data[offset : offset + length]).decode("utf-8")
+            offset += length
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+from pathlib import Path
+from time import time
+from trio import current_time, lowlevel, sleep_until
+from typing import AsyncIterable, Callable, Optional, Union, TYPE_CHECKING
+
+from .latency import FrameTimeline, LatencyStats, attach_timeline
+from .protocol import BinaryFrame, iter_poses
+from .recording import MocapLog
+
+if TYPE_CHECKING:
+    from flockwave.server.ext.motion_capture import MotionCaptureFrame
+
+__all__ = ("ReplayConnection",)
+
+
+class ReplayConnection:
+    """Connection that plays back the frames of a log recorded with
+    ``MocapLogWriter`` instead of receiving them from a mocap system.
+
+    It provides the same interface towards the extension as
+    ``LibmotioncaptureConnection`` does, so recorded sessions can stand in for
+    a live mocap system, e.g. as a reproducible workload.
+    """
+
+    dropped_frame_count: int = 0
+    sent_frame_count: int = 0
+
+    latency_stats: Optional[LatencyStats] = None
+    """Latency statistics of the connection. When set, each frame gets a
+    ``FrameTimeline`` attached that starts when the frame is played back.
+    """
+
+    last_timestamp: Optional[float] = None
+    """Time when the frame returned most recently was played back; the
+    timestamps of the log are in the past, so frames count as captured when
+    they are played back.
+    """
+
+    frame_factory: Optional[Callable[[], "MotionCaptureFrame"]] = None
+    """Function that can be called with no arguments and that returns a new
+    MotionCaptureFrame_ instance. Must be set before calling ``iter_frames()``.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        speed: float = 1.0,
+        loop: bool = False,
+        start: float = 0.0,
+    ):
+        """Constructor.
+
+        Parameters:
+            path: path of the log file to play back
+            speed: playback speed relative to the speed of the recording;
+                zero plays back the frames as fast as possible
+            loop: whether to start over when the end of the log is reached
+            start: number of seconds to skip from the start of the log
+        """
+        if speed < 0:
+            raise RuntimeError(f"invalid replay speed: {speed!r}")
+
+        self._log = MocapLog(path)
+        self._speed = float(speed)
+        self._loop = bool(loop)
+        self._start = float(start)
+
+    async def iter_frames(self) -> AsyncIterable["MotionCaptureFrame"]:
+        frame_factory = self.frame_factory
+        assert frame_factory is not None
+
+        log = self._log
+        if not len(log):
+            return
+
+        first = log.find(log.timestamps[0] + self._start)
+        speed = self._speed
+
+        while True:
+            started_at = current_time()
+            origin: Optional[float] = None
+
+            for timestamp, records in log.iter_frames(first):
+                if origin is None:
+                    origin = timestamp
+
+                if speed > 0:
+                    await sleep_until(started_at + (timestamp - origin) / speed)
+                else:
+                    await lowlevel.checkpoint()
+
+                frame = frame_factory()
+                for name, position, rotation in iter_poses(
+                    BinaryFrame(timestamp, 0, records), log.names
+                ):
+                    frame.add_item(name, position, rotation)
+                self.last_timestamp = time()
+                self._add_timeline(frame, self.last_timestamp)
+
+                self.sent_frame_count += 1
+                yield frame
+
+            if not self._loop:
+                break
+
+    def _add_timeline(self, frame: "MotionCaptureFrame", capture: float) -> None:
+        stats = self.latency_stats
+        if stats is not None:
+            stats.intervals.add(capture)
+            timeline = FrameTimeline(capture, stats)
+            timeline.stamp("decode")
+            attach_timeline(frame, timeline)
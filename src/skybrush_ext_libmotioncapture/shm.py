@@ -0,0 +1,153 @@
+"""Shared memory "latest frame" buffer between the libmotioncapture driver
+process and the extension.
+
+The buffer is a memory-mapped file that consists of a fixed-size header and
+two slots. The driver process writes each frame into the slot that is *not*
+holding the most recently published frame and then publishes it by bumping a
+sequence counter in the header. The counter is odd while a write is in
+progress and equal to twice the number of published frames otherwise; frame
+``k`` lives in slot ``k % 2``. The reader takes the newest published frame,
+copies it out and re-reads the counter to verify that the writer did not
+start overwriting the same slot in the meanwhile (seqlock).
+
+Each slot holds the length of the frame as a little-endian 32-bit unsigned
+integer, followed by the body of a ``MSG_FRAME`` message of the binary wire
+format (see the ``protocol`` module). Name tables and errors are still sent
+over the standard output of the driver process.
+
+The writer side is mirrored in the driver script as the script cannot import
+this module. Keep the two in sync.
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+from mmap import mmap
+from pathlib import Path
+from struct import Struct
+from tempfile import NamedTemporaryFile
+from typing import Iterator, Optional
+
+from .protocol import BinaryFrame, decode_frame_body
+
+__all__ = ("SharedFrameBuffer", "shared_frame_buffer")
+
+
+MAGIC = b"LMCF"
+VERSION = 1
+
+_HEADER = Struct("<4sHxxI")
+_SEQ = Struct("<Q")
+_SLOT_LENGTH = Struct("<I")
+
+SEQ_OFFSET = 16
+SLOTS_OFFSET = 32
+
+DEFAULT_SLOT_SIZE = 65536
+"""Default size of a single slot, in bytes. This is enough for ~2000 rigid
+bodies in a single frame.
+"""
+
+MAX_READ_ATTEMPTS = 3
+"""Maximum number of attempts to read a consistent frame from the buffer before
+giving up until the next poll.
+"""
+
+
+class SharedFrameBuffer:
+    """Reader side of a shared memory frame buffer."""
+
+    path: Path
+    """Path of the memory-mapped file backing the buffer."""
+
+    slot_size: int
+    """Size of a single slot in the buffer, in bytes."""
+
+    _mm: mmap
+    _last_seq: int
+
+    def __init__(self, path: Path, slot_size: int = DEFAULT_SLOT_SIZE):
+        """Constructor.
+
+        Creates or truncates the file at the given path, initializes the
+        header and maps the file into memory.
+        """
+        self.path = path
+        self.slot_size = slot_size
+        self._last_seq = 0
+
+        size = SLOTS_OFFSET + 2 * slot_size
+        with open(path, "w+b") as fp:
+            fp.truncate(size)
+            fp.write(_HEADER.pack(MAGIC, VERSION, slot_size))
+            fp.flush()
+            self._mm = mmap(fp.fileno(), size)
+
+    def close(self) -> None:
+        """Unmaps the buffer from memory."""
+        self._mm.close()
+
+    def read_latest(self) -> Optional[BinaryFrame]:
+        """Returns the newest frame from the buffer if it was published since
+        the last call, ``None`` otherwise.
+        """
+        mm = self._mm
+
+        for _ in range(MAX_READ_ATTEMPTS):
+            (seq,) = _SEQ.unpack_from(mm, SEQ_OFFSET)
+            if seq < self._last_seq:
+                # Writer restarted; start over
+                self._last_seq = 0
+
+            index = seq >> 1
+            if index == 0 or index << 1 == self._last_seq:
+                return None
+
+            start = SLOTS_OFFSET + (index & 1) * self.slot_size
+            (length,) = _SLOT_LENGTH.unpack_from(mm, start)
+            if length > self.slot_size - _SLOT_LENGTH.size:
+                length = 0
+            body = mm[start + _SLOT_LENGTH.size : start + _SLOT_LENGTH.size + length]
+
+            (seq_after,) = _SEQ.unpack_from(mm, SEQ_OFFSET)
+            if seq_after <= (index << 1) + 2 and length:
+                self._last_seq = index << 1
+                return decode_frame_body(body)
+
+        return None
+
+
+@contextmanager
+def shared_frame_buffer(
+    slot_size: int = DEFAULT_SLOT_SIZE,
+) -> Iterator[SharedFrameBuffer]:
+    """Context manager that creates a shared frame buffer in a temporary file
+    when the context is entered and removes it when the context is exited.
+
+    The file is created in ``/dev/shm`` if it exists so it is never written to
+    disk.
+    """
+    shm_dir = Path("/dev/shm")
+    path: Optional[Path] = None
+    buffer: Optional[SharedFrameBuffer] = None
+
+    try:
+        with NamedTemporaryFile(
+            prefix="lmc-",
+            suffix=".shm",
+            dir=str(shm_dir) if shm_dir.is_dir() else None,
+            delete=False,
+        ) as fp:
+            path = Path(fp.name)
+
+        buffer = SharedFrameBuffer(path, slot_size)
+        yield buffer
+    finally:
+        if buffer:
+            buffer.close()
+        try:
+            if path:
+                path.unlink(missing_ok=True)
+        except Exception:
+            # this is okay
+            pass
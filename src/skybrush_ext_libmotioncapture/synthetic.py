@@ -0,0 +1,153 @@
+"""Synthetic motion capture source for benchmarks and load tests.
+
+The source produces frames of a configurable number of rigid bodies that move
+along horizontal circles, encoded in the same wire formats as the frames of
+the driver process, so they can be fed to ``LibmotioncaptureConnection``
+without a mocap system or the ``motioncapture`` module.
+"""
+
+from __future__ import annotations
+
+import json
+
+from numpy import arange, cos, ndarray, sin, zeros
+from numpy.random import default_rng
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from .protocol import (
+    FLAG_HAS_ROTATION,
+    RECORD_DTYPE,
+    encode_frame_message,
+    encode_names_message,
+)
+
+__all__ = ("SyntheticMocapSource",)
+
+
+DEFAULT_PREFIXES = ("bu", "hook", "test")
+"""Name prefixes of the rigid bodies that the aimotionlab extension broadcasts
+by default.
+"""
+
+
+class SyntheticMocapSource:
+    """Generates frames of rigid bodies moving along circles.
+
+    A given share of the bodies is named after one of the given prefixes and a
+    number (e.g. ``bu3``), like the objects whose poses the aimotionlab
+    extension broadcasts; the rest are named like drones (e.g. ``cf7``).
+    """
+
+    names: List[str]
+    """Names of the rigid bodies, in the order of their numeric IDs."""
+
+    def __init__(
+        self,
+        body_count: int = 10,
+        matching_share: float = 0.5,
+        prefixes: Sequence[str] = DEFAULT_PREFIXES,
+        seed: Optional[int] = 0,
+    ):
+        """Constructor.
+
+        Parameters:
+            body_count: number of rigid bodies in each frame
+            matching_share: share of the rigid bodies (between 0 and 1) whose
+                names consist of one of the given prefixes and a number
+            prefixes: name prefixes to use for the matching rigid bodies
+            seed: seed of the random number generator that sets up the
+                trajectories; ``None`` for a different setup on every run
+        """
+        if body_count < 1:
+            raise ValueError("at least one rigid body is needed")
+        if not 0 <= matching_share <= 1:
+            raise ValueError("matching share must be between 0 and 1")
+        if matching_share > 0 and not prefixes:
+            raise ValueError("matching rigid bodies need at least one prefix")
+
+        matching = round(body_count * matching_share)
+        self.names = [
+            f"{prefixes[index % len(prefixes)]}{index}" for index in range(matching)
+        ] + [f"cf{index}" for index in range(matching, body_count)]
+
+        rng = default_rng(seed)
+        self._centers = rng.uniform(-2.0, 2.0, (body_count, 2))
+        self._heights = rng.uniform(0.2, 2.0, body_count)
+        self._radii = rng.uniform(0.1, 1.0, body_count)
+        self._speeds = rng.uniform(-2.0, 2.0, body_count)  # rad/s
+        self._phases = rng.uniform(0.0, 6.283, body_count)
+
+        self._records = zeros(body_count, dtype=RECORD_DTYPE)
+        self._records["id"] = arange(body_count)
+        self._records["flags"] = FLAG_HAS_ROTATION
+
+    @property
+    def body_count(self) -> int:
+        return len(self.names)
+
+    def records_at(self, timestamp: float) -> ndarray:
+        """Returns the poses of all the rigid bodies at the given time as
+        records in the layout of ``RECORD_DTYPE``. The returned array is
+        reused by subsequent calls.
+        """
+        angles = self._phases + self._speeds * timestamp
+        records = self._records
+        position = records["pos"]
+        position[:, 0] = self._centers[:, 0] + self._radii * cos(angles)
+        position[:, 1] = self._centers[:, 1] + self._radii * sin(angles)
+        position[:, 2] = self._heights
+
+        # Bodies face the direction they are moving in, i.e. yaw only
+        rotation = records["rot"]
+        rotation[:, 0] = cos(angles / 2)
+        rotation[:, 3] = sin(angles / 2)
+        return records
+
+    def encode_names(self, generation: int = 1) -> bytes:
+        """Returns the name table message of the binary wire format."""
+        return encode_names_message(generation, self.names)
+
+    def encode_binary_frame(self, timestamp: float, generation: int = 1) -> bytes:
+        """Returns the frame message of the binary wire format with the poses
+        at the given time.
+        """
+        return encode_frame_message(timestamp, generation, self.records_at(timestamp))
+
+    def encode_json_frame(self, timestamp: float) -> bytes:
+        """Returns the frame message of the JSON wire format with the poses at
+        the given time, in the same layout as the driver process sends it.
+        """
+        records = self.records_at(timestamp)
+        positions = records["pos"].astype(float).round(3).tolist()
+        rotations = records["rot"].tolist()
+        items = [
+            (name, position, rotation)
+            for name, position, rotation in zip(self.names, positions, rotations)
+        ]
+        message = {"items": items, "t": timestamp}
+        return (
+            json.dumps(message, sort_keys=True, separators=(",", ":")).encode("ascii")
+            + b"\n"
+        )
+
+    def iter_messages(
+        self, count: int, rate: float, format: str = "binary", start: float = 0.0
+    ) -> Iterator[Tuple[float, bytes]]:
+        """Iterates over the given number of frames sent at the given rate,
+        yielding the timestamp and the encoded frame of each. In the binary
+        format, the first frame is preceded by the name table.
+        """
+        if format not in ("json", "binary"):
+            raise ValueError(f"unknown wire format: {format!r}")
+
+        period = 1.0 / rate
+        for index in range(count):
+            timestamp = start + index * period
+            if format == "json":
+                yield timestamp, self.encode_json_frame(timestamp)
+            elif index == 0:
+                yield timestamp, self.encode_names() + self.encode_binary_frame(
+                    timestamp
+                )
+            else:
+                yield timestamp, self.encode_binary_frame(timestamp)
@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+from threading import Event
+from time import time
+from trio import to_thread
+from typing import Any, Callable, Dict, Optional, Tuple, TYPE_CHECKING
+
+from flockwave.connections import ConnectionBase
+
+from .latency import FrameTimeline, LatencyStats, attach_timeline
+from .recording import MocapLogWriter
+
+if TYPE_CHECKING:
+    from flockwave.server.ext.motion_capture import MotionCaptureFrame
+
+__all__ = ("ThreadedLibmotioncaptureConnection",)
+
+
+LatestFrame = Tuple[int, float, Dict[str, Any]]
+"""Sequence number, capture timestamp and rigid bodies of the newest frame
+received by the worker thread.
+"""
+
+STOP_TIMEOUT = 2.0
+"""Number of seconds to wait for the worker thread of the previous run of a
+connection to stop when the connection is opened again.
+"""
+
+
+class ThreadedLibmotioncaptureConnection(ConnectionBase):
+    """Connection to a mocap system that runs the ``motioncapture`` client in
+    a worker thread of the server process instead of a separate driver
+    process.
+
+    Opening the connection connects to the mocap system; ``run()`` then
+    receives frames until the connection fails or is closed.
+
+    The worker thread blocks in ``waitForNextFrame()`` and replaces the latest
+    frame slot with each new frame; the event loop polls the slot with
+    ``read_latest_frame()``, skipping the frames that were replaced in the
+    meanwhile. There is no encoding or pipe between the two, and connecting
+    does not need to start and initialize a new Python interpreter.
+    """
+
+    _latest: Optional[LatestFrame]
+    """The latest frame slot. The worker thread replaces it with a new tuple
+    for every frame; replacing a reference is atomic, so neither side needs a
+    lock and the event loop never waits for the worker thread.
+    """
+
+    _read_seq: int
+    """Sequence number of the frame returned most recently by
+    ``read_latest_frame()``.
+    """
+
+    dropped_frame_count: int = 0
+    """Number of frames that were replaced in the latest frame slot before
+    they were read.
+    """
+
+    sent_frame_count: int = 0
+    """Number of frames read from the latest frame slot."""
+
+    latency_stats: Optional[LatencyStats] = None
+    """Latency statistics of the connection. When set, each frame gets a
+    ``FrameTimeline`` attached that starts when the worker thread received the
+    frame.
+    """
+
+    frame_factory: Optional[Callable[[], "MotionCaptureFrame"]] = None
+    """Function that can be called with no arguments and that returns a new
+    MotionCaptureFrame_ instance. Must be set before calling ``run()``.
+    """
+
+    last_timestamp: Optional[float] = None
+    """Time when the worker thread received the frame returned most recently."""
+
+    recorder: Optional[MocapLogWriter] = None
+    """Log that every frame read from the slot is appended to; ``None`` if
+    frames are not recorded.
+    """
+
+    def __init__(self, type: str, parameters: Dict[str, str]):
+        """Constructor.
+
+        Parameters:
+            type: type of the mocap system to connect to
+            parameters: connection parameters to pass to libmotioncapture
+        """
+        super().__init__()
+
+        self._type = type
+        self._parameters = dict(parameters)
+        self._latest = None
+        self._read_seq = 0
+
+        # Client object of libmotioncapture between opening the connection
+        # and handing it over to the worker thread in run()
+        self._client: Any = None
+
+        # Events of the current worker thread: a request to stop, and the
+        # notification that it has stopped
+        self._stopped: Optional[Event] = None
+        self._exited: Optional[Event] = None
+
+    async def _open(self) -> None:
+        # The worker thread of the previous run may still be waiting for a
+        # frame; give it some time to let go of its client first. We go on
+        # after the timeout anyway so that a mocap system that went silent
+        # cannot prevent reconnecting.
+        exited = self._exited
+        if exited is not None and not exited.is_set():
+            await to_thread.run_sync(exited.wait, STOP_TIMEOUT, cancellable=True)
+
+        self._latest = None
+        self._read_seq = 0
+        self._client = await to_thread.run_sync(self._connect, cancellable=True)
+
+    async def _close(self) -> None:
+        if self._stopped is not None:
+            self._stopped.set()
+        self._client = None
+
+    async def run(self) -> None:
+        """Keeps on receiving frames in a worker thread until cancelled or
+        until the connection fails. The connection must be open.
+
+        ``waitForNextFrame()`` cannot be interrupted, so the worker thread is
+        abandoned when the task is cancelled, and it stops on its own after
+        the next frame.
+        """
+        if self._client is None:
+            raise RuntimeError("libmotioncapture connection is not open")
+
+        stopped = self._stopped = Event()
+        exited = self._exited = Event()
+        try:
+            await to_thread.run_sync(
+                self._receive_frames, stopped, exited, cancellable=True
+            )
+        finally:
+            stopped.set()
+
+    def read_latest_frame(self) -> Optional["MotionCaptureFrame"]:
+        """Returns the newest frame received by the worker thread if it was not
+        returned yet, ``None`` otherwise.
+        """
+        frame_factory = self.frame_factory
+        assert frame_factory is not None
+
+        latest = self._latest
+        if latest is None or latest[0] == self._read_seq:
+            return None
+
+        seq, timestamp, rigid_bodies = latest
+        self.dropped_frame_count += seq - self._read_seq - 1
+        self.sent_frame_count += 1
+        self._read_seq = seq
+        self.last_timestamp = timestamp
+
+        items = []
+        for name, obj in rigid_bodies.items():
+            x, y, z = obj.position
+            rot = obj.rotation
+            items.append(
+                (
+                    name,
+                    (float(x), float(y), float(z)),
+                    (rot.w, rot.x, rot.y, rot.z) if rot is not None else None,
+                )
+            )
+
+        frame = frame_factory()
+        for name, position, rotation in items:
+            frame.add_item(name, position, rotation)
+
+        stats = self.latency_stats
+        if stats is not None:
+            stats.intervals.add(timestamp)
+            timeline = FrameTimeline(timestamp, stats)
+            timeline.stamp("decode")
+            attach_timeline(frame, timeline)
+
+        if self.recorder is not None:
+            self.recorder.write_items(timestamp, items)
+
+        return frame
+
+    def _connect(self) -> Any:
+        # Runs in a worker thread
+        try:
+            from .driver import connect
+        except ImportError as ex:
+            raise RuntimeError(f"libmotioncapture is not available: {ex}") from None
+
+        return connect(self._type, self._parameters)
+
+    def _receive_frames(self, stopped: Event, exited: Event) -> None:
+        # Runs in the worker thread. The client is only referenced from here
+        # so that it is released (and disconnects) when the thread stops; it
+        # is None if the connection was closed in the meanwhile.
+        mc, self._client = self._client, None
+        try:
+            seq = 0
+            while mc is not None and not stopped.is_set():
+                mc.waitForNextFrame()
+                now = time()
+                if stopped.is_set():
+                    break
+
+                seq += 1
+                self._latest = (seq, now, mc.rigidBodies)
+        finally:
+            close = getattr(mc, "close", None)
+            if close is not None:
+                close()
+            del mc
+            exited.set()
@@ -0,0 +1,91 @@
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+
+from skybrush_ext_aimotionlab import classifier  # noqa: E402
+from skybrush_ext_aimotionlab.classifier import ObjectClassifier  # noqa: E402
+
+
+def test_default_prefixes():
+    objects = ObjectClassifier()
+    assert objects.classify("bu12") == (12, "bu")
+    assert objects.classify("hook3") == (3, "hook")
+    assert objects.classify("test07") == (7, "test")
+    assert objects.classify("cf1") is None
+    assert objects.classify("hook") is None
+    assert objects.classify("hook3a") is None
+
+
+@pytest.mark.parametrize("prefixes", [("h", "hook"), ("hook", "h")])
+def test_longest_prefix_wins(prefixes):
+    objects = ObjectClassifier(prefixes)
+    assert objects.classify("hook3") == (3, "hook")
+    assert objects.classify("h3") == (3, "h")
+
+
+@pytest.mark.parametrize("prefixes", [("cf", "cf1"), ("cf1", "cf")])
+def test_longest_prefix_wins_when_both_match(prefixes):
+    objects = ObjectClassifier(prefixes)
+    assert objects.classify("cf12") == (2, "cf1")
+    assert objects.classify("cf2") == (2, "cf")
+
+
+def test_pattern_with_id_group():
+    objects = ObjectClassifier(
+        (), {"payload": r"(?P<kind>box|bag)_(?P<id>\d+)(_v\d+)?"}
+    )
+    assert objects.classify("box_4") == (4, "payload")
+    assert objects.classify("bag_15_v2") == (15, "payload")
+    assert objects.classify("crate_4") is None
+
+
+def test_pattern_with_single_group():
+    objects = ObjectClassifier((), {"obstacle": r"wall-(\d+)"})
+    assert objects.classify("wall-8") == (8, "obstacle")
+    assert objects.classify("wall-8x") is None
+
+
+def test_prefixes_come_before_patterns():
+    objects = ObjectClassifier(("bu",), {"other": r"b\w(\d+)"})
+    assert objects.classify("bu1") == (1, "bu")
+    assert objects.classify("bx1") == (1, "other")
+
+
+@pytest.mark.parametrize("pattern", [r"obj\d+", r"(obj)(\d+)", r"(?P<num>\d+)-(\d+)"])
+def test_pattern_without_id_group(pattern):
+    with pytest.raises(ValueError, match="needs an 'id' group"):
+        ObjectClassifier((), {"cls": pattern})
+
+
+def test_from_configuration():
+    objects = ObjectClassifier.from_configuration(
+        {"object_prefixes": ["ball"], "object_patterns": {"gate": r"gate(\d+)"}}
+    )
+    assert objects.classify("ball1") == (1, "ball")
+    assert objects.classify("gate2") == (2, "gate")
+    assert objects.classify("bu1") is None
+    assert ObjectClassifier.from_configuration({}).classify("bu1") == (1, "bu")
+
+
+def test_cache_is_reset_when_full(monkeypatch):
+    monkeypatch.setattr(classifier, "MAX_CACHE_SIZE", 4)
+    objects = ObjectClassifier()
+    for index in range(4):
+        assert objects.classify(f"bu{index}") == (index, "bu")
+    assert len(objects._cache) == 4
+
+    objects.classify("random-name")
+    assert list(objects._cache) == ["random-name"]
+
+    # Results after the reset are still correct
+    assert objects.classify("bu2") == (2, "bu")
+    assert objects.classify("random-name") is None
+    assert len(objects._cache) == 2
+
+
+def test_results_are_cached(monkeypatch):
+    objects = ObjectClassifier()
+    assert objects.classify("bu1") == (1, "bu")
+    monkeypatch.setattr(objects, "_rules", [])
+    assert objects.classify("bu1") == (1, "bu")
+    assert objects.classify("bu2") is None
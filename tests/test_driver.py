@@ -0,0 +1,140 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+driver = pytest.importorskip(
+    "skybrush_ext_libmotioncapture.driver", reason="the driver needs libmotioncapture"
+)
+
+from skybrush_ext_libmotioncapture import protocol, shm  # noqa: E402
+from skybrush_ext_libmotioncapture.protocol import (  # noqa: E402
+    BinaryError,
+    BinaryFrame,
+    DriverStats,
+    NameTable,
+    create_binary_parser,
+    iter_poses,
+)
+
+
+def rigid_body(position, rotation=None):
+    if rotation is not None:
+        w, x, y, z = rotation
+        rotation = SimpleNamespace(w=w, x=x, y=y, z=z)
+    return SimpleNamespace(position=position, rotation=rotation)
+
+
+def parse_in_chunks(data: bytes, size: int):
+    parser = create_binary_parser()
+    result = []
+    for start in range(0, len(data), size):
+        result.extend(parser(data[start : start + size]))
+    return result
+
+
+def test_binary_writer_output_is_parsed_by_extension(capsysbinary):
+    writer = driver.BinaryFrameWriter()
+    writer.write_frame(
+        12.5,
+        {"cf1": rigid_body((1, 2, 3), (1, 0, 0, 0)), "box": rigid_body((4, 5, 6))},
+    )
+    writer.write_frame(13.0, {"cf1": rigid_body((1.5, 2, 3), (0, 1, 0, 0))})
+    writer.write_stats(3, 17)
+    writer.write_error("connection lost")
+
+    data = capsysbinary.readouterr().out
+    for chunk_size in (1, 7, len(data)):
+        messages = parse_in_chunks(data, chunk_size)
+        assert [type(message) for message in messages] == [
+            NameTable,
+            BinaryFrame,
+            NameTable,
+            BinaryFrame,
+            DriverStats,
+            BinaryError,
+        ]
+
+        names, first, new_names, second, stats, error = messages
+        assert names == NameTable(1, ["cf1", "box"])
+        assert first.timestamp == 12.5
+        assert first.generation == 1
+        assert list(iter_poses(first, names.names)) == [
+            ("cf1", [1.0, 2.0, 3.0], [1.0, 0.0, 0.0, 0.0]),
+            ("box", [4.0, 5.0, 6.0], None),
+        ]
+
+        assert new_names == NameTable(2, ["cf1"])
+        assert second.generation == 2
+        assert list(iter_poses(second, new_names.names)) == [
+            ("cf1", [1.5, 2.0, 3.0], [0.0, 1.0, 0.0, 0.0])
+        ]
+
+        assert stats == DriverStats(3, 17)
+        assert error == BinaryError("connection lost")
+
+
+def test_extension_encoding_matches_driver(capsysbinary):
+    writer = driver.BinaryFrameWriter()
+    body = writer.encode_frame(
+        1.0, {"a": rigid_body((1, 2, 3), (1, 0, 0, 0)), "b": rigid_body((4, 5, 6))}
+    )
+    names = capsysbinary.readouterr().out
+
+    assert names == protocol.encode_names_message(1, ["a", "b"])
+    frame = protocol.decode_frame_body(body)
+    assert protocol.encode_frame_message(1.0, 1, frame.records) == (
+        driver._HEADER.pack(len(body) + 1, driver.MSG_FRAME) + body
+    )
+
+
+def test_wire_format_is_in_sync():
+    for name in ("MSG_NAMES", "MSG_FRAME", "MSG_ERROR", "MSG_STATS"):
+        assert getattr(driver, name) == getattr(protocol, name)
+    assert driver.FLAG_HAS_ROTATION == protocol.FLAG_HAS_ROTATION
+
+    assert driver._HEADER.format == protocol._MESSAGE_HEADER.format
+    for name in ("_NAMES_HEADER", "_NAME_LENGTH", "_FRAME_HEADER", "_STATS"):
+        assert getattr(driver, name).format == getattr(protocol, name).format
+
+    assert driver._RECORD.size == protocol.RECORD_DTYPE.itemsize
+    record = driver._RECORD.pack(7, 1, 1, 2, 3, 4, 5, 6, 7)
+    (decoded,) = protocol.decode_frame_body(
+        driver._FRAME_HEADER.pack(0.0, 0, 1) + record
+    ).records
+    assert decoded["id"] == 7
+    assert decoded["flags"] == 1
+    assert decoded["pos"].tolist() == [1, 2, 3]
+    assert decoded["rot"].tolist() == [4, 5, 6, 7]
+
+
+def test_shared_memory_layout_is_in_sync():
+    assert driver.SHM_MAGIC == shm.MAGIC
+    assert driver.SHM_SEQ_OFFSET == shm.SEQ_OFFSET
+    assert driver.SHM_SLOTS_OFFSET == shm.SLOTS_OFFSET
+    assert driver._SHM_HEADER.format == shm._HEADER.format
+    assert driver._SHM_SEQ.format == shm._SEQ.format
+    assert driver._SHM_SLOT_LENGTH.format == shm._SLOT_LENGTH.format
+    assert driver._SHM_HEADER.size <= shm.SEQ_OFFSET
+    assert shm.SEQ_OFFSET + shm._SEQ.size <= shm.SLOTS_OFFSET
+
+
+def test_shared_memory_writer_is_read_by_extension(tmp_path, capsysbinary):
+    buffer = shm.SharedFrameBuffer(tmp_path / "frames.shm", slot_size=256)
+    try:
+        writer = driver.SharedMemoryFrameWriter(str(buffer.path))
+        assert buffer.read_latest() is None
+
+        for index in range(3):
+            writer.write_frame(float(index), {"cf1": rigid_body((index, 0, 0))})
+            frame = buffer.read_latest()
+            assert frame.timestamp == index
+            assert frame.records["pos"].tolist() == [[index, 0, 0]]
+            assert buffer.read_latest() is None
+
+        (names,) = parse_in_chunks(capsysbinary.readouterr().out, 1024)
+        assert names == NameTable(1, ["cf1"])
+    finally:
+        writer._mm.close()
+        writer._fp.close()
+        buffer.close()
@@ -0,0 +1,92 @@
+from time import time
+
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+
+from flockwave.server.ext.motion_capture import MotionCaptureFrame  # noqa: E402
+
+from skybrush_ext_libmotioncapture.fusion import (  # noqa: E402
+    ClockOffsetEstimator,
+    FrameMerger,
+)
+
+
+def create_frame() -> MotionCaptureFrame:
+    return MotionCaptureFrame(timestamp=time())
+
+
+def frame_of(*items) -> MotionCaptureFrame:
+    frame = create_frame()
+    for name, position in items:
+        frame.add_item(name, position, None)
+    return frame
+
+
+def positions(frame: MotionCaptureFrame):
+    return {item.name: item.position for item in frame.items}
+
+
+def create_merger(policy: str, max_age: float = 0.1):
+    merged = []
+    merger = FrameMerger(create_frame, merged.append, policy=policy, max_age=max_age)
+    merger.add_source("a", priority=1, clock_offset=0)
+    merger.add_source("b", priority=0, clock_offset=0)
+    return merger, merged
+
+
+def test_freshest_pose_wins():
+    merger, merged = create_merger("freshest")
+    now = time()
+    merger.add_frame("a", frame_of(("cf1", (1, 0, 0)), ("cf2", (2, 0, 0))), now - 0.02)
+    merger.add_frame("b", frame_of(("cf1", (3, 0, 0)), ("cf3", (4, 0, 0))), now - 0.01)
+    merger.add_frame("a", frame_of(("cf3", (5, 0, 0))), now - 0.03)
+
+    frame = merger.flush()
+    assert merged == [frame]
+    assert positions(frame) == {"cf1": (3, 0, 0), "cf2": (2, 0, 0), "cf3": (4, 0, 0)}
+
+    # Nothing new since the last tick
+    assert merger.flush() is None
+    merger.add_frame("b", frame_of(("cf2", (6, 0, 0))), time())
+    assert positions(merger.flush()) == {"cf2": (6, 0, 0)}
+
+
+def test_priority_wins_while_fresh():
+    merger, _ = create_merger("priority", max_age=0.1)
+    now = time()
+    merger.add_frame("a", frame_of(("cf1", (1, 0, 0))), now - 0.05)
+    merger.add_frame("b", frame_of(("cf1", (3, 0, 0))), now)
+
+    # The pose of cf2 from a is too old, so the one from b is taken
+    merger.add_frame("a", frame_of(("cf2", (2, 0, 0))), now - 0.5)
+    merger.add_frame("b", frame_of(("cf2", (4, 0, 0))), now)
+
+    assert positions(merger.flush()) == {"cf1": (1, 0, 0), "cf2": (4, 0, 0)}
+
+
+def test_stale_poses_are_dropped():
+    merger, _ = create_merger("freshest", max_age=0.1)
+    now = time()
+    merger.add_frame("a", frame_of(("cf1", (1, 0, 0))), now - 1)
+    merger.add_frame("a", frame_of(("cf2", (2, 0, 0))), now)
+    assert positions(merger.flush()) == {"cf2": (2, 0, 0)}
+
+
+def test_unknown_policy():
+    with pytest.raises(RuntimeError):
+        FrameMerger(create_frame, print, policy="loudest")
+
+
+def test_clock_offset_estimator():
+    clock = ClockOffsetEstimator(drift=0.01)
+    assert clock.to_local_time(100.0, 1000.5) == pytest.approx(1000.5)
+    assert clock.offset == pytest.approx(900.5)
+
+    # A frame that arrived faster lowers the estimate, a slower one doesn't
+    # raise it beyond the allowed drift
+    assert clock.to_local_time(101.0, 1001.2) == pytest.approx(1001.2)
+    assert clock.to_local_time(102.0, 1003.2) == pytest.approx(1002.22)
+
+    fixed = ClockOffsetEstimator(offset=-5.0)
+    assert fixed.to_local_time(10.0, 1000.0) == 5.0
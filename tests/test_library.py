@@ -0,0 +1,76 @@
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+
+from skybrush_ext_aimotionlab.library import TrajectoryLibrary  # noqa: E402
+
+
+def test_first_fit():
+    library = TrajectoryLibrary(None, start=1000, size=300, ids=(4, 5, 6))
+    a = library.allocate(b"a", 100)
+    b = library.allocate(b"b", 50)
+    assert (a.start, a.traj_id) == (1000, 4)
+    assert (b.start, b.traj_id) == (1100, 5)
+
+    # The gap left by a is reused by the first trajectory that fits into it
+    library.remove(b"a")
+    c = library.allocate(b"c", 120)
+    d = library.allocate(b"d", 80)
+    assert c.start == 1150
+    assert d.start == 1000
+    assert {c.traj_id, d.traj_id} == {4, 6}
+
+
+def test_evicts_least_recently_used():
+    library = TrajectoryLibrary(None, start=0, size=300, ids=(4, 5, 6, 7))
+    a = library.allocate(b"a", 100)
+    library.allocate(b"b", 100)
+    library.allocate(b"c", 100)
+    library.touch(a)
+
+    d = library.allocate(b"d", 100)
+    assert library.get(b"b") is None
+    assert library.get(b"a") is a
+    assert d.start == 100
+
+
+def test_evicts_when_out_of_ids():
+    library = TrajectoryLibrary(None, start=0, size=1000, ids=(4, 5))
+    library.allocate(b"a", 10)
+    library.allocate(b"b", 10)
+    c = library.allocate(b"c", 10)
+    assert library.get(b"a") is None
+    assert c.traj_id == 4
+    assert len(library) == 2
+
+
+def test_keeps_trajectories_in_flight():
+    library = TrajectoryLibrary(None, start=0, size=200, ids=(4, 5))
+    library.allocate(b"a", 100)
+    library.allocate(b"b", 100)
+    assert library.allocate(b"c", 150, keep=[4]) is None
+    assert library.get(b"a") is not None
+
+    c = library.allocate(b"c", 100, keep=[4])
+    assert library.get(b"a") is not None
+    assert (c.start, c.traj_id) == (100, 5)
+
+
+def test_too_large():
+    library = TrajectoryLibrary(None, start=0, size=100)
+    assert library.allocate(b"a", 101) is None
+    assert len(library) == 0
+
+
+def test_names():
+    library = TrajectoryLibrary(None, start=0, size=100)
+    entry = library.allocate(b"\x01\x02", 10)
+    library.set_name("loop", b"\x01\x02")
+    assert library.find("loop") is entry
+    assert library.find("0102") is entry
+    assert library.find("nope") is None
+
+    library.remove(b"\x01\x02")
+    assert library.find("loop") is None
+    with pytest.raises(KeyError):
+        library.set_name("loop", b"\x01\x02")
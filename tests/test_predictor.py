@@ -0,0 +1,121 @@
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+
+from skybrush_ext_aimotionlab.predictor import PosePredictor  # noqa: E402
+
+VELOCITY = (1.0, -2.0, 0.5)
+DT = 0.01
+
+
+def position_at(t: float, origin=(0.0, 0.0, 1.0)):
+    return [o + v * t for o, v in zip(origin, VELOCITY)]
+
+
+def feed_line(predictor: PosePredictor, names, steps: int, start: int = 0, **kwds):
+    result = None
+    for step in range(start, start + steps):
+        t = step * DT
+        result = predictor.update(names, [position_at(t)] * len(names), t, **kwds)
+    return result
+
+
+def test_constant_velocity_is_exact_on_straight_line():
+    predictor = PosePredictor(model="constant_velocity", horizon=0.05)
+    (predicted,) = feed_line(predictor, ["a"], 20)
+    assert predicted == pytest.approx(position_at(19 * DT + 0.05))
+
+
+def test_constant_velocity_needs_two_samples():
+    predictor = PosePredictor(model="constant_velocity", horizon=0.05)
+    assert feed_line(predictor, ["a"], 1) == [position_at(0.0)]
+    (predicted,) = feed_line(predictor, ["a"], 1, start=1)
+    assert predicted == pytest.approx(position_at(DT + 0.05))
+
+
+def test_alpha_beta_converges_on_straight_line():
+    predictor = PosePredictor(model="alpha_beta", alpha=0.5, beta=0.2, horizon=0.05)
+    (predicted,) = feed_line(predictor, ["a"], 300)
+    assert predicted == pytest.approx(position_at(299 * DT + 0.05), abs=1e-3)
+
+
+@pytest.mark.parametrize("model", ["constant_velocity", "alpha_beta"])
+def test_latency_is_added_to_horizon(model):
+    predictor = PosePredictor(model=model, alpha=0.5, beta=0.2, horizon=0.01)
+    (predicted,) = feed_line(predictor, ["a"], 300, latency=0.02)
+    assert predicted == pytest.approx(position_at(299 * DT + 0.03), abs=1e-3)
+
+
+@pytest.mark.parametrize("model", ["constant_velocity", "alpha_beta"])
+def test_horizon_is_clamped(model):
+    predictor = PosePredictor(model=model, alpha=0.5, beta=0.2, max_horizon=0.1)
+    (predicted,) = feed_line(predictor, ["a"], 300, latency=5.0)
+    assert predicted == pytest.approx(position_at(299 * DT + 0.1), abs=1e-3)
+
+    (predicted,) = predictor.predict(["a"], 299 * DT + 5.0)
+    assert predicted == pytest.approx(position_at(299 * DT + 0.1), abs=1e-3)
+
+
+@pytest.mark.parametrize("model", ["constant_velocity", "alpha_beta"])
+def test_predict_extrapolates_to_time_of_sending(model):
+    predictor = PosePredictor(model=model, alpha=0.5, beta=0.2, horizon=0.01)
+    feed_line(predictor, ["a"], 300)
+    (predicted,) = predictor.predict(["a"], 299 * DT + 0.04)
+    assert predicted == pytest.approx(position_at(299 * DT + 0.05), abs=1e-3)
+
+
+@pytest.mark.parametrize("model", ["constant_velocity", "alpha_beta"])
+def test_reset_after_gap(model):
+    predictor = PosePredictor(model=model, horizon=0.05, reset_after=0.5)
+    feed_line(predictor, ["a"], 50)
+
+    # Seen again after a long gap somewhere else: the velocity starts over
+    (predicted,) = predictor.update(["a"], [[5.0, 5.0, 5.0]], 10.0)
+    assert predicted == [5.0, 5.0, 5.0]
+
+
+@pytest.mark.parametrize("model", ["constant_velocity", "alpha_beta"])
+def test_no_reset_within_reset_after(model):
+    predictor = PosePredictor(model=model, horizon=0.05, reset_after=0.5)
+    feed_line(predictor, ["a"], 50)
+    t = 49 * DT + 0.4
+    (predicted,) = predictor.update(["a"], [position_at(t)], t)
+    assert predicted != pytest.approx(position_at(t))
+
+
+@pytest.mark.parametrize("model", ["constant_velocity", "alpha_beta"])
+def test_arrays_grow_past_initial_capacity(model):
+    predictor = PosePredictor(model=model, horizon=0.05)
+    names = [f"obj{index}" for index in range(40)]
+    feed_line(predictor, names[:16], 10)
+    before = predictor.predict(names[:16], 9 * DT)
+
+    # The state of the first objects must survive the reallocation
+    feed_line(predictor, names[16:], 10)
+    assert len(predictor._position) >= 40
+    assert predictor.predict(names[:16], 9 * DT) == before
+
+    result = feed_line(predictor, names, 10, start=10)
+    if model == "constant_velocity":
+        for predicted in result:
+            assert predicted == pytest.approx(position_at(19 * DT + 0.05))
+    else:
+        assert result[:16] == [result[0]] * 16
+        assert result[16:] == [result[16]] * 24
+
+
+def test_objects_are_independent():
+    predictor = PosePredictor(model="constant_velocity", horizon=0.1)
+    for step in range(10):
+        t = step * DT
+        predictor.update(["a", "b"], [position_at(t), [0.0, 0.0, 1.0]], t)
+    a, b = predictor.predict(["a", "b"], 9 * DT)
+    assert a == pytest.approx(position_at(9 * DT + 0.1))
+    assert b == pytest.approx([0.0, 0.0, 1.0])
+
+
+def test_invalid_configuration():
+    with pytest.raises(ValueError):
+        PosePredictor(model="kalman")
+    with pytest.raises(ValueError):
+        PosePredictor(history=1)
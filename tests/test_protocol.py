@@ -0,0 +1,134 @@
+import json
+
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+
+from skybrush_ext_aimotionlab.protocol import (  # noqa: E402
+    RESPONSE_HEADER,
+    RESPONSE_MAGIC,
+    STATUS_ACCEPTED,
+    STATUS_REJECTED,
+    VERSION,
+    Command,
+    CommandParser,
+    ProtocolError,
+    encode_command,
+    encode_response,
+)
+
+COMMANDS = {
+    b"takeoff": (True, False),
+    b"land": (False, False),
+    b"traj": (True, True),
+}
+
+
+def feed_in_chunks(parser: CommandParser, data: bytes, size: int):
+    result = []
+    for start in range(0, len(data), size):
+        result.extend(parser.feed(data[start : start + size]))
+    return result
+
+
+def test_framed_command():
+    parser = CommandParser(COMMANDS)
+    data = encode_command(6, b"traj", b"relative", b"payload")
+    assert parser.feed(data) == [
+        Command("06", b"traj", b"relative", b"payload", True)
+    ]
+
+
+def test_legacy_command_with_underscores_in_payload():
+    parser = CommandParser(COMMANDS)
+    assert parser.feed(b"CMDSTART_7_traj_absolute_{\"a_b\": 1}_EOF") == [
+        Command("07", b"traj", b"absolute", b'{"a_b": 1}', False)
+    ]
+    assert parser.feed(b"CMDSTART_0_land_EOF") == [
+        Command("00", b"land", None, None, False)
+    ]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+def test_split_chunks(size):
+    data = (
+        encode_command(1, b"takeoff", b"0.5")
+        + b"CMDSTART_2_land_EOF\n"
+        + encode_command(3, b"traj", b"relative", b"x" * 300)
+        + b"CMDSTART_4_takeoff_1.0_EOF"
+    )
+    expected = CommandParser(COMMANDS).feed(data)
+    assert len(expected) == 4
+    assert feed_in_chunks(CommandParser(COMMANDS), data, size) == expected
+
+
+@pytest.mark.parametrize("size", [1, 5, 1000])
+def test_resync_after_garbage(size):
+    data = (
+        b"garbage CMDSTAR"
+        + b"CMDSTART_1_land_EOF"
+        + b"AIM!"
+        + encode_command(2, b"land")
+    )
+    result = feed_in_chunks(CommandParser(COMMANDS), data, size)
+    commands = [item for item in result if isinstance(item, Command)]
+    errors = [item for item in result if isinstance(item, ProtocolError)]
+    assert [command.uav_id for command in commands] == ["01", "02"]
+    assert errors
+
+
+def test_unknown_and_malformed_commands():
+    parser = CommandParser(COMMANDS)
+    result = parser.feed(
+        encode_command(1, b"dance") + b"CMDSTART_x_land_EOF" + b"CMDSTART_1_takeoff_EOF"
+    )
+    assert result == [
+        ProtocolError(b"Command is not found in server side dictionary"),
+        ProtocolError(b"Malformed command"),
+        ProtocolError(b"Command is missing its argument"),
+    ]
+
+
+def test_too_large_payload_is_skipped():
+    parser = CommandParser(COMMANDS, max_payload_size=100)
+    data = encode_command(1, b"traj", b"relative", b"x" * 1000) + encode_command(
+        2, b"land"
+    )
+    result = feed_in_chunks(parser, data, 64)
+    assert result == [
+        ProtocolError(b"Payload is too large"),
+        Command("02", b"land", None, None, True),
+    ]
+
+
+def test_request_ids():
+    parser = CommandParser(COMMANDS, max_payload_size=10)
+    data = (
+        encode_command(1, b"land", request_id=7)
+        + encode_command(2, b"dance", request_id=8)
+        + encode_command(3, b"traj", b"relative", b"x" * 20, request_id=9)
+        + encode_command(4, b"land")
+    )
+    assert feed_in_chunks(parser, data, 3) == [
+        Command("01", b"land", None, None, True, 7),
+        ProtocolError(b"Command is not found in server side dictionary", 8),
+        ProtocolError(b"Payload is too large", 9),
+        Command("04", b"land", None, None, True),
+    ]
+
+
+def test_encode_response():
+    body = {"results": {"01": [True, "ok"]}}
+    data = encode_response(0x01020304, STATUS_ACCEPTED, body)
+    magic, version, request_id, status, length = RESPONSE_HEADER.unpack_from(data)
+    assert (magic, version, request_id, status) == (
+        RESPONSE_MAGIC,
+        VERSION,
+        0x01020304,
+        STATUS_ACCEPTED,
+    )
+    assert length == len(data) - RESPONSE_HEADER.size
+    assert json.loads(data[RESPONSE_HEADER.size :]) == body
+
+    data = encode_response(1, STATUS_REJECTED, {})
+    assert data[RESPONSE_HEADER.size :] == b"{}"
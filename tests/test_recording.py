@@ -0,0 +1,112 @@
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+
+from numpy import zeros  # noqa: E402
+
+from skybrush_ext_libmotioncapture.protocol import (  # noqa: E402
+    FLAG_HAS_ROTATION,
+    RECORD_DTYPE,
+)
+from skybrush_ext_libmotioncapture.recording import (  # noqa: E402
+    MocapLog,
+    MocapLogWriter,
+)
+
+
+def write_log(path, close: bool = True) -> MocapLogWriter:
+    writer = MocapLogWriter(path)
+    writer.write_items(
+        10.0, [("cf1", (1, 2, 3), (1, 0, 0, 0)), ("obj", (4, 5, 6), None)]
+    )
+
+    # Records whose IDs refer to the name table of a driver process
+    records = zeros(2, dtype=RECORD_DTYPE)
+    records["id"] = [1, 0]
+    records["pos"] = [(7, 8, 9), (0, 0, 1)]
+    records[0]["flags"] = FLAG_HAS_ROTATION
+    records[0]["rot"] = (0, 1, 0, 0)
+    writer.write_records(10.5, records, ["new", "cf1"])
+
+    writer.write_items(11.0, [])
+    if close:
+        writer.close()
+    return writer
+
+
+def poses(log: MocapLog, index: int):
+    _, records = log.frame(index)
+    return {
+        log.names[record["id"]]: (
+            tuple(record["pos"].tolist()),
+            tuple(record["rot"].tolist())
+            if record["flags"] & FLAG_HAS_ROTATION
+            else None,
+        )
+        for record in records
+    }
+
+
+@pytest.mark.parametrize("close", [True, False])
+def test_round_trip(tmp_path, close):
+    # Without closing the writer, there is no index and the log is scanned
+    writer = write_log(tmp_path / "log.lmc", close=close)
+    if not close:
+        writer._fp.flush()
+
+    log = MocapLog(writer.path)
+    assert len(log) == 3
+    assert log.names == ["cf1", "obj", "new"]
+    assert log.timestamps.tolist() == [10.0, 10.5, 11.0]
+    assert log.duration == pytest.approx(1.0)
+
+    assert poses(log, 0) == {
+        "cf1": ((1, 2, 3), (1, 0, 0, 0)),
+        "obj": ((4, 5, 6), None),
+    }
+    assert poses(log, 1) == {
+        "cf1": ((7, 8, 9), (0, 1, 0, 0)),
+        "new": ((0, 0, 1), None),
+    }
+    assert poses(log, 2) == {}
+
+    if not close:
+        writer.close()
+
+
+def test_truncated_log(tmp_path):
+    writer = write_log(tmp_path / "log.lmc", close=False)
+    writer._fp.flush()
+    data = writer.path.read_bytes()
+    writer.close()
+
+    # Cut off in the middle of the last frame block
+    truncated = tmp_path / "truncated.lmc"
+    truncated.write_bytes(data[:-4])
+    log = MocapLog(truncated)
+    assert log.timestamps.tolist() == [10.0, 10.5]
+
+
+def test_seeking(tmp_path):
+    log = MocapLog(write_log(tmp_path / "log.lmc").path)
+    assert log.find(0) == 0
+    assert log.find(10.2) == 1
+    assert log.find(10.5) == 1
+    assert log.find(12) == 3
+    assert [timestamp for timestamp, _ in log.iter_frames(1)] == [10.5, 11.0]
+    assert [timestamp for timestamp, _ in log.iter_frames(0, 2)] == [10.0, 10.5]
+
+
+def test_never_overwrites(tmp_path):
+    first = write_log(tmp_path / "log.lmc").path
+    second = write_log(tmp_path / "log.lmc").path
+    assert first != second
+    assert second.name == "log-1.lmc"
+    assert len(MocapLog(first)) == len(MocapLog(second)) == 3
+
+
+def test_not_a_log(tmp_path):
+    path = tmp_path / "garbage.lmc"
+    path.write_bytes(b"garbage" * 10)
+    with pytest.raises(RuntimeError):
+        MocapLog(path)
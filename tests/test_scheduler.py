@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+
+import trio  # noqa: E402
+import trio.testing  # noqa: E402
+
+from aiocflib.utils.quaternion import QuaternionXYZW  # noqa: E402
+from skybrush_ext_aimotionlab.scheduler import BroadcastScheduler  # noqa: E402
+
+IDENTITY = QuaternionXYZW(0.0, 0.0, 0.0, 1.0)
+
+
+def run_scheduler(scheduler: BroadcastScheduler, names, duration: float = 1.0):
+    """Runs the scheduler for the given number of (virtual) seconds while the
+    given objects submit a new pose every millisecond, and returns the number
+    of packets broadcast and the number of poses sent per object.
+    """
+    packets = []
+    sent = {name: 0 for name in names}
+
+    def on_sent(name, capture, now):
+        sent[name] += 1
+
+    scheduler._broadcast = lambda port, channel, packet: packets.append(packet)
+    scheduler.on_sent = on_sent
+
+    async def feed():
+        while True:
+            for index, name in enumerate(names):
+                scheduler.submit(name, None, (index, (0.0, 0.0, 0.0), IDENTITY), 0.0)
+            await trio.sleep(0.001)
+
+    async def main():
+        with trio.move_on_after(duration):
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(feed)
+                nursery.start_soon(scheduler.run)
+
+    trio.run(main, clock=trio.testing.MockClock(autojump_threshold=0))
+    return len(packets), sent
+
+
+def test_budget_limits_packet_rate():
+    scheduler = BroadcastScheduler(None, 0, 0, budget=100)
+    packets, sent = run_scheduler(scheduler, ["a", "b", "c", "d", "e", "f"])
+    assert 95 <= packets <= 102
+    assert sum(sent.values()) == 2 * packets
+
+
+def test_priorities_share_budget():
+    scheduler = BroadcastScheduler(None, 0, 0, budget=100, priorities={"a": 3})
+    _, sent = run_scheduler(scheduler, ["a", "b", "c", "d"])
+    assert sent["a"] == pytest.approx(3 * sent["b"], rel=0.1)
+    assert sent["b"] == pytest.approx(sent["c"], rel=0.1)
+    assert sent["c"] == pytest.approx(sent["d"], rel=0.1)
+
+
+def test_min_rate_is_honored():
+    scheduler = BroadcastScheduler(
+        None, 0, 0, budget=50, priorities={"slow": 0.01}, min_rates={"slow": 20}
+    )
+    _, sent = run_scheduler(scheduler, ["slow", "a", "b", "c"])
+    # Overdue objects are only noticed at the next tick of the scheduler
+    assert sent["slow"] >= 16
+
+    scheduler = BroadcastScheduler(None, 0, 0, budget=50, priorities={"slow": 0.01})
+    _, sent = run_scheduler(scheduler, ["slow", "a", "b", "c"])
+    assert sent["slow"] < 5
+
+
+def test_budget_must_be_positive():
+    with pytest.raises(ValueError):
+        BroadcastScheduler(None, 0, 0, budget=0)
@@ -0,0 +1,109 @@
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+
+import trio  # noqa: E402
+
+from skybrush_ext_aimotionlab.shadow import (  # noqa: E402
+    MERGE_GAP,
+    MemoryShadow,
+    write_with_shadow,
+)
+
+
+class FakeMemory:
+    """Trajectory memory of a drone, recording the writes made to it."""
+
+    def __init__(self, size: int = 4096):
+        self.data = bytearray(size)
+        self.writes = []
+
+    async def read(self, addr, length):
+        return bytes(self.data[addr : addr + length])
+
+    async def write(self, addr, data):
+        self.writes.append((addr, bytes(data)))
+        self.data[addr : addr + len(data)] = data
+
+
+def test_unknown_memory_is_written_in_full():
+    shadow = MemoryShadow(None)
+    data = bytes(range(100))
+    assert shadow.diff(10, data) == [(10, data)]
+    assert not shadow.is_known(10, 100)
+
+
+def test_diff_of_known_memory():
+    shadow = MemoryShadow(None)
+    old = bytes(200)
+    shadow.update(0, old)
+    assert shadow.matches(0, old)
+    assert shadow.diff(0, old) == []
+
+    new = bytearray(old)
+    new[5] = 1
+    new[150:152] = b"\x02\x03"
+    assert shadow.diff(0, bytes(new)) == [(5, b"\x01"), (150, b"\x02\x03")]
+
+
+def test_diff_merges_close_ranges():
+    shadow = MemoryShadow(None)
+    shadow.update(0, bytes(100))
+    new = bytearray(100)
+    new[10] = 1
+    new[10 + MERGE_GAP] = 1
+    assert shadow.diff(0, bytes(new)) == [(10, bytes(new[10 : 11 + MERGE_GAP]))]
+
+
+def test_invalidate():
+    shadow = MemoryShadow(None)
+    shadow.update(0, b"abc")
+    shadow.invalidate()
+    assert not shadow.matches(0, b"abc")
+
+
+def test_grows_on_demand():
+    shadow = MemoryShadow(None, size=16)
+    shadow.update(100, b"xyz")
+    assert shadow.matches(100, b"xyz")
+
+
+def test_write_with_shadow():
+    memory = FakeMemory()
+    shadow = MemoryShadow(None)
+    checksum, data = b"\x01\x02\x03\x04", bytes(range(200))
+
+    # First write: the checksum is read back, then everything is written
+    assert trio.run(write_with_shadow, memory, shadow, 100, data, checksum) == 4
+    assert memory.data[100:104] == checksum
+    assert memory.data[104:304] == data
+
+    # Same data again: nothing is written
+    memory.writes.clear()
+    trio.run(write_with_shadow, memory, shadow, 100, data, checksum)
+    assert memory.writes == []
+    assert shadow.bytes_skipped == len(data)
+
+    # Changed data: the checksum is cleared first, then only the changes and
+    # the new checksum are written
+    changed = bytearray(data)
+    changed[50] = 0xFF
+    new_checksum = b"\x05\x06\x07\x08"
+    trio.run(write_with_shadow, memory, shadow, 100, bytes(changed), new_checksum)
+    assert memory.writes == [
+        (100, bytes(4)),
+        (154, b"\xff"),
+        (100, new_checksum),
+    ]
+    assert memory.data[104:304] == changed
+
+
+def test_write_with_shadow_recognizes_data_on_drone():
+    memory = FakeMemory()
+    checksum, data = b"\x01\x02\x03\x04", bytes(range(50))
+    memory.data[0:54] = checksum + data
+
+    shadow = MemoryShadow(None)
+    trio.run(write_with_shadow, memory, shadow, 0, data, checksum)
+    assert memory.writes == []
+    assert shadow.matches(4, data)
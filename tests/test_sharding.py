@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+
+import trio  # noqa: E402
+import trio.testing  # noqa: E402
+
+from aiocflib.utils.quaternion import QuaternionXYZW  # noqa: E402
+from skybrush_ext_aimotionlab.scheduler import BroadcastScheduler  # noqa: E402
+from skybrush_ext_aimotionlab.sharding import (  # noqa: E402
+    BroadcastShard,
+    RadioSender,
+    assign_shards,
+)
+
+
+class StuckRadio:
+    def __init__(self):
+        self.sent = []
+        self.unblock = trio.Event()
+
+    async def send_packet(self, port, channel, data):
+        await self.unblock.wait()
+        self.sent.append(data)
+
+
+def test_radio_sender_drops_when_full():
+    radio = StuckRadio()
+    sender = RadioSender(radio, queue_size=4)
+
+    async def main():
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(sender.run)
+            await trio.testing.wait_all_tasks_blocked()
+
+            # One packet is taken by the sender task, four wait in the queue
+            results = [sender.send(0, 0, bytes([index])) for index in range(10)]
+            await trio.testing.wait_all_tasks_blocked()
+            results += [sender.send(0, 0, bytes([index])) for index in range(10, 20)]
+            assert results.count(False) == sender.dropped == 15
+
+            radio.unblock.set()
+            await trio.testing.wait_all_tasks_blocked()
+            nursery.cancel_scope.cancel()
+
+    trio.run(main)
+    assert radio.sent == [bytes([index]) for index in range(5)]
+
+
+def test_scheduler_counts_dropped_packets():
+    sent = []
+    scheduler = BroadcastScheduler(lambda *args: False, 0, 0, budget=100)
+    scheduler.on_sent = lambda *args: sent.append(args)
+
+    async def main():
+        pose = (0, (0.0, 0.0, 0.0), QuaternionXYZW(0.0, 0.0, 0.0, 1.0))
+        scheduler.submit("a", None, pose, 0.0)
+        with trio.move_on_after(0.1):
+            await scheduler.run()
+        return scheduler.achieved_rates()
+
+    rates = trio.run(main, clock=trio.testing.MockClock(autojump_threshold=0))
+    assert scheduler.dropped_packets == 1
+    assert sent == []
+    assert rates == {"a": 0.0}
+
+
+def test_assign_shards():
+    catch_all = BroadcastShard("default", None, 0, 0)
+    hooks = BroadcastShard("hooks", None, 0, 0, patterns=["hook*", "payload"])
+    shards = [catch_all, hooks]
+    assert assign_shards(shards, "hook1", None) == [hooks]
+    assert assign_shards(shards, "box", "payload") == [hooks]
+    assert assign_shards(shards, "box", "obstacle") == [catch_all]
@@ -0,0 +1,154 @@
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+
+from numpy import zeros  # noqa: E402
+
+from skybrush_ext_libmotioncapture import shm  # noqa: E402
+from skybrush_ext_libmotioncapture.protocol import (  # noqa: E402
+    _FRAME_HEADER,
+    RECORD_DTYPE,
+)
+from skybrush_ext_libmotioncapture.shm import SharedFrameBuffer  # noqa: E402
+
+SEQ = shm._SEQ
+
+
+class Writer:
+    """Writer side of the buffer, following the protocol in the docstring of
+    the ``shm`` module.
+    """
+
+    def __init__(self, buffer: SharedFrameBuffer):
+        self.buffer = buffer
+        self.seq = 0
+
+    def write(self, timestamp: float, start_seq=None):
+        if start_seq is not None:
+            self.seq = start_seq
+        records = zeros(1, dtype=RECORD_DTYPE)
+        records["pos"] = [timestamp, 0, 0]
+        body = _FRAME_HEADER.pack(timestamp, 0, 1) + records.tobytes()
+
+        mm, seq = self.buffer._mm, self.seq
+        start = shm.SLOTS_OFFSET + (((seq >> 1) + 1) & 1) * self.buffer.slot_size
+        SEQ.pack_into(mm, shm.SEQ_OFFSET, seq + 1)
+        shm._SLOT_LENGTH.pack_into(mm, start, len(body))
+        mm[start + 4 : start + 4 + len(body)] = body
+        SEQ.pack_into(mm, shm.SEQ_OFFSET, seq + 2)
+        self.seq = seq + 2
+
+
+class InterleavedSeq:
+    """Stand-in for the sequence counter layout that lets the writer run
+    between the two reads of the counter in ``read_latest()``.
+    """
+
+    def __init__(self, between_reads):
+        self.between_reads = between_reads
+        self.reads = 0
+
+    def unpack_from(self, buffer, offset):
+        self.reads += 1
+        if self.reads % 2 == 0:
+            self.between_reads()
+        return SEQ.unpack_from(buffer, offset)
+
+
+@pytest.fixture
+def buffer(tmp_path):
+    buffer = SharedFrameBuffer(tmp_path / "frames.shm", slot_size=256)
+    yield buffer
+    buffer.close()
+
+
+def timestamp_of(frame):
+    assert frame.records["pos"][0][0] == frame.timestamp
+    return frame.timestamp
+
+
+def test_empty_buffer(buffer):
+    assert buffer.read_latest() is None
+
+
+def test_round_trip(buffer):
+    writer = Writer(buffer)
+    for timestamp in (1.0, 2.0, 3.0):
+        writer.write(timestamp)
+        assert timestamp_of(buffer.read_latest()) == timestamp
+
+
+def test_only_newest_frame_is_returned(buffer):
+    writer = Writer(buffer)
+    for timestamp in (1.0, 2.0, 3.0):
+        writer.write(timestamp)
+    assert timestamp_of(buffer.read_latest()) == 3.0
+
+
+def test_stale_sequence_returns_none(buffer):
+    writer = Writer(buffer)
+    writer.write(1.0)
+    assert buffer.read_latest() is not None
+    assert buffer.read_latest() is None
+    assert buffer.read_latest() is None
+
+    writer.write(2.0)
+    assert timestamp_of(buffer.read_latest()) == 2.0
+    assert buffer.read_latest() is None
+
+
+def test_frame_being_written_is_not_returned(buffer):
+    writer = Writer(buffer)
+    writer.write(1.0)
+    assert buffer.read_latest() is not None
+
+    # Writer is halfway through the second frame
+    SEQ.pack_into(buffer._mm, shm.SEQ_OFFSET, writer.seq + 1)
+    assert buffer.read_latest() is None
+
+
+def test_torn_read_is_retried(buffer, monkeypatch):
+    writer = Writer(buffer)
+    writer.write(1.0)
+
+    def write_once():
+        if seq.reads == 2:
+            writer.write(2.0)
+            writer.write(3.0)
+
+    # The writer publishes two more frames while the first one is being
+    # copied, so the slot of the first one is overwritten
+    seq = InterleavedSeq(write_once)
+    monkeypatch.setattr(shm, "_SEQ", seq)
+
+    assert timestamp_of(buffer.read_latest()) == 3.0
+    assert seq.reads == 4
+
+
+def test_gives_up_when_every_read_is_torn(buffer, monkeypatch):
+    writer = Writer(buffer)
+    writer.write(1.0)
+
+    seq = InterleavedSeq(lambda: (writer.write(2.0), writer.write(3.0)))
+    monkeypatch.setattr(shm, "_SEQ", seq)
+
+    assert buffer.read_latest() is None
+    assert seq.reads == 2 * shm.MAX_READ_ATTEMPTS
+
+
+def test_writer_restart(buffer):
+    writer = Writer(buffer)
+    for timestamp in (1.0, 2.0, 3.0):
+        writer.write(timestamp)
+    assert timestamp_of(buffer.read_latest()) == 3.0
+
+    writer.write(4.0, start_seq=0)
+    assert timestamp_of(buffer.read_latest()) == 4.0
+
+
+def test_invalid_length_is_ignored(buffer):
+    writer = Writer(buffer)
+    writer.write(1.0)
+    start = shm.SLOTS_OFFSET + buffer.slot_size
+    shm._SLOT_LENGTH.pack_into(buffer._mm, start, buffer.slot_size)
+    assert buffer.read_latest() is None
@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+
+from skybrush_ext_aimotionlab.simplify import (  # noqa: E402
+    fit_trajectory,
+    simplify_points,
+)
+
+POINT_SIZE = 10
+
+
+def encode(data):
+    # Stand-in for the Crazyflie encoder with a fixed size per point
+    return bytes(POINT_SIZE * len(data["points"]))
+
+
+def wavy_trajectory(count: int = 100, curved=()):
+    points = []
+    for index in range(count):
+        t = index * 0.1
+        position = [t, 0.05 * np.sin(t), 1.0]
+        control = [[t, 0.0, 1.0]] if index in curved else []
+        points.append([t, position, control])
+    return {"version": 1, "points": points}
+
+
+def deviation(original, simplified) -> float:
+    # Largest distance of the original points from the simplified trajectory
+    # at their own time
+    times = np.array([point[0] for point in original["points"]])
+    positions = np.array([point[1] for point in original["points"]])
+    kept_times = np.array([point[0] for point in simplified["points"]])
+    kept = np.array([point[1] for point in simplified["points"]])
+    expected = np.column_stack(
+        [np.interp(times, kept_times, kept[:, axis]) for axis in range(3)]
+    )
+    return float(np.linalg.norm(positions - expected, axis=1).max())
+
+
+def test_straight_line_is_reduced_to_endpoints():
+    times = np.arange(10, dtype=float)
+    positions = np.column_stack([times, 2 * times, np.zeros(10)])
+    keep, error = simplify_points(times, positions, 1e-6)
+    assert keep.tolist() == [True] + [False] * 8 + [True]
+    assert error == pytest.approx(0.0)
+
+
+def test_change_of_speed_is_kept():
+    # Same path, but the drone stops halfway; time-synchronized simplification
+    # must not drop the stop
+    times = np.arange(5, dtype=float)
+    positions = np.array([[0, 0, 0], [1, 0, 0], [2, 0, 0], [2, 0, 0], [4, 0, 0]])
+    keep, _ = simplify_points(times, positions.astype(float), 0.1)
+    assert keep[2] or keep[3]
+
+
+def test_fixed_points_are_kept():
+    times = np.arange(10, dtype=float)
+    positions = np.column_stack([times, times, times])
+    fixed = np.zeros(10, dtype=bool)
+    fixed[4] = True
+    keep, _ = simplify_points(times, positions, 1.0, fixed)
+    assert np.flatnonzero(keep).tolist() == [0, 4, 9]
+
+
+@pytest.mark.parametrize("max_error", [0.001, 0.01, 0.05])
+def test_achieved_error_is_within_max_error(max_error):
+    data = wavy_trajectory()
+    result = fit_trajectory(data, encode, 60 * POINT_SIZE, max_error)
+    assert result is not None
+    simplified, encoded, error = result
+    assert error <= max_error
+    assert deviation(data, simplified) == pytest.approx(error)
+
+
+def test_result_fits_max_size():
+    data = wavy_trajectory()
+    for max_size in (80 * POINT_SIZE, 30 * POINT_SIZE, 10 * POINT_SIZE):
+        simplified, encoded, _ = fit_trajectory(data, encode, max_size, 0.05)
+        assert len(encoded) <= max_size
+        assert encoded == encode(simplified)
+        assert simplified["points"][0] == data["points"][0]
+        assert simplified["points"][-1] == data["points"][-1]
+
+
+def test_smaller_size_means_larger_error():
+    data = wavy_trajectory()
+    _, _, loose = fit_trajectory(data, encode, 80 * POINT_SIZE, 0.05)
+    _, _, tight = fit_trajectory(data, encode, 10 * POINT_SIZE, 0.05)
+    assert loose < tight
+
+
+def test_curved_points_and_their_predecessors_are_kept():
+    data = wavy_trajectory(curved=(20, 55))
+    simplified, _, _ = fit_trajectory(data, encode, 20 * POINT_SIZE, 0.05)
+    kept = [point[0] for point in simplified["points"]]
+    for index in (19, 20, 54, 55):
+        assert data["points"][index][0] in kept
+    assert simplified["points"][kept.index(data["points"][20][0])][2]
+
+
+def test_none_when_max_error_does_not_fit():
+    data = wavy_trajectory()
+    assert fit_trajectory(data, encode, 5 * POINT_SIZE, 0.001) is None
+    assert fit_trajectory(data, encode, 1, 0.05) is None
+
+
+def test_none_for_trajectories_too_short_to_simplify():
+    data = wavy_trajectory(count=2)
+    assert fit_trajectory(data, encode, 1, 0.05) is None
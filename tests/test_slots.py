@@ -0,0 +1,88 @@
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+
+from skybrush_ext_aimotionlab.slots import TrajectorySlots  # noqa: E402
+
+
+def upload(slots: TrajectorySlots, relative: bool = False) -> int:
+    traj_id = slots.begin_prepare()
+    slots.finish_prepare(traj_id, relative)
+    return traj_id
+
+
+def test_upload_goes_to_inactive_slot():
+    slots = TrajectorySlots(object())
+    assert (slots.active, slots.inactive) == (2, 3)
+    assert upload(slots) == 3
+    assert slots.active == 2
+    assert slots.commit() == (3, False)
+    assert (slots.active, slots.inactive) == (3, 2)
+    assert slots.playing == 3
+    assert upload(slots, relative=True) == 2
+    assert slots.commit() == (2, True)
+    assert slots.active == 2
+
+
+def test_commit_without_prepare_fails():
+    slots = TrajectorySlots(object())
+    assert slots.commit() is None
+    assert slots.active == 2
+    assert slots.playing is None
+
+    upload(slots)
+    assert slots.commit() == (3, False)
+    assert slots.commit() is None
+    assert slots.active == 3
+    assert slots.playing == 3
+
+
+def test_failed_prepare_does_not_flip_slot():
+    slots = TrajectorySlots(object())
+    upload(slots)
+    slots.commit()
+
+    # Upload fails between begin_prepare() and finish_prepare()
+    assert slots.begin_prepare() == 2
+    assert slots.prepared is None
+    assert slots.commit() is None
+    assert (slots.active, slots.playing) == (3, 3)
+
+
+def test_failed_prepare_discards_earlier_prepared_trajectory():
+    slots = TrajectorySlots(object())
+    upload(slots)
+    # A second upload overwrites the slot of the first one, then fails
+    slots.begin_prepare()
+    assert slots.commit() is None
+    assert slots.active == 2
+
+
+def test_drones_keep_independent_active_slots():
+    first, second = TrajectorySlots(object()), TrajectorySlots(object())
+    upload(first)
+    first.commit()
+    assert (first.active, second.active) == (3, 2)
+
+    upload(second)
+    assert second.prepared == (3, False)
+    assert first.prepared is None
+    second.commit()
+    upload(second)
+    second.commit()
+    assert (first.active, second.active) == (3, 2)
+    assert (first.playing, second.playing) == (3, 2)
+
+
+def test_trajectory_outside_slots_leaves_slots_alone():
+    slots = TrajectorySlots(object())
+    slots.begin_prepare()
+    slots.finish_prepare(5, False)  # e.g. from the trajectory library
+    assert slots.commit() == (5, False)
+    assert slots.active == 2
+    assert slots.playing == 5
+
+
+def test_at_least_two_slots():
+    with pytest.raises(ValueError):
+        TrajectorySlots(object(), slots=(2,))
@@ -0,0 +1,192 @@
+from threading import Event
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+
+import trio  # noqa: E402
+
+from skybrush_ext_libmotioncapture import threaded  # noqa: E402
+from skybrush_ext_libmotioncapture.threaded import (  # noqa: E402
+    ThreadedLibmotioncaptureConnection,
+)
+
+
+class FakeFrame:
+    def __init__(self):
+        self.items = []
+
+    def add_item(self, name, position, rotation):
+        self.items.append((name, position, rotation))
+
+
+class FakeClient:
+    """Stand-in for a ``motioncapture`` client that delivers a frame whenever
+    the test releases one.
+    """
+
+    def __init__(self):
+        self._released = 0
+        self._delivered = 0
+        self._gate = Event()
+        self.closed = Event()
+        self.rigidBodies = {}
+
+    def release(self, count: int = 1):
+        self._released += count
+        self._gate.set()
+
+    def waitForNextFrame(self):
+        while self._delivered >= self._released:
+            self._gate.wait()
+            self._gate.clear()
+        self._delivered += 1
+        self.rigidBodies = {
+            "cf1": SimpleNamespace(
+                position=(self._delivered, 0, 0),
+                rotation=SimpleNamespace(w=1, x=0, y=0, z=0),
+            )
+        }
+
+    def close(self):
+        self.closed.set()
+
+
+def create_connection(clients):
+    connection = ThreadedLibmotioncaptureConnection("test", {})
+    connection.frame_factory = FakeFrame
+
+    def connect():
+        clients.append(FakeClient())
+        return clients[-1]
+
+    connection._connect = connect
+    return connection
+
+
+async def wait_for_frame(connection, seq: int):
+    with trio.fail_after(1):
+        while connection._latest is None or connection._latest[0] < seq:
+            await trio.sleep(0.001)
+
+
+def body(x):
+    return SimpleNamespace(position=(x, 0, 0), rotation=None)
+
+
+def test_read_latest_frame_counts_dropped_frames():
+    connection = create_connection([])
+    assert connection.read_latest_frame() is None
+
+    connection._latest = (1, 10.0, {"a": body(1)})
+    frame = connection.read_latest_frame()
+    assert frame.items == [("a", (1.0, 0.0, 0.0), None)]
+    assert connection.last_timestamp == 10.0
+    assert connection.read_latest_frame() is None
+
+    # Frames 2-4 were replaced before they could be read
+    connection._latest = (5, 10.5, {"a": body(5)})
+    assert connection.read_latest_frame().items[0][1] == (5.0, 0.0, 0.0)
+    assert connection.read_latest_frame() is None
+
+    connection._latest = (6, 10.6, {"a": body(6)})
+    assert connection.read_latest_frame() is not None
+    assert (connection.dropped_frame_count, connection.sent_frame_count) == (3, 3)
+
+
+def test_frames_from_worker_thread():
+    clients = []
+    connection = create_connection(clients)
+
+    async def main():
+        await connection.open()
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(connection.run)
+            await trio.sleep(0.01)
+            client = clients[0]
+
+            client.release(4)
+            await wait_for_frame(connection, 4)
+            frame = connection.read_latest_frame()
+            assert frame.items == [("cf1", (4.0, 0.0, 0.0), (1, 0, 0, 0))]
+            assert connection.read_latest_frame() is None
+
+            client.release()
+            await wait_for_frame(connection, 5)
+            assert connection.read_latest_frame().items[0][1] == (5.0, 0.0, 0.0)
+
+            nursery.cancel_scope.cancel()
+        await connection.close()
+
+        client.release()
+        await trio.to_thread.run_sync(client.closed.wait, 1)
+
+    trio.run(main)
+    assert (connection.dropped_frame_count, connection.sent_frame_count) == (3, 2)
+
+
+async def open_run_and_abandon(connection, clients):
+    # Opens the connection and cancels run() while the worker thread is
+    # blocked in waitForNextFrame()
+    await connection.open()
+    with trio.move_on_after(0.05):
+        await connection.run()
+    await connection.close()
+    assert not clients[-1].closed.is_set()
+    return clients[-1]
+
+
+def test_reopen_waits_for_previous_worker():
+    clients = []
+    connection = create_connection(clients)
+
+    async def main():
+        client = await open_run_and_abandon(connection, clients)
+
+        async def release_later():
+            await trio.sleep(0.2)
+            client.release()
+
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(release_later)
+            start = trio.current_time()
+            await connection.open()
+            assert 0.2 <= trio.current_time() - start < threaded.STOP_TIMEOUT
+
+        # The old client let go before the new one was connected
+        assert client.closed.is_set()
+        assert len(clients) == 2
+        assert connection._latest is None
+        await connection.close()
+
+    trio.run(main)
+
+
+def test_reopen_gives_up_waiting_after_timeout(monkeypatch):
+    monkeypatch.setattr(threaded, "STOP_TIMEOUT", 0.2)
+    clients = []
+    connection = create_connection(clients)
+
+    async def main():
+        client = await open_run_and_abandon(connection, clients)
+
+        start = trio.current_time()
+        await connection.open()
+        assert trio.current_time() - start >= 0.2
+        assert len(clients) == 2
+        assert not client.closed.is_set()
+
+        # The abandoned worker still stops after its next frame
+        client.release()
+        await trio.to_thread.run_sync(client.closed.wait, 1)
+        assert connection._latest is None
+        await connection.close()
+
+    trio.run(main)
+
+
+def test_run_needs_open_connection():
+    connection = create_connection([])
+    with pytest.raises(RuntimeError):
+        trio.run(connection.run)
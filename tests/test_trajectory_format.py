@@ -0,0 +1,53 @@
+import json
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("flockwave.server", reason="the extension needs Skybrush Server")
+
+from skybrush_ext_aimotionlab.trajectory_format import (  # noqa: E402
+    decode_binary_trajectory,
+    encode_binary_trajectory,
+    parse_trajectory,
+)
+
+ROOT = Path(__file__).parent.parent
+
+
+def assert_same_trajectory(actual, expected):
+    assert actual["takeoffTime"] == pytest.approx(expected.get("takeoffTime", 0.0))
+    assert actual["landingTime"] == pytest.approx(expected.get("landingTime", 0.0))
+    assert len(actual["points"]) == len(expected["points"])
+    for (t, position, controls), (t0, position0, controls0) in zip(
+        actual["points"], expected["points"]
+    ):
+        assert t == pytest.approx(t0)
+        assert position == pytest.approx(position0, abs=1e-6)
+        assert len(controls) == len(controls0)
+        for control, control0 in zip(controls, controls0):
+            assert control == pytest.approx(control0, abs=1e-6)
+
+
+@pytest.mark.parametrize("name", ["cw_traj.json", "ccw_traj.json", "hover.json"])
+def test_round_trip(name):
+    data = json.loads((ROOT / name).read_text())
+    payload = encode_binary_trajectory(data)
+    assert_same_trajectory(decode_binary_trajectory(payload), data)
+    assert_same_trajectory(parse_trajectory(payload), data)
+
+
+def test_json_payload():
+    data = {"version": 1, "points": [[0, [0, 0, 1], []]]}
+    assert parse_trajectory(json.dumps(data).encode()) == data
+
+
+def test_invalid_payloads():
+    payload = encode_binary_trajectory(
+        {"points": [[0, [0, 0, 0], []], [1, [1, 0, 0], [[0.5, 0, 0]]]]}
+    )
+    with pytest.raises(ValueError):
+        decode_binary_trajectory(b"XXXX" + payload[4:])
+    with pytest.raises(ValueError):
+        decode_binary_trajectory(payload[:4] + b"\x09" + payload[5:])
+    with pytest.raises(ValueError):
+        decode_binary_trajectory(payload[:-1])